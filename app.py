@@ -1,56 +1,234 @@
 import os
-from dotenv import load_dotenv
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
 
 from flask import (
-    Flask, request, jsonify
+    Blueprint, Flask, Response, abort, request, jsonify
 )
-from flask_debugtoolbar import DebugToolbarExtension
 from flask_cors import CORS
 from sqlalchemy.exc import IntegrityError
-from werkzeug.utils import secure_filename
 
 from models import (
-    db, connect_db, User, Message, Listing, Booking)
+    db, connect_db, User, Message, Listing, ListingCalendar, Booking,
+    BookingConflictError, CacheVersion, Conversation, CONVERSATION_JSON,
+    LISTING_JSON, ListingNotFoundError, MESSAGE_JSON)
+from pagination import decode_cursor, encode_cursor, parse_limit
+from cache import TTLCache
+from http_cache import cache_publicly, make_etag, not_modified
+from serializers import RowSerializer, json_response
+from events import HubFullError, hub
+from facets import PriceFacets, price_facets
+from hashing import HashingOverloadedError
+from metrics import metrics
+from query_budget import budget, query_budget
+from replicas import read_only, replicas
+from uploader import PhotoTooLargeError, UploadWorker
 
 from flask_jwt_extended import create_access_token
+from flask_jwt_extended import get_jwt
 from flask_jwt_extended import get_jwt_identity
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
 from sqlalchemy import func, or_
 
-load_dotenv()
-
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
-CORS(app)
+# Settings create_app refuses to start without
+REQUIRED_CONFIG = ('SQLALCHEMY_DATABASE_URI', 'SECRET_KEY', 'JWT_SECRET_KEY',
+                   'AWS_ACCESS_KEY', 'AWS_SECRET_ACCESS_KEY', 'AWS_BUCKET_NAME')
+
+api = Blueprint("api", __name__)
+
+# Most listings or bookings one batch request may ask for
+MAX_BATCH_SIZE = 100
+
+# Most nights one calendar request may ask for
+MAX_CALENDAR_DAYS = 366
+
+# Default and most price histogram buckets for GET /api/listings/facets
+DEFAULT_FACET_BUCKETS = 10
+MAX_FACET_BUCKETS = 100
+
+upload_worker = UploadWorker()
+
+# Detached User rows by username, for routes that need more than the id
+# carried in the token. Entries are read-only templates; see lookup_user.
+# create_app sizes it from IDENTITY_CACHE_SIZE and IDENTITY_CACHE_TTL.
+user_cache = TTLCache()
+
+
+def create_app(config=None):
+    """Build the app from the environment (and .env), then `config`.
+
+    Nothing expensive happens at import: the debug toolbar is only loaded
+    in debug mode, and the storage client and Pillow on first use.
+    Building the app opens no database connection, so it is safe to call
+    in a gunicorn master before forking workers (--preload).
+    Raises KeyError naming any required setting that is missing.
+    """
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    app = Flask(__name__)
+    CORS(app)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', '')
+        .replace("postgres://", "postgresql://"))
+    app.config['SQLALCHEMY_REPLICA_URIS'] = [
+        url.strip().replace("postgres://", "postgresql://")
+        for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if url.strip()]
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')
+    app.config['AWS_ACCESS_KEY'] = os.environ.get('AWS_ACCESS_KEY')
+    app.config['AWS_SECRET_ACCESS_KEY'] = os.environ.get(
+        'AWS_SECRET_ACCESS_KEY')
+    app.config['AWS_BUCKET_NAME'] = os.environ.get('AWS_BUCKET_NAME')
+    app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 's3')
+    app.config['STORAGE_LOCAL_ROOT'] = os.environ.get(
+        'STORAGE_LOCAL_ROOT', 'media')
+    app.config['STORAGE_BASE_URL'] = os.environ.get('STORAGE_BASE_URL')
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = False
+    app.config['BCRYPT_LOG_ROUNDS'] = int(
+        os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['HASH_WORKERS'] = int(os.environ.get('HASH_WORKERS', 2))
+    app.config['HASH_QUEUE_DEPTH'] = int(
+        os.environ.get('HASH_QUEUE_DEPTH', 16))
+    app.config['UPLOAD_WORKER_THREADS'] = int(
+        os.environ.get('UPLOAD_WORKER_THREADS', 2))
+    app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 1))
+    # Largest request body, in bytes; bigger photo uploads get a 413
+    app.config['MAX_CONTENT_LENGTH'] = int(
+        os.environ.get('MAX_CONTENT_LENGTH', 10 * 1024 * 1024))
+    app.config['PUBLIC_CACHE_MAX_AGE'] = int(
+        os.environ.get('PUBLIC_CACHE_MAX_AGE', 60))
+    app.config['MESSAGE_BROKER'] = os.environ.get('MESSAGE_BROKER')
+    # Streams per process; the stream server (gunicorn_streams.conf.py)
+    # raises it, gthread workers keep it well below their threads
+    app.config['STREAM_MAX_SUBSCRIBERS'] = int(
+        os.environ.get('STREAM_MAX_SUBSCRIBERS', 16))
+    app.config['STREAM_KEEPALIVE'] = float(
+        os.environ.get('STREAM_KEEPALIVE', 15))
+    app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 250))
+    app.config['SLOW_REQUEST_MS'] = float(
+        os.environ.get('SLOW_REQUEST_MS', 1000))
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['QUERY_BUDGET_MODE'] = os.environ.get('QUERY_BUDGET_MODE')
+    app.config['REPLICA_STICKY_SECONDS'] = float(
+        os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    app.config['REPLICA_CHECK_INTERVAL'] = float(
+        os.environ.get('REPLICA_CHECK_INTERVAL', 10))
+    app.config['REPLICA_MAX_LAG'] = float(
+        os.environ.get('REPLICA_MAX_LAG', 30))
+    app.config['IDENTITY_CACHE_SIZE'] = int(
+        os.environ.get('IDENTITY_CACHE_SIZE', 1024))
+    app.config['IDENTITY_CACHE_TTL'] = float(
+        os.environ.get('IDENTITY_CACHE_TTL', 60))
+
+    app.config.update(config or {})
+
+    missing = [key for key in REQUIRED_CONFIG if not app.config.get(key)]
+    if missing:
+        raise KeyError(f"missing required settings: {', '.join(missing)}")
+
+    # The toolbar records every query and template render: development
+    # only. metrics (below) is the production view of the same thing.
+    if app.debug:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    replicas.init_app(app)
+    metrics.init_app(app)
+    budget.init_app(app)
+    JWTManager(app)
+    upload_worker.init_app(app)
+    hub.init_app(app)
+
+    user_cache.maxsize = app.config['IDENTITY_CACHE_SIZE']
+    user_cache.ttl = app.config['IDENTITY_CACHE_TTL']
+
+    app.register_blueprint(api)
+
+    return app
+
+
+def __getattr__(name):
+    """Build the default app on first use of `app.app`.
+
+    So `from app import app` and `gunicorn app:app` keep working, while
+    importing this module (for create_app, or in a worker that already
+    has its app) doesn't read the environment or build anything.
+    """
+
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-app.config['JWT_SECRET_KEY'] = os.environ['JWT_SECRET_KEY']
-app.config['AWS_ACCESS_KEY'] = os.environ['AWS_ACCESS_KEY']
-app.config['AWS_SECRET_ACCESS_KEY'] = os.environ['AWS_SECRET_ACCESS_KEY']
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = False
+##############################################################################
+# Identity helpers
+
+def create_token(user):
+    """Return an access token for `user`.
+
+    The user id rides along as a claim so authenticated routes don't have
+    to look the user up.
+    """
+
+    return create_access_token(identity=user.username,
+                               additional_claims={"user_id": user.id})
+
+
+def lookup_user(username):
+    """Return the User with `username`, via the identity cache.
+
+    The cache holds detached copies; each caller gets its own instance
+    merged into the current session without a SELECT.
+    Raises NoResultFound if there is no such user.
+    """
+
+    cached = user_cache.get(username)
+
+    if cached is None:
+        cached = User.query.filter_by(username=username).one()
+        db.session.expunge(cached)
+        user_cache.set(username, cached)
+
+    return db.session.merge(cached, load=False)
+
+
+def current_user_id():
+    """Return the id of the user making this (authenticated) request.
+
+    Tokens issued before the user_id claim existed never expire, so fall
+    back to looking the user up by identity.
+    """
 
-toolbar = DebugToolbarExtension(app)
+    user_id = get_jwt().get("user_id")
 
-connect_db(app)
-jwt = JWTManager(app)
+    if user_id is None:
+        user_id = lookup_user(get_jwt_identity()).id
 
-SECRET_KEY = os.environ['SECRET_KEY']
+    return user_id
 
 
 
 ##############################################################################
 # User signup/login
 
-@app.route('/api/signup', methods=["GET", "POST"])
+@api.route('/api/signup', methods=["GET", "POST"])
+@query_budget(2)
 def signup():
     """Handle user signup.
 
@@ -70,12 +248,13 @@ def signup():
     db.session.add(user)
     db.session.commit()
 
-    access_token = create_access_token(identity=user.username)
+    access_token = create_token(user)
 
     return jsonify(token=access_token), 201
 
 
-@app.route('/api/login', methods=["POST"])
+@api.route('/api/login', methods=["POST"])
+@query_budget(2)
 def login():
     """Handle user login and return token."""
 
@@ -86,146 +265,467 @@ def login():
     if not user:
         return jsonify({"error": "invalid credentials"}),400
 
-    access_token = create_access_token(identity=username)
+    # persist a rehash at the current work factor, if authenticate made one
+    db.session.commit()
+
+    access_token = create_token(user)
 
     return jsonify(token=access_token)
 
 
-@app.route('/api/users/<username>', methods=["GET"])
+@api.route('/api/users/<username>', methods=["GET"])
+@read_only
+@query_budget(1)
 @jwt_required()
 def get_user(username):
     """Return user object as json."""
 
-    user = User.query.filter_by(username=username).one()
+    user = lookup_user(username)
     serialized = User.serialize(user)
 
     return jsonify(user=serialized)
 
 
-@app.route('/api/users/<username>/bookings', methods=["GET"])
+@api.route('/api/users/<username>/bookings', methods=["GET"])
+@read_only
+@query_budget(2)
 @jwt_required()
 def get_user_bookings(username):
     """Return user's bookings as json."""
 
-    user = User.query.filter_by(username=username).one()
+    user = lookup_user(username)
 
-    bookings = Booking.query.with_entities(
-            Booking.checkin_date, Booking.checkout_date,
-            Listing.name, Listing.id)\
+    bookings = Booking.query.with_entities(*USER_BOOKING_JSON.columns)\
             .filter_by(user_id=user.id)\
             .join(Listing,Listing.id==Booking.listing_id)
 
-    serialized = [{"name": b[2],
-                   "checkIn": b[0],
-                   "checkOut": b[1],
-                   "listingId": b[3]}
-                   for b in bookings]
-    return jsonify(bookings=serialized)
+    serialized = USER_BOOKING_JSON.many(bookings)
+    return json_response(bookings=serialized)
+
+
+USER_BOOKING_JSON = RowSerializer(
+    name=Listing.name,
+    checkIn=Booking.checkin_date,
+    checkOut=Booking.checkout_date,
+    listingId=Listing.id,
+)
 
 
 ##############################################################################
 # Listings routes:
 
-@app.get('/api/listings')
+@api.get('/api/listings')
+@read_only
+@query_budget(2)
 def get_all_listings():
-    """Return all listings as JSON."""
+    """Return a page of listings as JSON.
+
+    Optional query params:
+    - q: search text, matched against name and details; results are
+      ordered by relevance (`name` is accepted as an alias)
+    - minPrice, maxPrice: price range (inclusive)
+    - checkin_date, checkout_date: only listings free for this whole stay
+      (ISO dates, given together)
+    - sort: one of id, -id, price, -price (default id; ignored with q)
+    - limit: page size (default 20, max 100)
+    - cursor: the nextCursor from the previous page
+    - ids: comma-separated listing ids (at most 100) to fetch in one
+      request, e.g. for a page of saved listings. Returns them in that
+      order, leaving out any that don't exist or don't match the other
+      filters; not combined with q, sort, limit or cursor.
+
+    Returns {listings: [...], nextCursor: str or null}.
+
+    Responses carry an ETag from the listings version counter, so a
+    conditional GET is answered with a 304 before any listing is queried.
+    Availability also depends on bookings, so results filtered by stay
+    are not cached.
+    """
+
+    args = request.args
+    cacheable = not (args.get("checkin_date") or args.get("checkout_date"))
+
+    if cacheable:
+        version, last_modified = CacheVersion.current(CacheVersion.LISTINGS)
+        etag = make_etag("listings", version)
+        unchanged = not_modified(etag, last_modified)
+        if unchanged:
+            return unchanged
+
+    terms = (args.get("q") or args.get("name") or "").strip()
+    sort = "relevance" if terms else args.get("sort", "id")
+
+    if not terms and sort not in Listing.SORTS:
+        return jsonify({"error": f"sort must be one of {Listing.SORTS}"}), 400
+
+    columns = LISTING_JSON.columns
 
     try:
-        name = request.args["name"]
-        listings = Listing.query.filter(Listing.name.ilike(f"%{name}%")).all()
-    except:
-        listings = Listing.query.all()
+        limit = parse_limit(args.get("limit"))
+        min_price = _price_arg(args.get("minPrice"))
+        max_price = _price_arg(args.get("maxPrice"))
+        available = _stay_args(args.get("checkin_date"),
+                               args.get("checkout_date"))
+        after = (decode_cursor(args["cursor"], sort)
+                 if args.get("cursor") else None)
+        ids = _ids_arg(args.get("ids"))
+
+        if ids is not None:
+            if terms:
+                raise ValueError("give one of ids and q")
+            listings = Listing.by_ids(ids,
+                                      min_price=min_price,
+                                      max_price=max_price,
+                                      available=available,
+                                      columns=columns)
+            next_key = None
+        elif terms:
+            offset = max(int(after[0]), 0) if after else 0
+            listings, next_offset = Listing.search(terms,
+                                                   min_price=min_price,
+                                                   max_price=max_price,
+                                                   available=available,
+                                                   offset=offset,
+                                                   limit=limit,
+                                                   columns=columns)
+            next_key = [next_offset] if next_offset else None
+        else:
+            listings, next_key = Listing.browse(sort=sort,
+                                                min_price=min_price,
+                                                max_price=max_price,
+                                                available=available,
+                                                after=after,
+                                                limit=limit,
+                                                columns=columns)
+    except (ValueError, TypeError, InvalidOperation) as e:
+        return jsonify({"error": str(e) or "invalid query"}), 400
+
+    serialized = LISTING_JSON.many(listings)
+    next_cursor = encode_cursor(sort, next_key) if next_key else None
+
+    response = json_response(listings=serialized, nextCursor=next_cursor)
+    if cacheable:
+        cache_publicly(response, etag, last_modified)
+
+    return response
+
+
+def _price_arg(raw):
+    """Parse an optional price query param into a Decimal."""
+
+    if raw is None or raw == "":
+        return None
 
-    serialized = [Listing.serialize(l) for l in listings]
+    return Decimal(raw)
 
-    return jsonify(listings=serialized)
 
+def _ids_arg(raw):
+    """Parse an optional comma-separated list of ids, without repeats."""
+
+    if raw is None or raw == "":
+        return None
+
+    ids = list(dict.fromkeys(int(id) for id in raw.split(",")))
+    if len(ids) > MAX_BATCH_SIZE:
+        raise ValueError(f"at most {MAX_BATCH_SIZE} ids")
+
+    return ids
+
+
+def _stay_args(checkin, checkout):
+    """Parse optional checkin/checkout query params into a datetime pair.
+
+    Returns None if neither is given.
+    """
+
+    if not checkin and not checkout:
+        return None
+    if not checkin or not checkout:
+        raise ValueError("checkin_date and checkout_date go together")
+
+    stay = (datetime.fromisoformat(checkin), datetime.fromisoformat(checkout))
+    if stay[0] >= stay[1]:
+        raise ValueError("checkout_date must be after checkin_date")
+
+    return stay
+
+
+@api.get('/api/listings/facets')
+@read_only
+@query_budget(2)
+def get_listing_facets():
+    """Return listing counts and a price histogram as JSON, for the
+    browse page's filters and price slider.
+
+    Takes the q, minPrice, maxPrice, checkin_date and checkout_date
+    params of GET /api/listings, plus:
+    - buckets: most histogram buckets (default 10, max 100)
+
+    Returns {facets: {count, price: {min, max, buckets: [...]}}}:
+    - count: listings matching every filter
+    - price: the prices of listings matching every filter except the
+      price range, so a slider can show what lies outside it. Buckets
+      split min to max into ranges of equal width, as {min, max, count}
+      with both ends included. min and max are null if nothing matches.
+
+    Counts for all listings come from a per-process PriceFacets rebuilt
+    when the listings version changes, so without q or a stay this is
+    the version lookup and nothing else; with them, one query grouped
+    by price. Caching is as for GET /api/listings.
+    """
 
-@app.post('/api/listings')
+    args = request.args
+    cacheable = not (args.get("checkin_date") or args.get("checkout_date"))
+
+    if cacheable:
+        version, last_modified = CacheVersion.current(CacheVersion.LISTINGS)
+        etag = make_etag("listing-facets", version)
+        unchanged = not_modified(etag, last_modified)
+        if unchanged:
+            return unchanged
+
+    terms = (args.get("q") or args.get("name") or "").strip()
+
+    try:
+        min_price = _price_arg(args.get("minPrice"))
+        max_price = _price_arg(args.get("maxPrice"))
+        available = _stay_args(args.get("checkin_date"),
+                               args.get("checkout_date"))
+        buckets = int(args.get("buckets", DEFAULT_FACET_BUCKETS))
+        if not 1 <= buckets <= MAX_FACET_BUCKETS:
+            raise ValueError(f"buckets must be 1 to {MAX_FACET_BUCKETS}")
+    except (ValueError, TypeError, InvalidOperation) as e:
+        return jsonify({"error": str(e) or "invalid query"}), 400
+
+    if cacheable and not terms:
+        facets = price_facets.get(version, Listing.price_counts)
+    else:
+        facets = PriceFacets(Listing.price_counts(terms=terms,
+                                                  available=available))
+
+    response = json_response(facets={
+        "count": facets.count(min_price, max_price),
+        "price": {
+            "min": facets.min_price,
+            "max": facets.max_price,
+            "buckets": facets.histogram(buckets),
+        },
+    })
+    if cacheable:
+        cache_publicly(response, etag, last_modified)
+
+    return response
+
+
+@api.post('/api/listings')
+@query_budget(7)
 @jwt_required()
 def create_listing():
-    """Add a listing and returns listing details as JSON."""
+    """Add a listing and returns listing details as JSON.
+
+    A photo is uploaded in the background: the listing comes back with
+    the default photo and photoStatus "pending" until the upload is done.
+    """
 
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).one()
+    user_id = current_user_id()
 
     name = request.form.get('name')
     price = request.form.get('price')
     details = request.form.get('details')
 
-    listing = Listing(user_id=user.id,
+    listing = Listing(user_id=user_id,
                       name=name,
                       price=float(price),
                       details=details)
     db.session.add(listing)
-    db.session.commit()
+    db.session.flush()
 
-    if request.files.get('photo'):
-        photo = request.files.get('photo')
-        photo.filename = f"{listing.id}.jpg"
+    photo = request.files.get('photo')
+    if photo:
+        object_name = f"{listing.id}.jpg"
+        upload_worker.enqueue(listing, photo, object_name)
 
-        photo.save(os.path.join("uploads", secure_filename(photo.filename)))
-        url = Listing.upload_file(file_name=photo.filename)
-        os.remove(os.path.join("uploads", secure_filename(photo.filename)))
+    db.session.commit()
 
-        listing.photo = url
+    if photo:
+        upload_worker.wake()
 
-    db.session.commit()
     serialized = Listing.serialize(listing)
 
     return jsonify(listing=serialized), 201
 
 
-@app.get('/api/listings/<int:listing_id>')
+@api.get('/api/listings/<int:listing_id>')
+@read_only
+@query_budget(1)
 def get_listing(listing_id):
-    """Get details about a listing."""
+    """Get details about a listing.
+
+    Supports conditional GETs against the listing's version.
+    """
 
     listing = Listing.query.get_or_404(listing_id)
+    etag = make_etag("listing", listing.id, listing.version)
+
+    unchanged = not_modified(etag, listing.updated_at)
+    if unchanged:
+        return unchanged
+
     serialized = Listing.serialize(listing)
 
-    return jsonify(listing=serialized)
+    return cache_publicly(jsonify(listing=serialized), etag,
+                          listing.updated_at)
+
+
+@api.get('/api/listings/<int:listing_id>/calendar')
+@read_only
+@query_budget(1)
+def get_listing_calendar(listing_id):
+    """Which nights a listing is booked.
 
+    Optional query params:
+    - from: first night (ISO date; default today)
+    - to: the day after the last night (default 30 days after from; at
+      most a year after it)
 
-@app.post('/api/listings/<int:listing_id>/book')
+    Returns {calendar: {listingId, from, to, booked}}; booked has one
+    character per night, "1" if booked and "0" if free.
+    """
+
+    try:
+        start = (date.fromisoformat(request.args["from"])
+                 if request.args.get("from") else datetime.utcnow().date())
+        end = (date.fromisoformat(request.args["to"])
+               if request.args.get("to") else start + timedelta(days=30))
+        if start >= end:
+            raise ValueError("to must be after from")
+        if (end - start).days > MAX_CALENDAR_DAYS:
+            raise ValueError(f"at most {MAX_CALENDAR_DAYS} nights")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    booked = ListingCalendar.booked(listing_id, start, end)
+    if booked is None:
+        abort(404)
+
+    return jsonify(calendar={"listingId": listing_id,
+                             "from": start.isoformat(),
+                             "to": end.isoformat(),
+                             "booked": booked})
+
+
+@api.post('/api/listings/<int:listing_id>/book')
+@query_budget(8)
 @jwt_required()
 def book_listing(listing_id):
-    """Book a listing."""
+    """Book a listing.
+
+    Returns 409 if the stay overlaps an existing booking.
+    """
 
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).one()
+    user_id = current_user_id()
 
-    checkin_date = request.json.get('checkin_date')
-    checkout_date = request.json.get('checkout_date')
+    try:
+        stay = _stay_args(request.json.get('checkin_date'),
+                          request.json.get('checkout_date'))
+        if stay is None:
+            raise ValueError("checkin_date and checkout_date are required")
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
 
-    booking = Booking(user_id=user.id,
-                      listing_id=listing_id,
-                      checkin_date=checkin_date,
-                      checkout_date=checkout_date)
+    Listing.query.get_or_404(listing_id)
 
-    db.session.add(booking)
-    db.session.commit()
+    try:
+        booking = Booking.book(user_id=user_id,
+                               listing_id=listing_id,
+                               checkin_date=stay[0],
+                               checkout_date=stay[1])
+    except BookingConflictError:
+        return jsonify({"error": "listing is already booked for those dates"}), 409
 
     serialized = Booking.serialize(booking)
 
     return jsonify(booking=serialized), 201
 
 
-@app.post('/api/listings/<int:listing_id>/message')
+@api.post('/api/bookings')
+@query_budget(8)
+@jwt_required()
+def book_listings():
+    """Book many stays, for any listings, in one transaction.
+
+    Takes {bookings: [{listing_id, checkin_date, checkout_date}, ...]}, at
+    most 100. Each stay is booked unless it is invalid, its listing
+    doesn't exist, or it overlaps an existing booking or an earlier stay
+    in the batch; the others are booked regardless.
+
+    Returns {results: [...]}, one per stay in order: {status: 201,
+    booking: {...}}, or {status: 400, 404 or 409, error: "..."}. The
+    response is 201 if every stay was booked, else 207.
+    """
+
+    user_id = current_user_id()
+
+    items = (request.json or {}).get("bookings")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "bookings must be a non-empty list"}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify(
+            {"error": f"at most {MAX_BATCH_SIZE} bookings at a time"}), 400
+
+    results = [None] * len(items)
+    stays = {}
+    for n, item in enumerate(items):
+        try:
+            listing_id = int(item.get("listing_id"))
+            stay = _stay_args(item.get("checkin_date"),
+                              item.get("checkout_date"))
+            if stay is None:
+                raise ValueError(
+                    "checkin_date and checkout_date are required")
+        except (AttributeError, ValueError, TypeError) as e:
+            results[n] = {"status": 400, "error": str(e)}
+            continue
+        stays[n] = (listing_id, *stay)
+
+    # once more if a booking made without the listing locks gets in
+    # first; if it happens again, none of the stays were booked
+    bookings = [BookingConflictError()] * len(stays)
+    for attempt in range(2):
+        try:
+            bookings = Booking.book_many(user_id, list(stays.values()))
+            break
+        except BookingConflictError:
+            pass
+
+    for n, booking in zip(stays, bookings):
+        if isinstance(booking, ListingNotFoundError):
+            results[n] = {"status": 404, "error": "listing not found"}
+        elif isinstance(booking, BookingConflictError):
+            results[n] = {"status": 409, "error":
+                          "listing is already booked for those dates"}
+        else:
+            results[n] = {"status": 201, "booking": Booking.serialize(booking)}
+
+    created = all(result["status"] == 201 for result in results)
+
+    return jsonify(results=results), 201 if created else 207
+
+
+@api.post('/api/listings/<int:listing_id>/message')
+@query_budget(6)
 @jwt_required()
 def message_listing_owner(listing_id):
     """Message an owner about a listing."""
 
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).one()
+    user_id = current_user_id()
 
     text = request.json.get('text')
     listing = Listing.query.get_or_404(listing_id)
 
-    message = Message(to_user_id=listing.user_id,
-                      from_user_id=user.id,
-                      text=text)
-
-    db.session.add(message)
+    message = Message.send(from_user_id=user_id,
+                           to_user_id=listing.user_id,
+                           text=text)
     db.session.commit()
 
     serialized = Message.serialize(message)
@@ -235,65 +735,113 @@ def message_listing_owner(listing_id):
 ##############################################################################
 # Messages routes:
 
-@app.get('/api/messages')
+@api.get('/api/messages')
+@read_only
+@query_budget(2)
 @jwt_required()
 def get_messages():
-    """Gets all messages a user has sent and received."""
+    """Gets a page of the user's conversations, most recent first.
+
+    Each has the other user's id and username, a snippet of the last
+    message and how many messages the user hasn't read yet.
+
+    Optional query params:
+    - limit: page size (default 20, max 100)
+    - cursor: the nextCursor from the previous page
+
+    Returns {conversations: [...], nextCursor: str or null}.
+    """
+
+    user_id = current_user_id()
+
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        before = (int(decode_cursor(request.args["cursor"], "recent")[0])
+                  if request.args.get("cursor") else None)
+    except (ValueError, TypeError, IndexError) as e:
+        return jsonify({"error": str(e) or "invalid query"}), 400
+
+    conversations, next_key = Conversation.inbox(user_id,
+                                                 before=before,
+                                                 limit=limit)
+
+    serialized = CONVERSATION_JSON.many(conversations)
+    next_cursor = encode_cursor("recent", [next_key]) if next_key else None
+
+    return json_response(conversations=serialized, nextCursor=next_cursor)
 
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).one()
 
-    recd = Message.query.with_entities(
-        Message.from_user_id, User.username)\
-            .filter((Message.from_user_id != user.id) & (Message.to_user_id == user.id))\
-            .group_by(Message.from_user_id,User.username)\
-            .join(User,User.id == Message.from_user_id)\
-            .all()
+@api.get('/api/messages/stream')
+@query_budget(1)
+@jwt_required(locations=["headers", "query_string"])
+def stream_messages():
+    """Push the user's new messages, sent and received, as they commit.
 
-    sent = Message.query.with_entities(
-        Message.to_user_id, User.username)\
-            .filter((Message.to_user_id != user.id) & (Message.from_user_id == user.id))\
-            .group_by(Message.to_user_id,User.username)\
-            .join(User,User.id == Message.to_user_id)\
-            .all()
+    A Server-Sent Events stream: each event is a message, as in
+    GET /api/messages/<user_id>, with its id as the event id. EventSource
+    can't set headers, so the token may also be passed as ?jwt=<token>.
+    Returns 503 if this worker has no room for another stream.
+    """
 
-    conversations = {*recd,*sent}
+    hub.check_room()
+    user_id = current_user_id()
 
-    serialized = [{"id":c[0],"username":c[1]} for c in conversations]
+    # the stream may stay open for hours; don't hold a DB connection
+    db.session.remove()
 
-    return jsonify(conversations=serialized)
+    return Response(hub.stream(user_id),
+                    mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
 
 
-@app.route('/api/messages/<int:user_id>', methods=["GET", "POST"])
+@api.route('/api/messages/<int:user_id>', methods=["GET", "POST"])
+@query_budget(5)
 @jwt_required()
 def open_conversation(user_id):
     """Gets messages with one person.
 
-    Return messages if GET, add new message if POST.
+    Return messages if GET (and mark them read), add new message if POST.
+
+    GET returns a page of messages, oldest first: by default the latest
+    ones. Optional query params:
+    - before: id of a message; page back from it (e.g. the first id of
+      the current page)
+    - after: id of a message; page forward from it
+    - limit: page size (default 50, max 100)
+
+    Returns {messages: [...], hasMore: bool}; hasMore says whether there
+    are more messages in the direction of the page.
     """
 
-    username = get_jwt_identity()
-    user = User.query.filter_by(username=username).one()
+    current_id = current_user_id()
 
     if request.method == "GET":
-        messages = Message.query.filter(((Message.to_user_id==user_id) &
-                                        (Message.from_user_id==user.id)) |
-                                        ((Message.to_user_id==user.id) &
-                                        (Message.from_user_id==user_id)))\
-                                        .order_by(Message.id)\
-                                        .all()
+        args = request.args
+        try:
+            limit = parse_limit(args.get("limit"), default=50)
+            before = _message_id_arg(args.get("before"))
+            after = _message_id_arg(args.get("after"))
+            if before is not None and after is not None:
+                raise ValueError("give one of before and after")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        messages, has_more = Message.history(current_id, user_id,
+                                             before=before,
+                                             after=after,
+                                             limit=limit)
+
+        Conversation.mark_read(current_id, user_id)
+        db.session.commit()
 
-        serialized = [Message.serialize(m) for m in messages]
+        serialized = MESSAGE_JSON.many(messages)
 
-        return jsonify(messages=serialized)
+        return json_response(messages=serialized, hasMore=has_more)
 
     else:
-        message = Message(
-            to_user_id=user_id,
-            from_user_id=user.id,
-            text=request.json.get("text")
-            )
-        db.session.add(message)
+        message = Message.send(from_user_id=current_id,
+                               to_user_id=user_id,
+                               text=request.json.get("text"))
         db.session.commit()
 
         serialized = Message.serialize(message)
@@ -301,20 +849,59 @@ def open_conversation(user_id):
         return jsonify(message=serialized), 201
 
 
+def _message_id_arg(raw):
+    """Parse an optional before/after message id query param."""
+
+    if raw is None or raw == "":
+        return None
+
+    return int(raw)
+
+
 ##############################################################################
 # Homepage and error pages
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def page_not_found(e):
     """404 NOT FOUND page."""
 
     return jsonify({"error": "Page not found."}), 404
 
 
-@app.after_request
+@api.app_errorhandler(413)
+@api.app_errorhandler(PhotoTooLargeError)
+def too_large(e):
+    """413 for a request body or photo over MAX_CONTENT_LENGTH."""
+
+    return jsonify({"error": "Upload too large."}), 413
+
+
+@api.app_errorhandler(HashingOverloadedError)
+def hashing_overloaded(e):
+    """503 when too many logins/signups are waiting on password hashing."""
+
+    response = jsonify({"error": "Server busy, please retry."})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+
+@api.app_errorhandler(HubFullError)
+def hub_full(e):
+    """503 when this worker can't hold another message stream."""
+
+    response = jsonify({"error": "Server busy, please retry."})
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+
+@api.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers, unless the route made the response public.
+
+    See http_cache for the public listing reads.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if not response.cache_control.public:
+        response.cache_control.no_store = True
     return response
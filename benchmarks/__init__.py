@@ -0,0 +1 @@
+"""Benchmark and load-test scripts. Run from the repo root as modules."""
@@ -0,0 +1,100 @@
+"""Mixed login / browse load against the WSGI app.
+
+Login threads hammer POST /api/login while reader threads fetch
+GET /api/listings/<id>, all in one process as gunicorn gthread workers
+would. Reports p50/p95/p99 for both, plus how many logins were shed
+with 503.
+
+    python -m benchmarks.auth_mixed_load --hash-workers 2
+    python -m benchmarks.auth_mixed_load --hash-workers 0   # inline hashing
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks.common import percentiles, setup_env
+
+
+def run(args):
+    setup_env(BCRYPT_LOG_ROUNDS=args.rounds,
+              HASH_WORKERS=args.hash_workers,
+              HASH_QUEUE_DEPTH=args.queue_depth)
+
+    from app import app
+    from models import db, User, Listing
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User.signup("bench", "bench@email.com", "password",
+                           "Bench", "User")
+        db.session.commit()
+        listing = Listing(user_id=user.id, name="Bench", price=100)
+        db.session.add(listing)
+        db.session.commit()
+        listing_id = listing.id
+
+    results = {"login": [], "read": []}
+    statuses = {"login": {}, "read": {}}
+    deadline = time.perf_counter() + args.duration
+    lock = threading.Lock()
+
+    def worker(kind):
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if kind == "login":
+                resp = client.post("/api/login", json={
+                    "username": "bench", "password": "password"})
+            else:
+                resp = client.get(f"/api/listings/{listing_id}")
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                counts = statuses[kind]
+                counts[resp.status_code] = counts.get(resp.status_code, 0) + 1
+                if resp.status_code < 500:
+                    results[kind].append(elapsed)
+
+            if resp.status_code == 503:
+                # a real client would back off before retrying
+                time.sleep(args.backoff)
+
+    threads = ([threading.Thread(target=worker, args=("login",))
+                for _ in range(args.logins)] +
+               [threading.Thread(target=worker, args=("read",))
+                for _ in range(args.readers)])
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(f"hash workers={args.hash_workers} rounds={args.rounds} "
+          f"logins={args.logins} readers={args.readers} "
+          f"duration={args.duration}s")
+    for kind in ("login", "read"):
+        print(f"  {kind:5} ok={len(results[kind]):6} "
+              f"statuses={statuses[kind]} {percentiles(results[kind])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=8,
+                        help="concurrent login clients")
+    parser.add_argument("--readers", type=int, default=4,
+                        help="concurrent GET clients")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--rounds", type=int, default=12,
+                        help="BCRYPT_LOG_ROUNDS")
+    parser.add_argument("--hash-workers", type=int, default=2,
+                        help="HASH_WORKERS (0 hashes inline)")
+    parser.add_argument("--queue-depth", type=int, default=4,
+                        help="HASH_QUEUE_DEPTH")
+    parser.add_argument("--backoff", type=float, default=0.1,
+                        help="seconds a login client waits after a 503")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
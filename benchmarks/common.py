@@ -0,0 +1,56 @@
+"""Shared setup for benchmark scripts.
+
+Run benchmarks from the repo root, e.g.
+
+    python -m benchmarks.auth_mixed_load
+
+Unless DATABASE_URL is already set they use a throwaway SQLite database,
+and the other settings app.py requires get dummy values, so they run
+offline. Call setup_env() before importing app.
+"""
+
+import os
+import tempfile
+import time
+
+
+def setup_env(**overrides):
+    """Fill in the environment app.py expects, without clobbering it."""
+
+    workdir = tempfile.mkdtemp(prefix="sharebnb-bench-")
+    defaults = {
+        "DATABASE_URL": f"sqlite:///{workdir}/bench.db",
+        "SECRET_KEY": "bench",
+        "JWT_SECRET_KEY": "bench",
+        "AWS_ACCESS_KEY": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_BUCKET_NAME": "sharebnb-bench",
+    }
+    defaults.update({k: str(v) for k, v in overrides.items()})
+
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+    return workdir
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """Return {"p50": ms, ...} for a list of durations in seconds."""
+
+    if not samples:
+        return {f"p{p}": None for p in points}
+
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+
+    return {f"p{p}": round(ordered[min(last, round(p / 100 * last))] * 1000, 2)
+            for p in points}
+
+
+def timed(fn, *args, **kwargs):
+    """Call fn and return (result, elapsed seconds)."""
+
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+
+    return result, time.perf_counter() - start
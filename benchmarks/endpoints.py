@@ -0,0 +1,429 @@
+"""Concurrent load on every route, with throughput and latency per route.
+
+Seeds a synthetic dataset (generator/, loaded with loader.py) unless
+--no-seed, then runs --clients threads for --duration seconds. Each
+request picks a route by weight from --mix:
+
+    browse        GET  /api/listings (random sort and price range)
+    search        GET  /api/listings?q=...
+    facets        GET  /api/listings/facets, half with q
+    detail        GET  /api/listings/<id>, popular listings more often
+    book          POST /api/listings/<id>/book, far future dates
+    bookings      GET  /api/users/<username>/bookings
+    inbox         GET  /api/messages
+    conversation  GET  /api/messages/<user_id>
+    login         POST /api/login
+
+--target wsgi calls the app in this process, as gthread worker threads
+would; --target gunicorn starts `gunicorn --worker-class gthread` on a
+local port and talks HTTP to it. Results print as a table and, with
+--output, are saved as JSON; --compare flags any route whose p95 grew or
+throughput fell by more than --threshold against a saved run, and exits
+non-zero if one did.
+
+    python -m benchmarks.endpoints --users 20000 --duration 30 \\
+        --output before.json
+    python -m benchmarks.endpoints --no-seed --compare before.json
+
+Uses a throwaway SQLite database unless DATABASE_URL is set.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from benchmarks.common import percentiles, setup_env
+
+ROUTES = ("browse", "search", "facets", "detail", "book", "bookings",
+          "inbox", "conversation", "login")
+
+DEFAULT_MIX = ("browse=25,search=10,facets=5,detail=25,book=5,bookings=5,"
+               "inbox=10,conversation=15,login=5")
+
+SEARCH_TERMS = ("backyard", "garden", "pool", "fire pit", "treehouse",
+                "quiet", "hot tub", "orchard")
+
+
+class WSGIClient:
+    """Requests through the app in this process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body=None):
+        resp = self.client.open(path, method=method, headers=headers,
+                                json=body)
+        resp.close()
+        return resp.status_code
+
+
+class HTTPClient:
+    """Requests over one keep-alive HTTP connection."""
+
+    def __init__(self, port):
+        self.port = port
+        self.connection = None
+
+    def request(self, method, path, headers, body=None):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                "127.0.0.1", self.port, timeout=30)
+
+        headers = dict(headers)
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        try:
+            self.connection.request(method, path, payload, headers)
+            resp = self.connection.getresponse()
+            resp.read()
+            return resp.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+
+class Workload:
+    """The ids and tokens requests are made from, picked at random."""
+
+    def __init__(self, app, sample=1000):
+        from app import create_token
+        from models import db, Conversation, Listing, User
+
+        with app.app_context():
+            def auth(user):
+                return {"Authorization": f"Bearer {create_token(user)}"}
+
+            users = User.query.order_by(User.id).limit(sample)
+            self.users = [(user.username, auth(user)) for user in users]
+
+            sides = db.session.query(User, Conversation.other_user_id)\
+                .join(Conversation, Conversation.user_id == User.id)\
+                .limit(sample)
+            self.conversations = [(other_id, auth(user))
+                                  for user, other_id in sides]
+            self.listings = [id for (id,) in db.session.query(Listing.id)
+                             .order_by(Listing.id).limit(sample * 10)]
+            self.max_price = int(db.session.query(
+                db.func.max(Listing.price)).scalar() or 100)
+
+        self.booked = 0
+        self._lock = threading.Lock()
+
+    def next_stay(self):
+        """A stay after every generated booking, never reused."""
+
+        with self._lock:
+            self.booked += 1
+            n = self.booked
+        checkin = date(2030, 1, 1) + timedelta(days=n % 3650)
+        return (checkin.isoformat(),
+                (checkin + timedelta(days=2)).isoformat())
+
+    def browse(self, rng):
+        low = rng.randrange(self.max_price)
+        sort = rng.choice(("id", "-id", "price", "-price"))
+        return ("GET", f"/api/listings?sort={sort}&minPrice={low}"
+                       f"&maxPrice={low + 100}", {}, None)
+
+    def search(self, rng):
+        return ("GET", f"/api/listings?q={rng.choice(SEARCH_TERMS)}",
+                {}, None)
+
+    def facets(self, rng):
+        low = rng.randrange(self.max_price)
+        query = f"minPrice={low}&maxPrice={low + 100}&buckets=20"
+        if rng.random() < 0.5:
+            query += f"&q={rng.choice(SEARCH_TERMS)}"
+        return "GET", f"/api/listings/facets?{query}", {}, None
+
+    def detail(self, rng):
+        # skewed towards the first (hot) part of the sample
+        id = self.listings[int(len(self.listings) * rng.random() ** 3)]
+        return "GET", f"/api/listings/{id}", {}, None
+
+    def book(self, rng):
+        _, headers = rng.choice(self.users)
+        checkin, checkout = self.next_stay()
+        return ("POST", f"/api/listings/{rng.choice(self.listings)}/book",
+                headers, {"checkin_date": checkin,
+                          "checkout_date": checkout})
+
+    def bookings(self, rng):
+        username, headers = rng.choice(self.users)
+        return "GET", f"/api/users/{username}/bookings", headers, None
+
+    def inbox(self, rng):
+        _, headers = rng.choice(self.conversations or self.users)
+        return "GET", "/api/messages", headers, None
+
+    def conversation(self, rng):
+        other_id, headers = rng.choice(self.conversations)
+        return "GET", f"/api/messages/{other_id}", headers, None
+
+    def login(self, rng):
+        username, _ = rng.choice(self.users)
+        return ("POST", "/api/login", {},
+                {"username": username, "password": "password"})
+
+
+def seed(args):
+    """Generate and load a dataset of the requested size."""
+
+    import migrations
+    from app import app
+    from generator import Dataset, generate
+    from loader import BulkLoader
+    from models import db
+
+    out = tempfile.mkdtemp(prefix="sharebnb-data-")
+    dataset = Dataset(args.users, args.listings, args.bookings,
+                      args.messages, seed=args.seed)
+    generate(dataset, out, log=lambda line: None)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        migrations.stamp(db.engine)
+        BulkLoader(db.engine, log=lambda line: None).load(out)
+
+
+def start_gunicorn(args):
+    """Start gunicorn on a free port; return (process, port)."""
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app",
+         "--worker-class", "gthread",
+         "--workers", str(args.workers),
+         "--threads", str(args.threads),
+         "--bind", f"127.0.0.1:{port}",
+         "--log-level", "warning"],
+        env=os.environ.copy())
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            HTTPClient(port).request("GET", "/api/listings", {})
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+
+    process.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        route, _, weight = part.partition("=")
+        if route not in ROUTES:
+            raise SystemExit(f"unknown route {route!r} in --mix")
+        weights[route] = float(weight or 1)
+    return weights
+
+
+def drive(make_client, workload, weights, clients, duration, warmup, seed):
+    """Run `clients` threads; return {route: {"latencies", "statuses",
+    "errors"}} for requests started after the warmup."""
+
+    routes, cum_weights = list(weights), []
+    total = 0
+    for route in routes:
+        total += weights[route]
+        cum_weights.append(total)
+
+    results = {route: {"latencies": [], "statuses": {}, "errors": 0}
+               for route in routes}
+    lock = threading.Lock()
+    start = time.perf_counter()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        client = make_client()
+        while True:
+            route = rng.choices(routes, cum_weights=cum_weights)[0]
+            method, path, headers, body = getattr(workload, route)(rng)
+
+            sent = time.perf_counter()
+            if sent >= deadline:
+                return
+            try:
+                status = client.request(method, path, headers, body)
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - sent
+
+            if sent < measure_from:
+                continue
+            with lock:
+                result = results[route]
+                if status is None or status >= 500:
+                    result["errors"] += 1
+                else:
+                    result["latencies"].append(elapsed)
+                key = str(status)
+                result["statuses"][key] = result["statuses"].get(key, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def summarize(results, duration):
+    summary = {}
+    for route, result in results.items():
+        latencies = result["latencies"]
+        summary[route] = {
+            "requests": len(latencies) + result["errors"],
+            "errors": result["errors"],
+            "statuses": result["statuses"],
+            "throughput": round(len(latencies) / duration, 2),
+            **percentiles(latencies),
+        }
+    return summary
+
+
+def compare(summary, baseline, threshold):
+    """Return a line for each route that regressed against `baseline`."""
+
+    regressions = []
+    for route, now in summary.items():
+        before = baseline["routes"].get(route)
+        if not before or not now["requests"] or not before["requests"]:
+            continue
+        if (before["p95"] and now["p95"] and
+                now["p95"] > before["p95"] * (1 + threshold)):
+            regressions.append(f"{route}: p95 {before['p95']} -> "
+                               f"{now['p95']} ms")
+        if now["throughput"] < before["throughput"] * (1 - threshold):
+            regressions.append(f"{route}: throughput "
+                               f"{before['throughput']} -> "
+                               f"{now['throughput']} req/s")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    setup_env(BCRYPT_LOG_ROUNDS=args.rounds)
+    weights = parse_mix(args.mix)
+
+    from app import app
+
+    if not args.no_seed:
+        seed(args)
+    workload = Workload(app)
+
+    process = None
+    if args.target == "gunicorn":
+        process, port = start_gunicorn(args)
+        make_client = lambda: HTTPClient(port)
+    else:
+        make_client = lambda: WSGIClient(app)
+
+    try:
+        results = drive(make_client, workload, weights, args.clients,
+                        args.duration, args.warmup, args.seed)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    summary = summarize(results, args.duration)
+
+    print(f"{args.target}: {args.clients} clients, {args.duration}s")
+    print(f"  {'route':13} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}"
+          f"  statuses")
+    for route, stats in summary.items():
+        print(f"  {route:13} {stats['throughput']:8.1f} "
+              f"{stats['p50'] or 0:8.2f} {stats['p95'] or 0:8.2f} "
+              f"{stats['p99'] or 0:8.2f}  {stats['statuses']}")
+
+    report = {
+        "run_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "database": app.config['SQLALCHEMY_DATABASE_URI'].split(":")[0],
+        "args": vars(args),
+        "routes": summary,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(summary, json.load(file), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", choices=("wsgi", "gunicorn"),
+                        default="wsgi")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3,
+                        help="seconds of load before measuring")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="route=weight,... (default %(default)s)")
+    parser.add_argument("--rounds", type=int, default=12,
+                        help="BCRYPT_LOG_ROUNDS")
+    parser.add_argument("--seed", type=int, default=0)
+
+    data = parser.add_argument_group("dataset")
+    data.add_argument("--no-seed", action="store_true",
+                      help="use the data already in DATABASE_URL")
+    data.add_argument("--users", type=int, default=5_000)
+    data.add_argument("--listings", type=int, default=1_000)
+    data.add_argument("--bookings", type=int, default=20_000)
+    data.add_argument("--messages", type=int, default=50_000)
+
+    server = parser.add_argument_group("gunicorn")
+    server.add_argument("--workers", type=int, default=2)
+    server.add_argument("--threads", type=int, default=16)
+
+    results = parser.add_argument_group("results")
+    results.add_argument("--output", help="save results as JSON here")
+    results.add_argument("--compare", help="JSON results to compare with")
+    results.add_argument("--threshold", type=float, default=0.1,
+                         help="allowed p95/throughput change (fraction)")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
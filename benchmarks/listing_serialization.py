@@ -0,0 +1,76 @@
+"""Rows/sec for turning listings into a JSON response body.
+
+Compares the old path (Listing instances, serialize() per row, Flask's
+jsonify) against column tuples, LISTING_JSON and orjson, over the same
+rows. Both include the query, so ORM hydration is part of the cost.
+
+    python -m benchmarks.listing_serialization --rows 100000
+"""
+
+import argparse
+import json
+
+from benchmarks.common import setup_env, timed
+
+
+def run(args):
+    setup_env()
+
+    from flask import jsonify
+
+    from app import app
+    from models import db, User, Listing, LISTING_JSON
+    from serializers import json_response
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User.signup("bench", "bench@email.com", "password",
+                           "Bench", "User")
+        db.session.commit()
+
+        db.session.execute(Listing.__table__.insert(), [
+            {"user_id": user.id,
+             "name": f"Listing {n}",
+             "price": f"{50 + n % 450}.{n % 100:02}",
+             "details": "a quiet backyard with room for a tent",
+             "photo": f"https://example.com/{n}.jpg"}
+            for n in range(args.rows)])
+        db.session.commit()
+
+        def before():
+            listings = Listing.query.order_by(Listing.id).all()
+            return jsonify(listings=[l.serialize() for l in listings])
+
+        def after():
+            rows = Listing.query.with_entities(*LISTING_JSON.columns)\
+                .order_by(Listing.id).all()
+            return json_response(listings=LISTING_JSON.many(rows))
+
+        results = {}
+        for name, fn in (("before", before), ("after", after)):
+            best = None
+            for _ in range(args.repeat):
+                db.session.expunge_all()
+                response, elapsed = timed(fn)
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = (best, response.get_data())
+
+    old, new = (json.loads(results[n][1]) for n in ("before", "after"))
+    assert old == new, "responses differ"
+
+    print(f"{args.rows} listings, best of {args.repeat}")
+    for name, (elapsed, body) in results.items():
+        print(f"  {name:6} {elapsed:.3f}s {args.rows / elapsed:,.0f} rows/s "
+              f"({len(body) / 1e6:.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Idle Server-Sent Event subscribers, then message delivery latency.
+
+Starts the stream server as deployed (gunicorn -c
+gunicorn_streams.conf.py, one gevent worker), opens --subscribers
+streams to GET /api/messages/stream as that many users, and lets them
+sit idle. Then one user messages random subscribers through the same
+server and we time from the POST to the event arriving on the
+recipient's socket. Reports the worker's memory and threads with the
+streams open. Linux only.
+
+    python -m benchmarks.message_stream --subscribers 5000 --messages 200
+"""
+
+import argparse
+import http.client
+import json
+import os
+import resource
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+from benchmarks.common import percentiles, setup_env
+from benchmarks.startup import children, memory
+
+
+def open_stream(port, token):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(f"GET /api/messages/stream HTTP/1.1\r\n"
+                 f"Host: localhost\r\n"
+                 f"Authorization: Bearer {token}\r\n\r\n".encode())
+    sock.setblocking(False)
+    return sock
+
+
+def threads(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                return int(line.split()[1])
+
+
+def start_server(port):
+    """Start the stream server; return (gunicorn process, worker pid)."""
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn_streams.conf.py",
+         "--workers", "1", "--bind", f"127.0.0.1:{port}",
+         "--log-level", "warning"])
+
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics")
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError("gunicorn did not start")
+            time.sleep(0.1)
+
+    return process, children(process.pid)[0]
+
+
+def run(args):
+    setup_env(BCRYPT_LOG_ROUNDS=4,
+              MESSAGE_BROKER="local",
+              STREAM_MAX_SUBSCRIBERS=args.subscribers + 10,
+              STREAM_KEEPALIVE=args.keepalive)
+
+    # a socket per stream here, and one in the server, which inherits this
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    from app import app, create_token
+    from models import db, User
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        sender = User.signup("sender", "sender@email.com", "password",
+                             "Send", "Er")
+        db.session.commit()
+        db.session.execute(User.__table__.insert(), [
+            {"username": f"sub{n}", "email": f"sub{n}@email.com",
+             "password": sender.password, "first_name": "Sub",
+             "last_name": str(n)}
+            for n in range(args.subscribers)])
+        db.session.commit()
+        users = User.query.filter(User.id != sender.id).all()
+        tokens = {u.id: create_token(u) for u in users}
+        sender_token = create_token(sender)
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server, worker = start_server(port)
+    try:
+        before = memory(worker)
+        selector = selectors.DefaultSelector()
+        sockets = {}
+        received = {}
+        start = time.perf_counter()
+        for user_id, token in tokens.items():
+            sock = open_stream(port, token)
+            sockets[user_id] = sock
+            received[user_id] = b""
+            selector.register(sock, selectors.EVENT_READ, user_id)
+
+        def drain(timeout):
+            """Read whatever arrived; return {user_id: received bytes}."""
+
+            arrived = {}
+            for key, _ in selector.select(timeout):
+                arrived[key.data] = key.fileobj.recv(65536)
+            return arrived
+
+        # each stream is open once its retry line is in
+        waiting = set(sockets)
+        deadline = time.perf_counter() + 60
+        while waiting and time.perf_counter() < deadline:
+            for user_id, data in drain(0.2).items():
+                received[user_id] += data
+                if b"retry: 5000" in received[user_id]:
+                    waiting.discard(user_id)
+        connect_time = time.perf_counter() - start
+        refused = sum(b" 503 " in data.split(b"\r\n", 1)[0]
+                      for data in received.values())
+
+        after = memory(worker)
+        print(f"{len(sockets) - len(waiting) - refused}/{len(sockets)} "
+              f"streams open in {connect_time:.2f}s "
+              f"({refused} refused, {len(waiting)} unanswered); worker "
+              f"{threads(worker)} threads, "
+              f"RSS +{after['rss_mb'] - before['rss_mb']:.0f} MB "
+              f"({after['rss_mb']:.0f} MB)")
+
+        time.sleep(args.idle)
+        drain(0)
+
+        client = http.client.HTTPConnection("127.0.0.1", port)
+        headers = {"Authorization": f"Bearer {sender_token}",
+                   "Content-Type": "application/json"}
+        latencies = []
+        for n in range(args.messages):
+            target = random.choice(list(sockets))
+            sent = time.perf_counter()
+            client.request("POST", f"/api/messages/{target}",
+                           json.dumps({"text": f"ping {n}"}), headers)
+            client.getresponse().read()
+            while True:
+                arrived = drain(5)
+                if not arrived:
+                    break
+                if b"event: message" in arrived.get(target, b""):
+                    latencies.append(time.perf_counter() - sent)
+                    break
+
+        print(f"{len(latencies)}/{args.messages} messages delivered, "
+              f"POST to event {percentiles(latencies)}")
+
+        for sock in sockets.values():
+            sock.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--idle", type=float, default=5,
+                        help="seconds to sit idle before sending")
+    parser.add_argument("--keepalive", type=float, default=15)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Cold start time and per-worker memory.
+
+Cold start: --runs fresh interpreters each import app and build it,
+reporting wall time, peak RSS and which of the heavy optional modules
+(Pillow, boto3, the debug toolbar, dotenv) got loaded on the way.
+
+Workers: starts gunicorn with --workers gthread workers, with and
+without --preload, makes one request so every worker has served, and
+reads each worker's RSS and PSS from /proc/<pid>/smaps_rollup. PSS
+splits pages shared with the master (and other workers) between them,
+so it shows what copy-on-write saves; RSS counts shared pages in full.
+Linux only.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --workers 4 --runs 10
+
+Uses a throwaway SQLite database unless DATABASE_URL is set.
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+from benchmarks.common import setup_env
+
+HEAVY_MODULES = ("PIL", "boto3", "botocore", "flask_debugtoolbar", "dotenv")
+
+COLD_START = f"""
+import json, resource, sys, time
+start = time.perf_counter()
+from app import app
+app.url_map
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules),
+    "heavy": [m for m in {HEAVY_MODULES!r} if m in sys.modules],
+}}))
+"""
+
+
+def cold_start(runs):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", COLD_START],
+                             check=True, capture_output=True, text=True)
+        samples.append(json.loads(out.stdout.splitlines()[-1]))
+
+    return {
+        "seconds": round(statistics.median(s["seconds"] for s in samples), 3),
+        "max_rss_mb": round(statistics.median(s["max_rss_mb"]
+                                              for s in samples), 1),
+        "modules": samples[-1]["modules"],
+        "heavy": samples[-1]["heavy"],
+    }
+
+
+def memory(pid):
+    """{"rss_mb", "pss_mb"} for a process, from smaps_rollup."""
+
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if name in ("Rss", "Pss"):
+                fields[name.lower() + "_mb"] = round(int(rest.split()[0])
+                                                     / 1024, 1)
+    return fields
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def workers(app, count, preload):
+    """Start gunicorn; return memory for its master and each worker."""
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    command = [sys.executable, "-m", "gunicorn", app,
+               "--worker-class", "gthread", "--threads", "8",
+               "--workers", str(count),
+               "--bind", f"127.0.0.1:{port}",
+               "--log-level", "warning"]
+    if preload:
+        command.append("--preload")
+
+    start = time.perf_counter()
+    # gunicorn.conf.py preloads unless told otherwise
+    env = dict(os.environ, GUNICORN_PRELOAD="1" if preload else "0")
+    process = subprocess.Popen(command, env=env)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics")
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.1)
+        ready = time.perf_counter() - start
+
+        # the master forks workers one at a time; wait for all of them
+        while len(children(process.pid)) < count:
+            time.sleep(0.1)
+        time.sleep(1)
+
+        # 404s load every route and error handler, without the database
+        for _ in range(count * 4):
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/nowhere")
+            except OSError:
+                pass
+
+        worker_memory = [memory(pid) for pid in children(process.pid)]
+        return {
+            "ready_seconds": round(ready, 2),
+            "master": memory(process.pid),
+            "worker_rss_mb": round(statistics.mean(
+                w["rss_mb"] for w in worker_memory), 1),
+            "worker_pss_mb": round(statistics.mean(
+                w["pss_mb"] for w in worker_memory), 1),
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", default="app:app",
+                        help="gunicorn app to load (default app:app)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=5,
+                        help="cold starts to take the median of")
+    parser.add_argument("--output", help="also save results as JSON here")
+    args = parser.parse_args()
+
+    setup_env(STORAGE_BACKEND="local")
+
+    from app import app
+    from models import db
+
+    with app.app_context():
+        db.create_all()
+
+    results = {
+        "cold_start": cold_start(args.runs),
+        "gunicorn": {
+            "no_preload": workers(args.app, args.workers, preload=False),
+            "preload": workers(args.app, args.workers, preload=True),
+        },
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
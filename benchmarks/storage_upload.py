@@ -0,0 +1,70 @@
+"""Per-upload cost of the storage layer, offline.
+
+Compares what Listing.upload_file used to pay on every call (a new boto3
+client, after saving the photo to a temp file) against the pooled client
+and streaming put() of storage.py, using the local backend for the
+actual bytes.
+
+    python -m benchmarks.storage_upload --uploads 50 --size-kb 2048
+"""
+
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.common import percentiles
+
+
+def run(args):
+    import boto3
+
+    from storage import LocalStorage, S3Storage
+
+    payload = os.urandom(args.size_kb * 1024)
+    root = tempfile.mkdtemp(prefix="sharebnb-storage-")
+    backend = LocalStorage(os.path.join(root, "bucket"))
+    staging = os.path.join(root, "staging")
+    os.makedirs(staging)
+
+    # before: temp file + fresh client per upload
+    before = []
+    for n in range(args.uploads):
+        start = time.perf_counter()
+        path = os.path.join(staging, f"{n}.jpg")
+        with open(path, "wb") as f:
+            f.write(payload)
+        boto3.client('s3', aws_access_key_id="bench",
+                     aws_secret_access_key="bench", region_name="us-east-1")
+        with open(path, "rb") as f:
+            backend.put(f, f"before-{n}.jpg")
+        os.remove(path)
+        before.append(time.perf_counter() - start)
+
+    # after: one client per process, request stream straight to storage
+    s3 = S3Storage("bench", "bench", "bench")
+    after = []
+    for n in range(args.uploads):
+        start = time.perf_counter()
+        s3.client
+        backend.put(io.BytesIO(payload), f"after-{n}.jpg")
+        after.append(time.perf_counter() - start)
+
+    shutil.rmtree(root)
+
+    print(f"{args.uploads} uploads of {args.size_kb} KB")
+    for name, samples in (("before", before), ("after", after)):
+        print(f"  {name:6} total={sum(samples):.3f}s {percentiles(samples)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--uploads", type=int, default=50)
+    parser.add_argument("--size-kb", type=int, default=2048)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Small in-process caches."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries expire after `ttl` seconds.
+
+    Holds at most `maxsize` entries; the least recently used is evicted
+    first. Each worker process has its own, so keep `ttl` short for
+    anything that can change.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if missing or expired."""
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            value, expires = item
+            if expires <= self.timer():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting the oldest entry if full."""
+
+        with self._lock:
+            self._data[key] = (value, self.timer() + self.ttl)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove `key` and return its value (or `default`)."""
+
+        with self._lock:
+            item = self._data.pop(key, None)
+
+        return default if item is None else item[0]
+
+    def clear(self):
+        """Remove every entry."""
+
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
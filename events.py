@@ -0,0 +1,299 @@
+"""Push delivery of new messages as Server-Sent Events.
+
+Message.send leaves each new message in the session's outbox. When the
+transaction commits, a broker carries it to the MessageHub of every app
+process, and the hub hands it to the open streams of the sender and the
+recipient (GET /api/messages/stream).
+
+- PostgresBroker sends a NOTIFY from inside the committing transaction,
+  so it goes out exactly when the message is committed, and keeps one
+  LISTEN connection per process.
+- LocalBroker publishes straight to this process's hub after commit.
+  Other processes never hear about it; that is enough for development,
+  tests and SQLite.
+
+An open stream holds no database connection, but it does hold its
+worker for as long as it is open: a thread in a gthread worker, a
+greenlet in a gevent one. STREAM_MAX_SUBSCRIBERS caps streams per
+process. In production, serve streams from the gevent stream server
+(gunicorn_streams.conf.py), which holds thousands each. The default
+cap of 16 is for the gthread server, where it must stay well below
+--threads (128) so ordinary requests still get threads.
+"""
+
+import logging
+import select
+import threading
+import time
+from collections import defaultdict, deque
+
+import orjson
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from models import db, MESSAGE_OUTBOX
+from serializers import dumps
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "sharebnb_messages"
+
+
+class HubFullError(Exception):
+    """This process already has as many open streams as it allows."""
+
+
+class Subscription:
+    """One open stream's queue of events for `user_id`.
+
+    Holds at most `maxlen` undelivered events; if the client falls that
+    far behind, the oldest are dropped (it can catch up with
+    GET /api/messages/<user_id>?after=<id>).
+    """
+
+    def __init__(self, user_id, maxlen=100):
+        self.user_id = user_id
+        self._events = deque(maxlen=maxlen)
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        with self._ready:
+            self._events.append(event)
+            self._ready.notify()
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds; return the queued events."""
+
+        with self._ready:
+            if not self._events:
+                self._ready.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+
+        return events
+
+
+class LocalBroker:
+    """Delivers new messages within this process only."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def before_commit(self, session, events):
+        pass
+
+    def after_commit(self, events):
+        for message in events:
+            self.hub.publish(message)
+
+
+class PostgresBroker:
+    """Delivers new messages to every process through LISTEN/NOTIFY.
+
+    The NOTIFY is part of the message's transaction, so it is sent on
+    commit and never for a rollback. Each process, this one included,
+    gets it back on its listener thread.
+    """
+
+    def __init__(self, hub, engine, retry=1):
+        self.hub = hub
+        self.engine = engine
+        self.retry = retry
+
+    def start(self):
+        threading.Thread(target=self._loop,
+                         name="message-listener",
+                         daemon=True).start()
+
+    def before_commit(self, session, events):
+        for message in events:
+            session.execute(
+                func.pg_notify(CHANNEL, dumps(message).decode()).select())
+
+    def after_commit(self, events):
+        pass
+
+    def _loop(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("message listener failed; reconnecting")
+                time.sleep(self.retry)
+
+    def _listen(self):
+        # a connection of its own, closed rather than pooled afterwards
+        raw = self.engine.raw_connection()
+
+        try:
+            connection = raw.connection
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+
+            while True:
+                if not select.select([connection], [], [], 60)[0]:
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    note = connection.notifies.pop(0)
+                    self.hub.publish(orjson.loads(note.payload))
+        finally:
+            raw.invalidate()
+
+
+class MessageHub:
+    """Fans new messages out to the open streams in this process.
+
+    The broker starts on the first request, so each gunicorn worker gets
+    its own listener after any fork. MESSAGE_BROKER picks it ("local" or
+    "postgres"); by default it follows the database.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.max_subscribers = 16
+        self.keepalive = 15
+        self.queue_size = 100
+        self._subscribers = defaultdict(set)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._broker = None
+        self._start_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read stream settings from config and hook up lazy start."""
+
+        self.app = app
+        self.max_subscribers = app.config.get('STREAM_MAX_SUBSCRIBERS', 16)
+        self.keepalive = app.config.get('STREAM_KEEPALIVE', 15)
+        self.queue_size = app.config.get('STREAM_QUEUE_SIZE', 100)
+
+        app.before_request(self.ensure_started)
+
+    @property
+    def broker(self):
+        """The broker for this process, made on first use."""
+
+        if self._broker is None:
+            with self._start_lock:
+                if self._broker is None:
+                    kind = self.app.config.get('MESSAGE_BROKER') or (
+                        "postgres" if db.engine.dialect.name == "postgresql"
+                        else "local")
+                    if kind == "postgres":
+                        broker = PostgresBroker(self, db.engine)
+                    else:
+                        broker = LocalBroker(self)
+                    broker.start()
+                    self._broker = broker
+
+        return self._broker
+
+    def ensure_started(self):
+        """Start listening for other processes' messages."""
+
+        self.broker
+
+    def check_room(self):
+        """Raise HubFullError if another stream wouldn't fit."""
+
+        if self._count >= self.max_subscribers:
+            raise HubFullError()
+
+    def subscribe(self, user_id):
+        """Open a Subscription to `user_id`'s new messages.
+
+        Raises HubFullError past STREAM_MAX_SUBSCRIBERS.
+        """
+
+        subscription = Subscription(user_id, self.queue_size)
+
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                raise HubFullError()
+            self._subscribers[user_id].add(subscription)
+            self._count += 1
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                self._count -= 1
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def publish(self, message):
+        """Queue a serialized message for both participants' streams."""
+
+        with self._lock:
+            targets = [*self._subscribers.get(message["toUserId"], ()),
+                       *self._subscribers.get(message["fromUserId"], ())]
+
+        for subscription in set(targets):
+            subscription.put(message)
+
+    def stream(self, user_id):
+        """Yield Server-Sent Events of `user_id`'s new messages until
+        disconnect.
+
+        The subscription opens when the first event is sent, not before:
+        a generator that is never started never runs its `finally`, so a
+        response dropped before it is sent (a HEAD, an error in an
+        after_request hook, a client gone already) would otherwise keep
+        its slot. If the hub filled up in the meantime, the stream ends
+        after telling the client when to retry.
+
+        A comment goes out every `keepalive` seconds while idle, so dead
+        connections are noticed and proxies don't time the stream out.
+        """
+
+        try:
+            subscription = self.subscribe(user_id)
+        except HubFullError:
+            yield "retry: 5000\n\n"
+            return
+
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                events = subscription.get(self.keepalive)
+                if not events:
+                    yield ": keepalive\n\n"
+                for message in events:
+                    yield (f"id: {message['id']}\n"
+                           f"event: message\n"
+                           f"data: {dumps(message).decode()}\n\n")
+        finally:
+            self.unsubscribe(subscription)
+
+    def __len__(self):
+        return self._count
+
+
+hub = MessageHub()
+
+
+@event.listens_for(Session, "before_commit")
+def _notify_new_messages(session):
+    events = session.info.get(MESSAGE_OUTBOX)
+    if events and hub.app is not None:
+        hub.broker.before_commit(session, events)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_new_messages(session):
+    events = session.info.pop(MESSAGE_OUTBOX, None)
+    if events and hub.app is not None:
+        hub.broker.after_commit(events)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_new_messages(session):
+    session.info.pop(MESSAGE_OUTBOX, None)
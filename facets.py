@@ -0,0 +1,131 @@
+"""Listing counts and price histograms for the browse page's filters.
+
+A PriceFacets holds how many listings there are at each distinct price,
+as sorted arrays of prices (in cents) and running totals, so counting
+the listings in a price range is two binary searches however many
+listings there are:
+
+    facets = PriceFacets(Listing.price_counts())
+    facets.count(min_price=Decimal("50"), max_price=Decimal("150"))
+    facets.histogram(10)
+
+`price_facets` keeps the PriceFacets for all listings in each process,
+built once per listings version (CacheVersion.LISTINGS), so most
+requests cost only the version lookup they make anyway.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from decimal import ROUND_CEILING, ROUND_FLOOR, Decimal
+
+
+class PriceFacets:
+    """Listing counts by price; see the module docstring."""
+
+    def __init__(self, price_counts):
+        """Build from (price, count) pairs in price order."""
+
+        self.cents = array("q")
+        # totals[i] is the number of listings priced at or below cents[i]
+        self.totals = array("q")
+
+        total = 0
+        for price, count in price_counts:
+            total += count
+            self.cents.append(_cents(price, ROUND_FLOOR))
+            self.totals.append(total)
+
+    @property
+    def min_price(self):
+        return _price(self.cents[0]) if self.cents else None
+
+    @property
+    def max_price(self):
+        return _price(self.cents[-1]) if self.cents else None
+
+    def count(self, min_price=None, max_price=None):
+        """Return the number of listings priced within the range
+        (inclusive); a bound of None leaves that end open."""
+
+        start = (0 if min_price is None else
+                 bisect_left(self.cents, _cents(min_price, ROUND_CEILING)))
+        end = (len(self.cents) if max_price is None else
+               bisect_right(self.cents, _cents(max_price, ROUND_FLOOR)))
+
+        return max(self._up_to(end) - self._up_to(start), 0)
+
+    def histogram(self, buckets):
+        """Split the lowest to highest price into at most `buckets`
+        ranges of equal width, to the cent; the last ends at the
+        highest price.
+
+        Returns [{min, max, count}] in price order; both ends of each
+        range are included, and every listing is in exactly one.
+        """
+
+        if not self.cents:
+            return []
+
+        low, high = self.cents[0], self.cents[-1]
+        width = max(-(-(high - low) // buckets), 1)
+        count = max(-(-(high - low) // width), 1)
+
+        result = []
+        start = 0
+        for i in range(count):
+            bucket_low = low + i * width
+            bucket_high = high if i == count - 1 else bucket_low + width - 1
+            end = bisect_right(self.cents, bucket_high, start)
+            result.append({
+                "min": _price(bucket_low),
+                "max": _price(bucket_high),
+                "count": self._up_to(end) - self._up_to(start),
+            })
+            start = end
+
+        return result
+
+    def _up_to(self, index):
+        """Listings at the first `index` distinct prices."""
+
+        return self.totals[index - 1] if index else 0
+
+
+class PriceFacetCache:
+    """The PriceFacets for all listings, for the newest version seen.
+
+    Each worker process keeps its own. Requests that race to rebuild it
+    each build their own copy, and an older version (say, read from a
+    lagging replica) never replaces a newer one.
+    """
+
+    def __init__(self):
+        self._cached = None
+
+    def get(self, version, load):
+        """Return the PriceFacets for `version`, calling `load()` for
+        its (price, count) pairs if it isn't cached."""
+
+        cached = self._cached
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        facets = PriceFacets(load())
+        if cached is None or version > cached[0]:
+            self._cached = (version, facets)
+
+        return facets
+
+    def clear(self):
+        self._cached = None
+
+
+def _cents(price, rounding):
+    return int((Decimal(price) * 100).to_integral_value(rounding))
+
+
+def _price(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+price_facets = PriceFacetCache()
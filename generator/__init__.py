@@ -0,0 +1,333 @@
+"""Synthetic ShareBnB data at any scale, as CSV.
+
+The CSVs beside this file are the small hand-written sample seed.py
+loads. Dataset makes the same tables at any size, for load testing:
+
+    python -m generator out/ --users 1000000 --listings 200000 \\
+        --bookings 5000000 --messages 10000000 --workers 8
+
+Rows are referentially consistent: every listing's host, booking's guest
+and message's sender is a generated user, and messages run between
+guests and the hosts of the listings they ask about. Popularity is
+skewed, as in production: a few hosts own many listings, and a few
+listings get most of the bookings and messages. A listing's bookings
+never overlap (stays are half-open, like bookings_no_overlap).
+
+Output is a directory per table of numbered chunk files, each a complete
+CSV with a header, written in parallel by a process pool. A chunk is
+generated row by row straight to disk, so memory stays flat at any
+scale. Nothing is shared between chunks: hosts and popularity are pure
+functions of ids, and every block of BLOCK ids has its own random
+stream, so the output depends only on the seed and the table sizes, not
+on --workers or --chunk-size. A finished chunk is renamed into place, so
+an interrupted run picks up where it stopped.
+"""
+
+import csv
+import json
+import math
+import os
+import random
+from datetime import datetime, timedelta
+from math import gcd
+from multiprocessing import Pool
+
+# Ids per random stream; chunks are whole numbers of blocks
+BLOCK = 1000
+
+# Every user's password is "password" (bcrypt, 12 rounds)
+PASSWORD = "password"
+PASSWORD_HASH = "$2b$12$Yi6oK1LOU2ZBmXEcfwoEu.PjbMdWqLet8SmNvM11BubYLhS/VII5G"
+
+# Bookings and messages fall within HORIZON_DAYS from START
+START = datetime(2022, 1, 1)
+HORIZON_DAYS = 730
+
+# rank = n * random() ** SKEW; higher is more skewed towards rank 0
+HOST_SKEW = 3
+LISTING_SKEW = 2.5
+
+COLUMNS = {
+    "users": ("id", "email", "username", "password",
+              "first_name", "last_name"),
+    "listings": ("id", "user_id", "name", "photo", "price", "details"),
+    "bookings": ("user_id", "listing_id", "checkin_date", "checkout_date",
+                 "booking_date"),
+    "messages": ("to_user_id", "from_user_id", "conversation_key", "text",
+                 "timestamp"),
+}
+
+# In load order: each table only refers to those before it
+TABLES = tuple(COLUMNS)
+
+FIRST_NAMES = (
+    "Ada", "Andrew", "Beatriz", "Chen", "Dana", "Emeka", "Fatima", "Grace",
+    "Hiro", "Ines", "Jamal", "Kai", "Lena", "Mateo", "Nadia", "Omar",
+    "Priya", "Quinn", "Rosa", "Sam", "Tomas", "Uma", "Vera", "Wei",
+)
+LAST_NAMES = (
+    "Okafor", "Jensen", "Silva", "Nguyen", "Haddad", "Kowalski", "Moreno",
+    "Tanaka", "Schmidt", "Ivanova", "Park", "Dubois", "Rossi", "Cohen",
+    "Mensah", "Larsen", "Patel", "Garcia", "Novak", "Kim",
+)
+ADJECTIVES = (
+    "Sunny", "Quiet", "Rustic", "Shady", "Secret", "Breezy", "Cozy",
+    "Wild", "Hidden", "Golden", "Restored", "Lush", "Tiny", "Grand",
+)
+PLACES = (
+    "Backyard", "Garden", "Meadow", "Orchard", "Patio", "Courtyard",
+    "Treehouse", "Lawn", "Farm", "Hideaway", "Lodge", "Oasis", "Grove",
+)
+FEATURES = (
+    "fire pit", "hammock", "pool", "hot tub", "vegetable garden",
+    "pizza oven", "fountain", "shade trees", "string lights", "treehouse",
+)
+PHRASES = (
+    "hi! is this still available?", "what dates are open next month?",
+    "can we bring a dog?", "sounds great, thanks", "is parking nearby?",
+    "yes, those dates work", "we'll arrive around noon",
+    "the gate code is in your booking", "thanks for having us!",
+    "how many people fit?", "sorry, that weekend is taken",
+)
+PHOTOS = 26
+
+
+def conversation_key(a, b):
+    """The same key as models.conversation_key, without importing it."""
+
+    low, high = sorted((a, b))
+    return (low << 32) | high
+
+
+class Permutation:
+    """A cheap, fixed shuffle of 1..n: rank -> id and back.
+
+    Keeps popular hosts and listings spread across the id range rather
+    than all on the first pages.
+    """
+
+    def __init__(self, n):
+        self.n = max(n, 1)
+        stride = 2654435761 % self.n or 1
+        while gcd(stride, self.n) != 1:
+            stride += 1
+        self.stride = stride
+        self.inverse = pow(stride, -1, self.n) if self.n > 1 else 0
+
+    def id(self, rank):
+        return 1 + (rank * self.stride) % self.n
+
+    def rank(self, id):
+        return ((id - 1) * self.inverse) % self.n
+
+
+def unit(seed, n):
+    """A float in [0, 1) fixed by (seed, n); splitmix64."""
+
+    z = (seed * 0x9E3779B97F4A7C15 + n) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return ((z ^ (z >> 31)) >> 11) / (1 << 53)
+
+
+class Dataset:
+    """Table sizes and a seed; generates any block of any table.
+
+    `bookings` is a target: each listing gets about its share, by
+    popularity, as far as its calendar has room.
+    """
+
+    def __init__(self, users, listings, bookings, messages, seed=0):
+        self.users = users
+        self.listings = listings
+        self.bookings = bookings
+        self.messages = messages
+        self.seed = seed
+        self._hosts = Permutation(users)
+        self._popular = Permutation(listings)
+
+    def size(self, table):
+        """Ids (users, listings) or units (bookings: listings) to cover."""
+
+        return {"users": self.users,
+                "listings": self.listings,
+                "bookings": self.listings,
+                "messages": self.messages}[table]
+
+    def rows(self, table, start, stop):
+        """Yield rows of `table` for units start..stop-1 (block aligned)."""
+
+        for block in range(start // BLOCK, math.ceil(stop / BLOCK)):
+            rng = random.Random(f"{self.seed}:{table}:{block}")
+            first = block * BLOCK
+            last = min(first + BLOCK, self.size(table))
+            yield from getattr(self, f"_{table}")(rng, first, last)
+
+    def host(self, listing_id):
+        """The user who owns `listing_id`."""
+
+        u = unit(self.seed, listing_id)
+        return self._hosts.id(int(self.users * u ** HOST_SKEW))
+
+    def popular_listing(self, rng):
+        """A listing id, favouring popular listings."""
+
+        return self._popular.id(int(self.listings * rng.random() ** LISTING_SKEW))
+
+    def expected_bookings(self, listing_id):
+        """`listing_id`'s share of the bookings, by popularity rank.
+
+        Ranks are drawn as n * u ** s, whose density at rank r is
+        proportional to (r / n) ** (1/s - 1).
+        """
+
+        n = self.listings
+        share = (self._popular.rank(listing_id) + 0.5) / n
+        density = share ** (1 / LISTING_SKEW - 1) / LISTING_SKEW
+        return self.bookings / n * density
+
+    def _users(self, rng, first, last):
+        for n in range(first, last):
+            id = n + 1
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = rng.choice(LAST_NAMES)
+            username = f"{first_name}{last_name}{id}".lower()
+            yield (id, f"{username}@example.com", username, PASSWORD_HASH,
+                   first_name, last_name)
+
+    def _listings(self, rng, first, last):
+        for n in range(first, last):
+            id = n + 1
+            price = max(10, round(rng.lognormvariate(4.8, 0.6)))
+            yield (id, self.host(id),
+                   f"{rng.choice(ADJECTIVES)} {rng.choice(PLACES)}",
+                   f"https://share-bnb-rh.s3.amazonaws.com/"
+                   f"{rng.randrange(PHOTOS) + 1}.jpg",
+                   price,
+                   f"{rng.choice(ADJECTIVES).lower()}, with a "
+                   f"{rng.choice(FEATURES)}")
+
+    def _bookings(self, rng, first, last):
+        for n in range(first, last):
+            listing_id = n + 1
+            host = self.host(listing_id)
+
+            expected = self.expected_bookings(listing_id)
+            count = int(expected) + (rng.random() < expected % 1)
+            if not count:
+                continue
+
+            # spread `count` stays of ~4 nights over the horizon
+            gap = max(0.0, HORIZON_DAYS / count - 4)
+            day = int(rng.expovariate(1 / gap)) if gap else 0
+
+            for _ in range(count):
+                nights = min(1 + int(rng.expovariate(1 / 3)), 28)
+                if day + nights > HORIZON_DAYS:
+                    break
+
+                guest = rng.randrange(self.users) + 1
+                if guest == host and self.users > 1:
+                    guest = guest % self.users + 1
+
+                checkin = START + timedelta(days=day)
+                lead = int(rng.expovariate(1 / 30))
+                yield (guest, listing_id,
+                       checkin.date().isoformat(),
+                       (checkin + timedelta(days=nights)).date().isoformat(),
+                       (checkin - timedelta(days=lead)).date().isoformat())
+
+                day += nights + (int(rng.expovariate(1 / gap)) if gap else 0)
+
+    def _messages(self, rng, first, last):
+        left = last - first
+        while left > 0:
+            guest = rng.randrange(self.users) + 1
+            host = self.host(self.popular_listing(rng))
+            if guest == host:
+                continue
+
+            key = conversation_key(guest, host)
+            sent = START + timedelta(seconds=rng.randrange(HORIZON_DAYS * 86400))
+            sender, recipient = guest, host
+
+            for _ in range(min(left, 1 + int(rng.expovariate(1 / 4)))):
+                yield (recipient, sender, key, rng.choice(PHRASES),
+                       sent.isoformat(sep=" "))
+                left -= 1
+                sent += timedelta(minutes=1 + int(rng.expovariate(1 / 90)))
+                if rng.random() < 0.8:
+                    sender, recipient = recipient, sender
+
+    def chunks(self, chunk_size):
+        """Yield (table, index, start, stop) covering every table."""
+
+        per_chunk = max(BLOCK, chunk_size // BLOCK * BLOCK)
+        for table in TABLES:
+            units = per_chunk
+            if table == "bookings" and self.bookings:
+                # chunks of listings holding about chunk_size bookings
+                units = max(BLOCK, per_chunk * self.listings
+                            // self.bookings // BLOCK * BLOCK)
+            size = self.size(table)
+            for index, start in enumerate(range(0, size, units)):
+                yield table, index, start, min(start + units, size)
+
+    def manifest(self):
+        return {"seed": self.seed, "users": self.users,
+                "listings": self.listings, "bookings": self.bookings,
+                "messages": self.messages}
+
+
+def write_chunk(dataset, out, table, index, start, stop):
+    """Write one chunk file unless it exists; return (table, rows)."""
+
+    path = os.path.join(out, table, f"{index:05d}.csv")
+    if os.path.exists(path):
+        return table, None
+
+    rows = 0
+    partial = f"{path}.partial"
+    with open(partial, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS[table])
+        for row in dataset.rows(table, start, stop):
+            writer.writerow(row)
+            rows += 1
+
+    os.replace(partial, path)
+    return table, rows
+
+
+def _write_chunk(args):
+    return write_chunk(*args)
+
+
+def generate(dataset, out, chunk_size=100_000, workers=None, log=print):
+    """Write every table of `dataset` under `out`; return rows per table.
+
+    Chunks already on disk from an earlier run with the same dataset are
+    kept and not counted.
+    """
+
+    manifest = os.path.join(out, "manifest.json")
+    if os.path.exists(manifest):
+        with open(manifest) as file:
+            if json.load(file) != dataset.manifest():
+                raise ValueError(f"{out} holds a different dataset")
+
+    for table in TABLES:
+        os.makedirs(os.path.join(out, table), exist_ok=True)
+    with open(manifest, "w") as file:
+        json.dump(dataset.manifest(), file)
+
+    tasks = [(dataset, out, *chunk) for chunk in dataset.chunks(chunk_size)]
+    totals = dict.fromkeys(TABLES, 0)
+
+    with Pool(workers) as pool:
+        for table, rows in pool.imap_unordered(_write_chunk, tasks):
+            if rows is not None:
+                totals[table] += rows
+                log(f"{table}: {totals[table]:,} rows")
+
+    return totals
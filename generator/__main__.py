@@ -0,0 +1,41 @@
+"""Command line for the generator; see generator/__init__.py."""
+
+import argparse
+import time
+
+from generator import Dataset, generate
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m generator",
+        description="Write synthetic ShareBnB tables as chunked CSV.")
+    parser.add_argument("out", help="directory to write into")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--listings", type=int, default=2_000)
+    parser.add_argument("--bookings", type=int, default=50_000,
+                        help="about this many; calendars may fill first")
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=100_000,
+                        help="rows per chunk file")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    if args.users < 2 or args.listings < 1:
+        parser.error("need at least 2 users and 1 listing")
+
+    dataset = Dataset(args.users, args.listings, args.bookings,
+                      args.messages, seed=args.seed)
+
+    start = time.perf_counter()
+    totals = generate(dataset, args.out, args.chunk_size, args.workers)
+    elapsed = time.perf_counter() - start
+
+    rows = sum(totals.values())
+    print(f"{rows:,} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""gunicorn settings; gunicorn reads this file from the working directory.
+
+The app is built once in the master and forked (preload_app), so
+workers share its code and data pages copy-on-write instead of each
+importing everything again. Building it opens no database connection,
+and models.py makes a worker discard any pooled connection it inherits.
+GUNICORN_PRELOAD=0 builds the app in each worker instead.
+
+Message streams are served by gunicorn_streams.conf.py; here each would
+hold one of the threads.
+"""
+
+import gc
+import os
+
+wsgi_app = "app:create_app()"
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 128))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+
+def when_ready(server):
+    # Move everything the master allocated out of the collector's reach:
+    # collections write to every tracked object's header, which would
+    # copy the shared pages into each worker.
+    gc.freeze()
@@ -0,0 +1,32 @@
+"""gunicorn settings for the message stream server:
+
+    gunicorn -c gunicorn_streams.conf.py
+
+Route GET /api/messages/stream here and everything else to the main
+server (gunicorn.conf.py). A gthread worker spends a thread on each
+open stream, so it can only hold a few; these gevent workers hold each
+one in a greenlet instead, thousands per process. The rest of the app
+doesn't belong here: password hashing and image work are CPU bound and
+would stall every stream in the worker.
+
+Each worker holds up to STREAM_MAX_SUBSCRIBERS streams (default 10000),
+plus a little headroom to answer the rest with a 503. That many sockets
+needs `ulimit -n` above it. The app is built in each worker, after
+gevent has patched the standard library, never in the master.
+"""
+
+import os
+
+wsgi_app = "app:create_app()"
+worker_class = "gevent"
+preload_app = False
+
+os.environ.setdefault("STREAM_MAX_SUBSCRIBERS", "10000")
+worker_connections = int(os.environ["STREAM_MAX_SUBSCRIBERS"]) + 100
+
+
+def post_worker_init(worker):
+    # psycopg2 waits in C, where gevent can't switch away; make it wait
+    # on gevent's select so a query doesn't stall the worker's streams
+    from psycopg2 import extensions, extras
+    extensions.set_wait_callback(extras.wait_select)
@@ -0,0 +1,94 @@
+"""Password hashing on a small, bounded worker pool.
+
+bcrypt is deliberately slow. Running it on a fixed number of threads
+(bcrypt releases the GIL) caps how much CPU a burst of logins can take
+from everything else, and a cap on queued requests turns overload into a
+fast 503 rather than a pile-up of workers stuck behind the hash queue.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_DEPTH = 16
+DEFAULT_LOG_ROUNDS = 12  # Flask-Bcrypt's
+
+
+class HashingOverloadedError(Exception):
+    """Too many password hashes are already queued."""
+
+
+class PasswordHasher:
+    """Runs Flask-Bcrypt hashing and checking on a bounded thread pool.
+
+    `max_workers` hashes run at once and at most `max_pending` (running
+    or waiting) are accepted; past that, calls raise
+    HashingOverloadedError. With max_workers=0 hashing runs inline on the
+    calling thread, unbounded, as it used to.
+    """
+
+    def __init__(self, bcrypt, max_workers=DEFAULT_WORKERS,
+                 max_pending=DEFAULT_QUEUE_DEPTH):
+        self.bcrypt = bcrypt
+        self.log_rounds = DEFAULT_LOG_ROUNDS
+        self._executor = None
+        self.configure(max_workers, max_pending)
+
+    def init_app(self, app):
+        """Size the pool from HASH_WORKERS / HASH_QUEUE_DEPTH config and
+        read the work factor (BCRYPT_LOG_ROUNDS), as Flask-Bcrypt does."""
+
+        self.log_rounds = app.config.get('BCRYPT_LOG_ROUNDS',
+                                         DEFAULT_LOG_ROUNDS)
+        self.configure(app.config.get('HASH_WORKERS', DEFAULT_WORKERS),
+                       app.config.get('HASH_QUEUE_DEPTH', DEFAULT_QUEUE_DEPTH))
+
+    def configure(self, max_workers, max_pending):
+        """(Re)build the pool. Not safe while hashes are in flight."""
+
+        if self._executor is not None:
+            # its threads exit once idle, rather than living on unused
+            self._executor.shutdown(wait=False)
+
+        self.max_workers = int(max_workers)
+        self.max_pending = max(int(max_pending), self.max_workers)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = (ThreadPoolExecutor(self.max_workers,
+                                             thread_name_prefix="bcrypt")
+                          if self.max_workers else None)
+
+    def _run(self, fn, *args):
+        """Run fn(*args) on the pool and wait for its result."""
+
+        if self._executor is None:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloadedError()
+
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(self.bcrypt.generate_password_hash,
+                         password).decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        """Return True if `password` matches `pw_hash`."""
+
+        return self._run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """True if `pw_hash` was made with a different work factor."""
+
+        # bcrypt hashes look like $2b$12$<salt+hash>
+        try:
+            rounds = int(pw_hash.split("$")[2])
+        except (IndexError, ValueError):
+            return True
+
+        return rounds != self.log_rounds
@@ -0,0 +1,48 @@
+"""Validators and conditional GETs for public, cacheable responses.
+
+Routes check a cheap validator (a version counter) with `not_modified`
+before doing any real work, and mark the full response with
+`cache_publicly`. Anything not marked keeps the `no-store` default set in
+app.add_header.
+"""
+
+from flask import current_app, make_response, request
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts):
+    """Return an ETag value built from the parts of a resource version."""
+
+    return "-".join(str(p) for p in parts)
+
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 response if the client's copy is current, else None.
+
+    If-None-Match wins over If-Modified-Since when both are sent.
+    """
+
+    if is_resource_modified(request.environ,
+                            etag=etag,
+                            last_modified=last_modified):
+        return None
+
+    return cache_publicly(make_response("", 304), etag, last_modified)
+
+
+def cache_publicly(response, etag, last_modified=None):
+    """Let shared caches keep `response` and revalidate it by `etag`.
+
+    Cached copies are fresh for PUBLIC_CACHE_MAX_AGE seconds; after that
+    clients revalidate and get a 304 if nothing has changed.
+    """
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get(
+        'PUBLIC_CACHE_MAX_AGE', 60)
+
+    return response
@@ -0,0 +1,136 @@
+"""Resized variants of listing photos.
+
+Each uploaded photo is decoded once and re-encoded at a few widths, as
+JPEG and WebP, so clients can fetch the smallest image that fits. The
+CPU-heavy part runs in a process pool. Variants are stored under the
+SHA-256 of the original bytes, so the same photo uploaded twice is only
+processed once.
+"""
+
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as RenderTimeout
+
+# variant name -> longest edge in pixels, largest first
+VARIANTS = {"full": 1600, "card": 640, "thumb": 320}
+
+# format -> (Pillow format, file extension, content type, save options)
+FORMATS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg",
+             {"quality": 82, "optimize": True, "progressive": True}),
+    "webp": ("WEBP", "webp", "image/webp", {"quality": 80, "method": 4}),
+}
+
+
+def variant_key(digest, variant, fmt):
+    """Storage key of one variant of the photo with this digest."""
+
+    return f"photos/{digest}/{variant}.{FORMATS[fmt][1]}"
+
+
+def render_variants(data):
+    """Decode image bytes once; return {(variant, format): bytes}.
+
+    Runs in a worker process, so it only touches Pillow. Pillow is
+    imported here so web workers that never resize a photo don't load it.
+    """
+
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+
+    rendered = {}
+    for variant, edge in VARIANTS.items():
+        # each size is scaled down from the previous, larger one
+        image.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+        for fmt, (pil_format, _, _, options) in FORMATS.items():
+            out = io.BytesIO()
+            image.save(out, pil_format, **options)
+            rendered[(variant, fmt)] = out.getvalue()
+
+    return rendered
+
+
+class ImageProcessor:
+    """Makes and stores photo variants using a per-process pool.
+
+    IMAGE_WORKERS sets the pool size. Pool processes are spawned rather
+    than forked, since the app process has other threads running. A
+    render taking longer than IMAGE_RENDER_TIMEOUT seconds (default 60)
+    raises RenderTimeout, and its pool is killed and replaced.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.workers = 1
+        self.timeout = 60
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.workers = app.config.get('IMAGE_WORKERS', 1)
+        self.timeout = app.config.get('IMAGE_RENDER_TIMEOUT', 60)
+
+    @property
+    def pool(self):
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(
+                        self.workers,
+                        mp_context=multiprocessing.get_context("spawn"))
+                    self._pid = os.getpid()
+
+        return self._pool
+
+    def urls(self, digest):
+        """{variant: {format: url}} for the photo with this digest."""
+
+        return {variant: {fmt: self.storage.url(variant_key(digest, variant,
+                                                            fmt))
+                          for fmt in FORMATS}
+                for variant in VARIANTS}
+
+    def process(self, data):
+        """Make and store variants of the photo `data`; return URLs.
+
+        Skips the work if variants of identical bytes already exist.
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        smallest = variant_key(digest, list(VARIANTS)[-1], list(FORMATS)[-1])
+
+        # the smallest variant is written last, so if it exists, all do
+        if not self.storage.exists(smallest):
+            pool = self.pool
+            future = pool.submit(render_variants, data)
+            try:
+                rendered = future.result(timeout=self.timeout)
+            except RenderTimeout:
+                self._discard(pool)
+                raise
+            for (variant, fmt), body in rendered.items():
+                self.storage.put(io.BytesIO(body),
+                                 variant_key(digest, variant, fmt),
+                                 content_type=FORMATS[fmt][2])
+
+        return self.urls(digest)
+
+    def _discard(self, pool):
+        """Kill `pool`; the next render starts a new one."""
+
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+
+        # the executor can't stop a task once it runs, so end the
+        # processes; renders queued on them fail with BrokenProcessPool
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,428 @@
+"""Bulk load CSV data into the database.
+
+    python -m loader generator/              # the sample CSVs
+    python -m loader out/ --replace          # python -m generator output
+
+A directory holds <table>.csv files, or <table>/ directories of chunk
+files as the generator writes them. Columns come from each file's
+header; messages.conversation_key is filled in when it is missing.
+
+- Rows stream from the CSV in batches: COPY FROM STDIN on Postgres,
+  executemany on SQLite. Memory stays flat however big the files are.
+- Each file loads in one transaction, recorded in loaded_files, so a
+  rerun skips the files already loaded and resumes where it stopped.
+- A table starts loading as soon as the tables it references are done,
+  so independent tables (listings and messages, say) load at once, each
+  on its own connection. SQLite has one writer, so it goes one by one.
+- Indexes (other than primary keys and unique constraints) of a table
+  that starts out empty are dropped first and built once at the end,
+  which is much faster than maintaining them row by row. Dropped
+  definitions wait in deferred_indexes until rebuilt, so an interrupted
+  load rebuilds them when rerun.
+- Loads add to what is there unless --replace, which first empties the
+  tables being loaded and everything that references them.
+
+Afterwards id sequences are moved past the loaded ids, the listings
+cache version is bumped, conversation summaries are rebuilt (with
+unread counts at zero, as Conversation.rebuild does) and so are listing
+calendars.
+"""
+
+import argparse
+import csv
+import io
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from models import (
+    db, CacheVersion, Conversation, ListingCalendar, conversation_key)
+
+DEFAULT_BATCH_SIZE = 10_000
+
+# Seconds between progress lines while a table loads
+PROGRESS_INTERVAL = 5
+
+metadata = sa.MetaData()
+
+loaded_files = sa.Table(
+    "loaded_files", metadata,
+    sa.Column("path", sa.Text, primary_key=True),
+    sa.Column("table_name", sa.Text, nullable=False),
+    sa.Column("rows", sa.Integer, nullable=False),
+    sa.Column("loaded_at", sa.DateTime, nullable=False),
+)
+
+deferred_indexes = sa.Table(
+    "deferred_indexes", metadata,
+    sa.Column("name", sa.Text, primary_key=True),
+    sa.Column("table_name", sa.Text, nullable=False),
+    sa.Column("definition", sa.Text, nullable=False),
+)
+
+# Indexes a bulk load may drop and rebuild: not backing a constraint
+POSTGRES_INDEXES = """
+SELECT i.relname AS name, pg_get_indexdef(i.oid) AS definition
+FROM pg_index x
+JOIN pg_class i ON i.oid = x.indexrelid
+WHERE x.indrelid = CAST(:table AS regclass)
+  AND NOT x.indisprimary AND NOT x.indisunique
+  AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                  WHERE c.conindid = x.indexrelid)
+"""
+
+SQLITE_INDEXES = """
+SELECT name, sql AS definition FROM sqlite_master
+WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL
+  AND sql NOT LIKE 'CREATE UNIQUE%'
+"""
+
+
+def _message_key(row):
+    return conversation_key(int(row["to_user_id"]), int(row["from_user_id"]))
+
+
+# {table: {column: fn(row dict)}} for columns a CSV may leave out
+DERIVED = {
+    "messages": {"conversation_key": _message_key},
+}
+
+
+def sources(directory):
+    """Return {table: [csv paths]} for the model tables in `directory`."""
+
+    found = {}
+    for table in db.metadata.tables:
+        single = os.path.join(directory, f"{table}.csv")
+        chunks = os.path.join(directory, table)
+        if os.path.isfile(single):
+            found[table] = [single]
+        elif os.path.isdir(chunks):
+            found[table] = sorted(
+                os.path.join(chunks, name) for name in os.listdir(chunks)
+                if name.endswith(".csv"))
+
+    return found
+
+
+class Progress:
+    """Rows loaded per table and overall, logged every few seconds."""
+
+    def __init__(self, log):
+        self.log = log
+        self.start = time.perf_counter()
+        self.rows = {}
+        self._started = {}
+        self._logged = {}
+        self._lock = threading.Lock()
+
+    def begin(self, table):
+        with self._lock:
+            self.rows[table] = 0
+            self._started[table] = self._logged[table] = time.perf_counter()
+
+    def add(self, table, rows, force=False):
+        with self._lock:
+            self.rows[table] += rows
+            now = time.perf_counter()
+            if not force and now - self._logged[table] < PROGRESS_INTERVAL:
+                return
+            self._logged[table] = now
+            elapsed = now - self._started[table]
+            total = self.rows[table]
+
+        self.log(f"{table}: {total:,} rows "
+                 f"({total / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    def summary(self):
+        total = sum(self.rows.values())
+        elapsed = time.perf_counter() - self.start
+        return (f"{total:,} rows in {elapsed:.1f}s "
+                f"({total / max(elapsed, 1e-9):,.0f} rows/s)")
+
+
+class BulkLoader:
+    """Loads a directory of CSV files into the models' tables.
+
+    `defer_indexes` is True to always drop and rebuild indexes around a
+    table's load, False never to, or None (default) for tables that are
+    empty when the load starts.
+    """
+
+    def __init__(self, engine, batch_size=DEFAULT_BATCH_SIZE, workers=4,
+                 defer_indexes=None, log=print):
+        self.engine = engine
+        self.postgres = engine.dialect.name == "postgresql"
+        self.batch_size = batch_size
+        self.workers = workers if self.postgres else 1
+        self.defer_indexes = defer_indexes
+        self.log = log
+
+    def load(self, directory, replace=False):
+        """Load every table found in `directory`; return rows per table."""
+
+        found = sources(directory)
+        metadata.create_all(self.engine)
+
+        if replace:
+            self._empty(found)
+
+        progress = Progress(self.log)
+        self._in_dependency_order(
+            found, lambda table: self._load_table(table, found[table],
+                                                  progress))
+        self._finish([table for table, rows in progress.rows.items() if rows])
+        self.log(progress.summary())
+
+        return progress.rows
+
+    def _in_dependency_order(self, tables, load):
+        """Call load(table) for each table, on `workers` threads, each
+        once the tables it references (among `tables`) are loaded."""
+
+        needs = {table: {fk.column.table.name
+                         for fk in db.metadata.tables[table].foreign_keys}
+                 & set(tables) - {table}
+                 for table in tables}
+        done = set()
+        running = {}
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            while needs or running:
+                for table in [t for t, deps in needs.items() if deps <= done]:
+                    del needs[table]
+                    running[executor.submit(load, table)] = table
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+                    done.add(running.pop(future))
+
+    def _load_table(self, table, paths, progress):
+        progress.begin(table)
+        with self.engine.begin() as connection:
+            skip = {row.path for row in connection.execute(
+                sa.select(loaded_files.c.path)
+                  .where(loaded_files.c.table_name == table))}
+        todo = [p for p in paths if os.path.realpath(p) not in skip]
+
+        if todo:
+            self._drop_indexes(table)
+        for path in todo:
+            self._load_file(table, path, progress)
+            progress.add(table, 0, force=True)
+        self._build_indexes(table)
+
+    def _load_file(self, table, path, progress):
+        """Load one CSV file in one transaction, and record it."""
+
+        rows = 0
+        with self.engine.begin() as connection:
+            for columns, batch in self._batches(table, path):
+                if self.postgres:
+                    self._copy(connection, table, columns, batch)
+                else:
+                    self._insert(connection, table, columns, batch)
+                rows += len(batch)
+                progress.add(table, len(batch))
+
+            connection.execute(loaded_files.insert().values(
+                path=os.path.realpath(path), table_name=table, rows=rows,
+                loaded_at=datetime.utcnow()))
+
+    def _batches(self, table, path):
+        """Yield (columns, [row lists]) of at most batch_size rows."""
+
+        derived = {column: fn for column, fn in DERIVED.get(table, {}).items()}
+
+        with open(path, newline="") as file:
+            reader = csv.reader(file)
+            header = next(reader)
+
+            unknown = set(header) - set(db.metadata.tables[table].columns.keys())
+            if unknown:
+                raise ValueError(f"{path}: no column(s) {sorted(unknown)} "
+                                 f"in {table}")
+            for column in header:
+                derived.pop(column, None)
+            columns = header + list(derived)
+
+            batch = []
+            for row in reader:
+                if derived:
+                    values = dict(zip(header, row))
+                    row += [fn(values) for fn in derived.values()]
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    yield columns, batch
+                    batch = []
+            if batch:
+                yield columns, batch
+
+    def _copy(self, connection, table, columns, batch):
+        # empty, unquoted fields are NULL, as for executemany below
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY {table} ({', '.join(columns)}) "
+                f"FROM STDIN WITH (FORMAT csv)", buffer)
+        finally:
+            cursor.close()
+
+    def _insert(self, connection, table, columns, batch):
+        model_table = db.metadata.tables[table]
+        dates = {c for c in columns
+                 if isinstance(model_table.c[c].type, sa.DateTime)}
+
+        rows = []
+        for row in batch:
+            values = {}
+            for column, value in zip(columns, row):
+                if value == "":
+                    value = None
+                elif column in dates:
+                    value = datetime.fromisoformat(value)
+                values[column] = value
+            rows.append(values)
+
+        connection.execute(model_table.insert(), rows)
+
+    def _drop_indexes(self, table):
+        """Drop `table`'s indexes for the load, remembering them."""
+
+        with self.engine.begin() as connection:
+            pending = connection.execute(
+                sa.select(deferred_indexes.c.name)
+                  .where(deferred_indexes.c.table_name == table)).first()
+            if pending:
+                # dropped by an earlier, interrupted load
+                return
+
+            defer = self.defer_indexes
+            if defer is None:
+                defer = connection.execute(
+                    sa.select(sa.literal(1))
+                      .select_from(db.metadata.tables[table])
+                      .limit(1)).first() is None
+            if not defer:
+                return
+
+            sql = POSTGRES_INDEXES if self.postgres else SQLITE_INDEXES
+            indexes = connection.execute(sa.text(sql), {"table": table}).all()
+            for index in indexes:
+                connection.execute(deferred_indexes.insert().values(
+                    name=index.name, table_name=table,
+                    definition=index.definition))
+                connection.execute(sa.text(f"DROP INDEX {index.name}"))
+
+        if indexes:
+            self.log(f"{table}: deferred {len(indexes)} index(es)")
+
+    def _build_indexes(self, table):
+        """Rebuild the indexes _drop_indexes dropped from `table`."""
+
+        with self.engine.begin() as connection:
+            indexes = connection.execute(
+                sa.select(deferred_indexes)
+                  .where(deferred_indexes.c.table_name == table)).all()
+            if not indexes:
+                return
+
+            start = time.perf_counter()
+            for index in indexes:
+                connection.execute(sa.text(index.definition))
+            connection.execute(deferred_indexes.delete()
+                               .where(deferred_indexes.c.table_name == table))
+
+        self.log(f"{table}: built {len(indexes)} index(es) in "
+                 f"{time.perf_counter() - start:.1f}s")
+
+    def _empty(self, found):
+        """Delete everything in the tables being loaded and in every
+        table that references them."""
+
+        tables = set(found)
+        for table in db.metadata.sorted_tables:
+            if {fk.column.table.name for fk in table.foreign_keys} & tables:
+                tables.add(table.name)
+
+        ordered = [t for t in reversed(db.metadata.sorted_tables)
+                   if t.name in tables]
+
+        with self.engine.begin() as connection:
+            if self.postgres:
+                connection.execute(sa.text(
+                    f"TRUNCATE {', '.join(t.name for t in ordered)} "
+                    f"RESTART IDENTITY"))
+            else:
+                for table in ordered:
+                    connection.execute(table.delete())
+            connection.execute(loaded_files.delete()
+                               .where(loaded_files.c.table_name.in_(tables)))
+
+    def _finish(self, loaded):
+        """Bring sequences, caches and derived tables up to date after
+        loading rows into the `loaded` tables."""
+
+        with self.engine.begin() as connection:
+            for table in loaded:
+                model_table = db.metadata.tables[table]
+                if self.postgres and "id" in model_table.c:
+                    connection.execute(sa.text(
+                        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                        f"coalesce(max(id), 0) + 1, false) FROM {table}"))
+
+            if "listings" in loaded:
+                CacheVersion.bump(connection, CacheVersion.LISTINGS)
+
+        if "messages" in loaded:
+            Conversation.rebuild()
+            db.session.commit()
+
+        if "bookings" in loaded:
+            ListingCalendar.rebuild()
+            db.session.commit()
+
+        if self.postgres:
+            with self.engine.connect() as connection:
+                connection = connection.execution_options(
+                    isolation_level="AUTOCOMMIT")
+                for table in loaded:
+                    connection.execute(sa.text(f"ANALYZE {table}"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m loader",
+        description="Bulk load a directory of CSV files.")
+    parser.add_argument("directory")
+    parser.add_argument("--replace", action="store_true",
+                        help="empty the tables being loaded first")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="tables loading at once (Postgres)")
+    parser.add_argument("--defer-indexes", choices=("auto", "always", "never"),
+                        default="auto")
+    args = parser.parse_args()
+
+    import migrations
+    from app import app
+
+    defer = {"auto": None, "always": True, "never": False}[args.defer_indexes]
+
+    with app.app_context():
+        migrations.upgrade(db.engine, db)
+        BulkLoader(db.engine, args.batch_size, args.workers,
+                   defer).load(args.directory, replace=args.replace)
+
+
+if __name__ == "__main__":
+    main()
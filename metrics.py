@@ -0,0 +1,303 @@
+"""Request and database metrics, served in Prometheus text format.
+
+SQLAlchemy engine events time every statement and charge it to the
+request running on that thread, so each request knows its query count,
+total database time and slowest statement. When the request ends they
+go into per-route counters and histograms, along with its latency, and
+GET /metrics reports them with connection pool stats.
+
+- Responses carry a Server-Timing header (db time and query count), so
+  browser dev tools show where a request's time went.
+- A statement slower than SLOW_QUERY_MS is logged (without its
+  parameters) with the route it ran for; a request slower than
+  SLOW_REQUEST_MS is logged with its query count, db time and slowest
+  statement. 0 turns either off.
+- Recording is a few dict updates per request and two clock reads per
+  statement, cheap enough to leave on in production.
+
+Metrics are per process: with several gunicorn workers, each scrape sees
+one of them. Set METRICS_TOKEN to require "Authorization: Bearer
+<token>" on /metrics.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import Response, abort, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds of the queries-per-request histogram buckets
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Longest statement text kept for logs
+STATEMENT_LENGTH = 500
+
+
+class RequestStats:
+    """The database work done for one request so far.
+
+    `statements` is None unless something (query_budget.py) asks for
+    the text of every statement by setting it to a list.
+    """
+
+    __slots__ = ("queries", "db_time", "slowest", "slowest_time",
+                 "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = None
+        self.slowest_time = 0.0
+        self.statements = None
+
+    def add(self, statement, elapsed):
+        self.queries += 1
+        if self.statements is not None:
+            self.statements.append(statement)
+        self.db_time += elapsed
+        if elapsed > self.slowest_time:
+            self.slowest = statement
+            self.slowest_time = elapsed
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label values, Prometheus style."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def lines(self, name, label_names):
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            label_text = _labels(label_names, labels)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield (f'{name}_bucket{{{label_text},le="{bound}"}} '
+                       f'{cumulative}')
+            yield f'{name}_bucket{{{label_text},le="+Inf"}} {count}'
+            yield f"{name}_sum{{{label_text}}} {total:.6f}"
+            yield f"{name}_count{{{label_text}}} {count}"
+
+
+def _labels(names, values):
+    return ",".join(f'{name}="{_escape(value)}"'
+                    for name, value in zip(names, values))
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _shorten(statement):
+    statement = " ".join(statement.split())
+    if len(statement) > STATEMENT_LENGTH:
+        return statement[:STATEMENT_LENGTH] + "..."
+    return statement
+
+
+class Metrics:
+    """Collects per-request SQL stats and serves /metrics."""
+
+    def __init__(self):
+        self.slow_query = 0.25
+        self.slow_request = 1.0
+        self.token = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)
+        self._latency = Histogram(LATENCY_BUCKETS)
+        self._queries = Histogram(QUERY_BUCKETS)
+        self._db_time = defaultdict(float)
+        self._slow_queries = 0
+        self._listening = False
+
+    def init_app(self, app):
+        """Read SLOW_QUERY_MS, SLOW_REQUEST_MS and METRICS_TOKEN; hook
+        into requests and every engine; add the /metrics route."""
+
+        self.slow_query = app.config.get('SLOW_QUERY_MS', 250) / 1000
+        self.slow_request = app.config.get('SLOW_REQUEST_MS', 1000) / 1000
+        self.token = app.config.get('METRICS_TOKEN')
+
+        app.before_request(self._start_request)
+        app.after_request(self._add_server_timing)
+        app.teardown_request(self._end_request)
+        app.add_url_rule('/metrics', 'metrics', self.render_response)
+
+        if not self._listening:
+            event.listen(Engine, "before_cursor_execute", self._before_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_execute)
+            self._listening = True
+
+    @property
+    def current(self):
+        """RequestStats for the request on this thread, or None."""
+
+        return getattr(self._local, "stats", None)
+
+    def _start_request(self):
+        self._local.stats = RequestStats()
+        self._local.start = time.perf_counter()
+        self._local.status = 500
+
+    # The start time lives on the statement's execution context, which
+    # goes away with the statement; after_cursor_execute doesn't fire for
+    # one that raises, so anything kept on the connection would pile up.
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        context._metrics_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        elapsed = time.perf_counter() - context._metrics_start
+
+        stats = self.current
+        if stats is not None:
+            stats.add(statement, elapsed)
+
+        if self.slow_query and elapsed >= self.slow_query:
+            with self._lock:
+                self._slow_queries += 1
+            logger.warning("slow query (%.0f ms) in %s: %s",
+                           elapsed * 1000, _route(), _shorten(statement))
+
+    def _add_server_timing(self, response):
+        stats = self.current
+        if stats is not None:
+            self._local.status = response.status_code
+            response.headers.add(
+                "Server-Timing",
+                f'db;dur={stats.db_time * 1000:.1f};'
+                f'desc="{stats.queries} queries"')
+        return response
+
+    def _end_request(self, exc):
+        stats = self.current
+        if stats is None:
+            return
+        elapsed = time.perf_counter() - self._local.start
+        self._local.stats = None
+
+        route = _route()
+        # after_request doesn't run for an unhandled exception
+        status = 500 if exc is not None else self._local.status
+
+        with self._lock:
+            self._requests[(request.method, route, status)] += 1
+            self._latency.observe((request.method, route), elapsed)
+            self._queries.observe((route,), stats.queries)
+            self._db_time[route] += stats.db_time
+
+        if self.slow_request and elapsed >= self.slow_request:
+            logger.warning(
+                "slow request (%.0f ms) %s %s: %d queries, %.0f ms in db; "
+                "slowest (%.0f ms): %s",
+                elapsed * 1000, request.method, route, stats.queries,
+                stats.db_time * 1000, stats.slowest_time * 1000,
+                _shorten(stats.slowest or ""))
+
+    def pool_stats(self):
+        """{state: connections} for the app's engine pool."""
+
+        pool = db.engine.pool
+        stats = {}
+        for state, method in (("size", "size"),
+                              ("checked_in", "checkedin"),
+                              ("checked_out", "checkedout"),
+                              ("overflow", "overflow")):
+            if hasattr(pool, method):
+                stats[state] = getattr(pool, method)()
+        return stats
+
+    def render(self):
+        """The metrics, in Prometheus text exposition format."""
+
+        with self._lock:
+            requests = sorted(self._requests.items(), key=str)
+            latency = list(self._latency.lines(
+                "sharebnb_http_request_duration_seconds",
+                ("method", "route")))
+            queries = list(self._queries.lines(
+                "sharebnb_db_queries_per_request", ("route",)))
+            db_time = sorted(self._db_time.items())
+            slow_queries = self._slow_queries
+
+        lines = [
+            "# HELP sharebnb_http_requests_total Requests handled.",
+            "# TYPE sharebnb_http_requests_total counter",
+        ]
+        lines += [f"sharebnb_http_requests_total"
+                  f"{{{_labels(('method', 'route', 'status'), key)}}} {n}"
+                  for key, n in requests]
+        lines += [
+            "# HELP sharebnb_http_request_duration_seconds Request latency.",
+            "# TYPE sharebnb_http_request_duration_seconds histogram",
+            *latency,
+            "# HELP sharebnb_db_queries_per_request SQL statements per "
+            "request.",
+            "# TYPE sharebnb_db_queries_per_request histogram",
+            *queries,
+            "# HELP sharebnb_db_time_seconds_total Time spent in SQL "
+            "statements.",
+            "# TYPE sharebnb_db_time_seconds_total counter",
+        ]
+        lines += [f'sharebnb_db_time_seconds_total{{route="{_escape(route)}"}}'
+                  f" {seconds:.6f}"
+                  for route, seconds in db_time]
+        lines += [
+            "# HELP sharebnb_db_slow_queries_total Statements slower than "
+            "SLOW_QUERY_MS.",
+            "# TYPE sharebnb_db_slow_queries_total counter",
+            f"sharebnb_db_slow_queries_total {slow_queries}",
+            "# HELP sharebnb_db_pool_connections Connection pool state.",
+            "# TYPE sharebnb_db_pool_connections gauge",
+        ]
+        lines += [f'sharebnb_db_pool_connections{{state="{state}"}} {n}'
+                  for state, n in self.pool_stats().items()]
+
+        return "\n".join(lines) + "\n"
+
+    def render_response(self):
+        if self.token and (request.headers.get("Authorization")
+                           != f"Bearer {self.token}"):
+            abort(404)
+
+        return Response(self.render(),
+                        content_type="text/plain; version=0.0.4")
+
+
+def _route():
+    """The matched URL rule, so ids don't make a series per listing."""
+
+    try:
+        rule = request.url_rule
+    except RuntimeError:
+        return "none"
+    return rule.rule if rule is not None else "unmatched"
+
+
+metrics = Metrics()
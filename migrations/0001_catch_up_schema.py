@@ -0,0 +1,154 @@
+"""Bring a database from before migrations up to the models' schema.
+
+Tables, columns and constraints that models.py gained since the first
+release reached new databases through create_all() only. This adds them
+to an existing database. Indexes on existing tables come in 0002, which
+builds them online, and the bookings constraints in 0004, which checks
+the existing bookings against them first.
+
+Tables are declared here as they were at the time, not imported from
+models.py, so later model changes don't change what this migration does.
+"""
+
+import sqlalchemy as sa
+
+metadata = sa.MetaData()
+
+# just enough of the existing tables for the foreign keys below
+sa.Table("users", metadata, sa.Column("id", sa.Integer, primary_key=True))
+sa.Table("listings", metadata, sa.Column("id", sa.Integer, primary_key=True))
+sa.Table("messages", metadata, sa.Column("id", sa.Integer, primary_key=True))
+
+upload_jobs = sa.Table(
+    "upload_jobs", metadata,
+    sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+    sa.Column("listing_id", sa.Integer,
+              sa.ForeignKey("listings.id", ondelete="cascade"),
+              nullable=False),
+    sa.Column("path", sa.Text, nullable=False),
+    sa.Column("object_name", sa.Text, nullable=False),
+    sa.Column("status", sa.Text, nullable=False),
+    sa.Column("attempts", sa.Integer, nullable=False),
+    sa.Column("run_at", sa.DateTime, nullable=False),
+    sa.Column("last_error", sa.Text),
+    sa.Index("ix_upload_jobs_status_run_at", "status", "run_at"),
+)
+
+cache_versions = sa.Table(
+    "cache_versions", metadata,
+    sa.Column("name", sa.Text, primary_key=True),
+    sa.Column("version", sa.Integer, nullable=False),
+    sa.Column("updated_at", sa.DateTime),
+)
+
+conversations = sa.Table(
+    "conversations", metadata,
+    sa.Column("user_id", sa.Integer,
+              sa.ForeignKey("users.id", ondelete="CASCADE"),
+              primary_key=True),
+    sa.Column("other_user_id", sa.Integer,
+              sa.ForeignKey("users.id", ondelete="CASCADE"),
+              primary_key=True),
+    sa.Column("last_message_id", sa.Integer,
+              sa.ForeignKey("messages.id", ondelete="CASCADE"),
+              nullable=False),
+    sa.Column("snippet", sa.Text, nullable=False),
+    sa.Column("last_at", sa.DateTime, nullable=False),
+    sa.Column("unread", sa.Integer, nullable=False),
+    sa.Index("ix_conversations_user_recent", "user_id", "last_message_id"),
+)
+
+# One row per side of each conversation, from its latest message
+CONVERSATIONS_FROM_MESSAGES = """
+INSERT INTO conversations
+    (user_id, other_user_id, last_message_id, snippet, last_at, unread)
+SELECT latest.user_id, latest.other_user_id, m.id, substr(m.text, 1, 80),
+       m.timestamp, 0
+FROM (SELECT user_id, other_user_id, max(id) AS id
+      FROM (SELECT from_user_id AS user_id, to_user_id AS other_user_id, id
+            FROM messages
+            UNION ALL
+            SELECT to_user_id, from_user_id, id FROM messages) AS sides
+      GROUP BY user_id, other_user_id) AS latest
+JOIN messages m ON m.id = latest.id
+"""
+
+SQLITE_SEARCH = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5"
+    "(name, details, content='listings', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS listings_fts_ai AFTER INSERT ON listings "
+    "BEGIN INSERT INTO listings_fts(rowid, name, details) "
+    "VALUES (new.id, new.name, new.details); END",
+    "CREATE TRIGGER IF NOT EXISTS listings_fts_ad AFTER DELETE ON listings "
+    "BEGIN INSERT INTO listings_fts(listings_fts, rowid, name, details) "
+    "VALUES ('delete', old.id, old.name, old.details); END",
+    "CREATE TRIGGER IF NOT EXISTS listings_fts_au AFTER UPDATE ON listings "
+    "BEGIN INSERT INTO listings_fts(listings_fts, rowid, name, details) "
+    "VALUES ('delete', old.id, old.name, old.details); "
+    "INSERT INTO listings_fts(rowid, name, details) "
+    "VALUES (new.id, new.name, new.details); END",
+    "INSERT INTO listings_fts(listings_fts) VALUES ('rebuild')",
+]
+
+
+def upgrade(migration):
+    if migration.postgres:
+        migration.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+        migration.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    else:
+        for statement in SQLITE_SEARCH:
+            migration.execute(statement)
+
+    _listings(migration)
+    _messages(migration)
+    _new_tables(migration)
+
+
+def _listings(migration):
+    migration.add_column("listings", "photo_variants", "JSON")
+    migration.add_column("listings", "photo_status",
+                         "TEXT NOT NULL DEFAULT 'ready'")
+    migration.add_column("listings", "version",
+                         "INTEGER NOT NULL DEFAULT 1")
+
+    if migration.postgres:
+        migration.add_column("listings", "updated_at",
+                             "TIMESTAMP NOT NULL DEFAULT now()")
+    elif not migration.has_column("listings", "updated_at"):
+        # SQLite only allows constant defaults on added columns
+        migration.add_column("listings", "updated_at",
+                             "DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00'")
+        migration.execute("UPDATE listings SET updated_at = CURRENT_TIMESTAMP")
+
+
+def _messages(migration):
+    if migration.has_column("messages", "conversation_key"):
+        return
+
+    migration.add_column("messages", "conversation_key", "BIGINT")
+
+    if migration.postgres:
+        migration.execute(
+            "UPDATE messages SET conversation_key = "
+            "(LEAST(to_user_id, from_user_id)::bigint << 32) | "
+            "GREATEST(to_user_id, from_user_id)")
+        migration.execute("ALTER TABLE messages "
+                          "ALTER COLUMN conversation_key SET NOT NULL")
+    else:
+        migration.execute(
+            "UPDATE messages SET conversation_key = "
+            "(min(to_user_id, from_user_id) << 32) | "
+            "max(to_user_id, from_user_id)")
+
+
+def _new_tables(migration):
+    created = [t for t in (upload_jobs, cache_versions, conversations)
+               if not migration.has_table(t.name)]
+
+    metadata.create_all(migration.connection, tables=created)
+
+    if cache_versions in created:
+        migration.execute("INSERT INTO cache_versions (name, version) "
+                          "VALUES ('listings', 0)")
+    if conversations in created:
+        migration.execute(CONVERSATIONS_FROM_MESSAGES)
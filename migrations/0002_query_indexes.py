@@ -0,0 +1,48 @@
+"""Indexes for foreign keys and the routes' query patterns, built online.
+
+Besides the indexes models.py gained before migrations existed, this
+indexes every foreign key the routes filter or join on (and that
+ON DELETE CASCADE has to search when a user or listing goes):
+
+- bookings (user_id, listing_id, checkin_date, checkout_date): a user's
+  bookings, covering so the join to listings needs no heap fetch
+- listings (user_id), messages (to_user_id), messages (from_user_id),
+  conversations (other_user_id), conversations (last_message_id),
+  upload_jobs (listing_id)
+
+bookings.listing_id is already served by ix_bookings_listing_checkin.
+"""
+
+TRANSACTIONAL = False
+
+# (name, table, columns)
+INDEXES = [
+    ("ix_bookings_listing_checkin", "bookings", "listing_id, checkin_date"),
+    ("ix_bookings_user", "bookings",
+     "user_id, listing_id, checkin_date, checkout_date"),
+    ("ix_listings_price_id", "listings", "price, id"),
+    ("ix_listings_user_id", "listings", "user_id"),
+    ("ix_messages_conversation_id", "messages", "conversation_key, id"),
+    ("ix_messages_to_user_id", "messages", "to_user_id"),
+    ("ix_messages_from_user_id", "messages", "from_user_id"),
+    ("ix_conversations_other_user_id", "conversations", "other_user_id"),
+    ("ix_conversations_last_message_id", "conversations", "last_message_id"),
+    ("ix_upload_jobs_listing_id", "upload_jobs", "listing_id"),
+]
+
+# (name, table, method, columns); see LISTING_SEARCH_DDL in models.py
+POSTGRES_INDEXES = [
+    ("ix_listings_search", "listings", "gin",
+     "to_tsvector('english', coalesce(name, '') || ' ' || "
+     "coalesce(details, ''))"),
+    ("ix_listings_name_trgm", "listings", "gin", "name gin_trgm_ops"),
+]
+
+
+def upgrade(migration):
+    for name, table, columns in INDEXES:
+        migration.create_index(name, table, columns)
+
+    if migration.postgres:
+        for name, table, method, columns in POSTGRES_INDEXES:
+            migration.create_index(name, table, columns, using=method)
@@ -0,0 +1,68 @@
+"""Per-listing booked-night bitmaps, for GET /api/listings/<id>/calendar.
+
+Creates listing_calendars and fills it from the existing bookings, as
+ListingCalendar.rebuild does; from then on the app keeps it up to date.
+
+Instances still running the previous release don't, so bookings they
+make between this migration and their replacement are missing from the
+calendars. Deploy in this order:
+
+1. python -m migrations
+2. roll out the release everywhere
+3. python -m migrations rebuild-calendars
+
+Step 3 holds off booking writes (not reads) while it runs.
+"""
+
+from collections import defaultdict
+from datetime import date
+
+import sqlalchemy as sa
+
+metadata = sa.MetaData()
+
+sa.Table("listings", metadata, sa.Column("id", sa.Integer, primary_key=True))
+
+listing_calendars = sa.Table(
+    "listing_calendars", metadata,
+    sa.Column("listing_id", sa.Integer,
+              sa.ForeignKey("listings.id", ondelete="CASCADE"),
+              primary_key=True),
+    sa.Column("year", sa.Integer, primary_key=True),
+    sa.Column("nights", sa.LargeBinary, nullable=False),
+)
+
+YEAR_BYTES = 46
+
+
+def upgrade(migration):
+    if migration.has_table("listing_calendars"):
+        return
+
+    metadata.create_all(migration.connection, tables=[listing_calendars])
+
+    calendars = defaultdict(int)
+    bookings = migration.connection.execution_options(yield_per=10_000)\
+        .execute(sa.text("SELECT listing_id, checkin_date, checkout_date "
+                         "FROM bookings"))
+    for listing_id, checkin, checkout in bookings:
+        first, end = _day(checkin), _day(checkout)
+        while first < end:
+            last = min(end, date(first.year + 1, 1, 1))
+            start_bit = (first - date(first.year, 1, 1)).days
+            calendars[listing_id, first.year] |= \
+                ((1 << (last - first).days) - 1) << start_bit
+            first = last
+
+    rows = [{"listing_id": listing_id, "year": year,
+             "nights": bits.to_bytes(YEAR_BYTES, "little")}
+            for (listing_id, year), bits in calendars.items()]
+    if rows:
+        migration.connection.execute(listing_calendars.insert(), rows)
+
+
+def _day(value):
+    # SQLite hands back DATETIME columns of a text query as strings
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value.date()
@@ -0,0 +1,103 @@
+"""The bookings constraints: stays end after they start, and no two
+stays at a listing overlap.
+
+Bookings from before these constraints may break them (nothing stopped
+double bookings then), so this first looks for rows that would, and
+stops with a list of them (MigrationError) if it finds any. Cancel or
+fix those bookings and run it again.
+
+bookings_stay_order is added NOT VALID, which needs the table's lock
+only for a moment, then validated under a lock that lets reads and
+writes carry on.
+
+bookings_no_overlap can't be built online: Postgres builds its GiST
+index with the table locked against reads and writes, for as long as
+the build takes. Run this migration in a maintenance window. It waits at
+most LOCK_TIMEOUT for the lock rather than queueing live traffic behind
+it; if it times out, run it again.
+
+SQLite can't add constraints to an existing table, so this does
+nothing there.
+"""
+
+from migrations import MigrationError
+
+TRANSACTIONAL = False
+
+LOCK_TIMEOUT = "5s"
+
+# How many offending bookings to list
+REPORT_LIMIT = 20
+
+INVERTED_STAYS = """
+SELECT id, listing_id, checkin_date, checkout_date
+FROM bookings
+WHERE NOT checkin_date < checkout_date
+ORDER BY id
+LIMIT :limit
+"""
+
+OVERLAPPING_STAYS = """
+SELECT a.id, b.id AS other_id, a.listing_id
+FROM bookings a
+JOIN bookings b
+  ON b.listing_id = a.listing_id
+ AND b.id > a.id
+ AND b.checkin_date < a.checkout_date
+ AND a.checkin_date < b.checkout_date
+ORDER BY a.id, b.id
+LIMIT :limit
+"""
+
+
+def upgrade(migration):
+    if not migration.postgres:
+        return
+
+    existing = {row.conname for row in migration.execute(
+        "SELECT conname FROM pg_constraint "
+        "WHERE conrelid = 'bookings'::regclass")}
+
+    _check(migration, existing)
+
+    if "bookings_stay_order" not in existing:
+        migration.execute("ALTER TABLE bookings ADD CONSTRAINT "
+                          "bookings_stay_order "
+                          "CHECK (checkin_date < checkout_date) NOT VALID")
+    # a no-op once valid; finishes an earlier run that stopped here
+    migration.execute("ALTER TABLE bookings "
+                      "VALIDATE CONSTRAINT bookings_stay_order")
+
+    if "bookings_no_overlap" not in existing:
+        migration.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}'")
+        try:
+            migration.execute(
+                "ALTER TABLE bookings ADD CONSTRAINT bookings_no_overlap "
+                "EXCLUDE USING gist (listing_id WITH =, "
+                "tsrange(checkin_date, checkout_date) WITH &&)")
+        finally:
+            migration.execute("RESET lock_timeout")
+
+
+def _check(migration, existing):
+    """Raise MigrationError listing bookings the constraints would
+    reject."""
+
+    problems = []
+
+    # tsrange() rejects these too, so check them for either constraint
+    for row in migration.execute(INVERTED_STAYS, limit=REPORT_LIMIT):
+        problems.append(f"booking {row.id} (listing {row.listing_id}) "
+                        f"checks out {row.checkout_date} before checking "
+                        f"in {row.checkin_date}")
+
+    if "bookings_no_overlap" not in existing:
+        for row in migration.execute(OVERLAPPING_STAYS, limit=REPORT_LIMIT):
+            problems.append(f"bookings {row.id} and {row.other_id} "
+                            f"overlap at listing {row.listing_id}")
+
+    if problems:
+        listed = "\n  ".join(problems)
+        raise MigrationError(
+            f"bookings break the new constraints; fix these and migrate "
+            f"again (at most {REPORT_LIMIT} of each kind shown):\n  {listed}")
@@ -0,0 +1,53 @@
+"""Keep each upload job's photo in its row rather than on local disk.
+
+Jobs used to point at a file staged under uploads/ on the host that took
+the request, which a worker on another host, or on the same one after a
+restart with a fresh filesystem, can't read. This adds upload_jobs.data
+and fills it for unfinished jobs whose file is on the host running the
+migration. Jobs whose file isn't are marked failed (and so are their
+listings' photos), since nothing can upload them. The staged files are
+left where they are; delete uploads/ once this has run everywhere.
+
+path is no longer written; it stays, nullable, on Postgres so that
+instances still running the previous release can queue jobs until they
+are replaced (the worker fails those, as above). SQLite can't drop
+NOT NULL, so there it is dropped outright.
+"""
+
+
+def upgrade(migration):
+    migration.add_column("upload_jobs", "data",
+                         "BYTEA" if migration.postgres else "BLOB")
+
+    if not migration.has_column("upload_jobs", "path"):
+        return
+
+    jobs = migration.execute(
+        "SELECT id, listing_id, path FROM upload_jobs "
+        "WHERE data IS NULL AND status IN ('pending', 'running')").all()
+
+    for job in jobs:
+        try:
+            with open(job.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            _lost(migration, job)
+            continue
+
+        migration.execute("UPDATE upload_jobs SET data = :data "
+                          "WHERE id = :id", data=data, id=job.id)
+
+    if migration.postgres:
+        migration.execute("ALTER TABLE upload_jobs "
+                          "ALTER COLUMN path DROP NOT NULL")
+    else:
+        migration.execute("ALTER TABLE upload_jobs DROP COLUMN path")
+
+
+def _lost(migration, job):
+    migration.execute(
+        "UPDATE upload_jobs SET status = 'failed', "
+        "last_error = 'staged photo not found during migration 0005' "
+        "WHERE id = :id", id=job.id)
+    migration.execute("UPDATE listings SET photo_status = 'failed' "
+                      "WHERE id = :id", id=job.listing_id)
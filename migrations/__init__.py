@@ -0,0 +1,200 @@
+"""Versioned schema migrations.
+
+Each module here named NNNN_description.py is one migration. They are
+applied in order, each recorded in schema_migrations once it succeeds.
+A migration defines upgrade(migration), taking a Migration, and sets
+TRANSACTIONAL = False if it has to run outside a transaction (for
+CREATE INDEX CONCURRENTLY). A migration interrupted before it is
+recorded runs again, so write them to be safe to re-run.
+
+    python -m migrations                    # apply pending migrations
+    python -m migrations status             # list applied and pending
+    python -m migrations rebuild-calendars  # see 0003
+
+A database without any of our tables is created from the models and
+stamped as fully migrated; so is one set up by seed.py or the tests,
+which call create_all() themselves (see stamp()).
+"""
+
+import importlib
+import os
+import pkgutil
+import re
+from contextlib import contextmanager
+from datetime import datetime
+
+import sqlalchemy as sa
+
+# Namespace for the advisory lock that keeps two deploys from migrating
+# the same Postgres database at once
+MIGRATION_LOCK = 2
+
+_NAME = re.compile(r"^(\d{4})_\w+$")
+
+
+class MigrationError(Exception):
+    """A migration can't go ahead until someone fixes the data."""
+
+
+metadata = sa.MetaData()
+
+schema_migrations = sa.Table(
+    "schema_migrations", metadata,
+    sa.Column("version", sa.Text, primary_key=True),
+    sa.Column("applied_at", sa.DateTime, nullable=False),
+)
+
+
+class Migration:
+    """What a migration's upgrade() gets: a connection plus helpers."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.dialect = connection.dialect.name
+
+    @property
+    def postgres(self):
+        return self.dialect == "postgresql"
+
+    def execute(self, sql, **params):
+        return self.connection.execute(sa.text(sql), params)
+
+    def has_table(self, table):
+        return sa.inspect(self.connection).has_table(table)
+
+    def has_column(self, table, column):
+        columns = sa.inspect(self.connection).get_columns(table)
+        return any(c["name"] == column for c in columns)
+
+    def add_column(self, table, column, ddl):
+        """ALTER TABLE `table` ADD `column` `ddl`, unless it exists."""
+
+        if not self.has_column(table, column):
+            self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+    def create_index(self, name, table, columns, using=None):
+        """Create an index if it doesn't exist, online on Postgres.
+
+        `columns` is the SQL inside the parentheses. On Postgres this is
+        CREATE INDEX CONCURRENTLY, so writes to `table` carry on while
+        it builds; the migration must not be TRANSACTIONAL. An invalid
+        index left by an earlier failed build is dropped and rebuilt.
+        """
+
+        if not self.postgres:
+            self.execute(f"CREATE INDEX IF NOT EXISTS {name} "
+                         f"ON {table} ({columns})")
+            return
+
+        invalid = self.execute(
+            "SELECT 1 FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid",
+            name=name).first()
+        if invalid:
+            self.execute(f"DROP INDEX CONCURRENTLY {name}")
+
+        method = f"USING {using} " if using else ""
+        self.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                     f"ON {table} {method}({columns})")
+
+
+def available():
+    """Return [(version, module name)] for every migration, in order."""
+
+    found = []
+    for info in pkgutil.iter_modules([os.path.dirname(__file__)]):
+        match = _NAME.match(info.name)
+        if match:
+            found.append((match.group(1), info.name))
+
+    return sorted(found)
+
+
+def applied(engine):
+    """Return the set of versions recorded in schema_migrations."""
+
+    with engine.connect() as connection:
+        if not sa.inspect(connection).has_table("schema_migrations"):
+            return set()
+        rows = connection.execute(sa.select(schema_migrations.c.version))
+        return {row.version for row in rows}
+
+
+def stamp(engine, versions=None):
+    """Record `versions` (default: all) as applied, without running them.
+
+    For databases built by create_all(), which already have the schema
+    every migration would produce.
+    """
+
+    if versions is None:
+        versions = [version for version, _ in available()]
+
+    with engine.begin() as connection:
+        metadata.create_all(connection)
+        done = {row.version for row in
+                connection.execute(sa.select(schema_migrations.c.version))}
+        rows = [{"version": v, "applied_at": datetime.utcnow()}
+                for v in versions if v not in done]
+        if rows:
+            connection.execute(schema_migrations.insert(), rows)
+
+
+def upgrade(engine, db=None, log=print):
+    """Apply every pending migration to `engine`, in order.
+
+    If the database has none of the models' tables, `db` (the
+    Flask-SQLAlchemy instance) creates them and everything is stamped.
+    Returns the versions applied.
+    """
+
+    with _locked(engine):
+        if db is not None and not sa.inspect(engine).has_table("users"):
+            db.create_all()
+            stamp(engine)
+            log("created schema from models")
+            return []
+
+        done = applied(engine)
+        ran = []
+        for version, name in available():
+            if version in done:
+                continue
+            log(f"applying {name}")
+            _run(engine, importlib.import_module(f"{__name__}.{name}"))
+            stamp(engine, [version])
+            ran.append(version)
+
+        return ran
+
+
+def _run(engine, module):
+    if getattr(module, "TRANSACTIONAL", True):
+        with engine.begin() as connection:
+            module.upgrade(Migration(connection))
+    else:
+        with engine.connect() as connection:
+            connection = connection.execution_options(
+                isolation_level="AUTOCOMMIT")
+            module.upgrade(Migration(connection))
+
+
+@contextmanager
+def _locked(engine):
+    """Hold the migration lock (Postgres only) for the duration."""
+
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level="AUTOCOMMIT")
+        connection.execute(
+            sa.select(sa.func.pg_advisory_lock(MIGRATION_LOCK)))
+        try:
+            yield
+        finally:
+            connection.execute(
+                sa.select(sa.func.pg_advisory_unlock(MIGRATION_LOCK)))
@@ -0,0 +1,34 @@
+"""Command line for migrations; see migrations/__init__.py."""
+
+import sys
+
+import migrations
+from app import app
+from models import db, ListingCalendar
+
+
+def main(argv):
+    command = argv[0] if argv else "upgrade"
+
+    with app.app_context():
+        if command == "upgrade":
+            try:
+                ran = migrations.upgrade(db.engine, db)
+            except migrations.MigrationError as e:
+                sys.exit(str(e))
+            print(f"{len(ran)} migration(s) applied")
+        elif command == "rebuild-calendars":
+            ListingCalendar.rebuild()
+            db.session.commit()
+            print("listing calendars rebuilt")
+        elif command == "status":
+            done = migrations.applied(db.engine)
+            for version, name in migrations.available():
+                print(f"{'applied' if version in done else 'pending':8} {name}")
+        else:
+            sys.exit(f"unknown command {command!r}; use upgrade, status "
+                     f"or rebuild-calendars")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
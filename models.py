@@ -1,28 +1,118 @@
 """SQLAlchemy models for ShareBnb."""
 
-from datetime import datetime
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import (
+    DDL, case, event, func, inspect, literal, literal_column, select, text,
+    tuple_, union_all)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DisconnectionError, IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import Pool
+from sqlalchemy.sql import column, table
+from sqlalchemy.sql.dml import UpdateBase
 
 import logging
-import boto3
-from botocore.exceptions import ClientError
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+from hashing import PasswordHasher
+from serializers import RowSerializer
+from storage import storage, StorageError
+
+# session.info keys: the replica engine this session may read from (set
+# by replicas.py), and whether it has written anything
+READ_REPLICA = "read_replica"
+SESSION_WROTE = "session_wrote"
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from a replica when one is assigned.
+
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary,
+    and once the session has written, so do its reads: they must see the
+    write.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info[SESSION_WROTE] = True
+            self.info.pop(READ_REPLICA, None)
+
+        replica = self.info.get(READ_REPLICA)
+        if replica is not None:
+            return replica
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+hasher = PasswordHasher(bcrypt)
+db = RoutingSQLAlchemy()
+
+
+def default_image_url():
+    """The placeholder photo, in the configured bucket."""
+
+    bucket = db.get_app().config['AWS_BUCKET_NAME']
+    return f"https://{bucket}.s3.amazonaws.com/DEFAULT_YARD.jpeg"
+
+
+# Postgres SQLSTATE for a violated exclusion constraint
+EXCLUSION_VIOLATION = "23P01"
+
+# Namespace for per-listing advisory locks taken while booking
+BOOKING_LOCK_CLASS = 1
+
+# Takes the locks for a sorted list of listing ids, in that order
+BOOKING_LOCKS = text(
+    "SELECT pg_advisory_xact_lock(:lock_class, id) "
+    "FROM unnest(CAST(:ids AS integer[])) AS id")
+
+
+def _begin_immediate():
+    """Start an IMMEDIATE transaction on the session's SQLite connection,
+    so what follows runs under the database's write lock.
+
+    An open transaction is committed first: a deferred one that has only
+    read holds no write lock, and BEGIN can't be nested.
+    """
+
+    dbapi_connection = db.session.connection().connection
+    if dbapi_connection.in_transaction:
+        db.session.commit()
+        dbapi_connection = db.session.connection().connection
+    dbapi_connection.execute("BEGIN IMMEDIATE")
+
+
+class BookingConflictError(Exception):
+    """A booking overlaps an existing booking for the same listing."""
+
+
+class ListingNotFoundError(Exception):
+    """A booking is for a listing that doesn't exist."""
 
-AWS_BUCKET_NAME = os.environ['AWS_BUCKET_NAME']
-DEFAULT_IMAGE_URL = f"https://{AWS_BUCKET_NAME}.s3.amazonaws.com/DEFAULT_YARD.jpeg"
 
 class Booking(db.Model):
     """Connection of a user & listing -> booking."""
 
     __tablename__ = 'bookings'
+    __table_args__ = (
+        db.Index('ix_bookings_listing_checkin', 'listing_id', 'checkin_date'),
+        # a user's bookings, covering the join to listings
+        db.Index('ix_bookings_user', 'user_id', 'listing_id',
+                 'checkin_date', 'checkout_date'),
+        db.CheckConstraint('checkin_date < checkout_date',
+                           name='bookings_stay_order'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -58,6 +148,148 @@ class Booking(db.Model):
         default=datetime.utcnow
     )
 
+    @classmethod
+    def overlaps(cls, checkin_date, checkout_date):
+        """SQL condition: the booking's stay overlaps the given stay.
+
+        Stays are half-open, so checking out the day someone else checks
+        in is not an overlap. On Postgres this is a range test so it can
+        use the GiST index behind bookings_no_overlap.
+        """
+
+        if db.engine.dialect.name == "postgresql":
+            stay = func.tsrange(cls.checkin_date, cls.checkout_date)
+            return stay.op("&&")(func.tsrange(checkin_date, checkout_date))
+
+        return ((cls.checkin_date < checkout_date) &
+                (cls.checkout_date > checkin_date))
+
+    @classmethod
+    def book(cls, user_id, listing_id, checkin_date, checkout_date):
+        """Book a listing for a stay and commit.
+
+        The overlap check and insert are atomic. On Postgres the
+        bookings_no_overlap exclusion constraint rejects the insert; a
+        per-listing advisory lock queues competing bookings for the same
+        listing first, since concurrent conflicting inserts into an
+        exclusion constraint can deadlock. Bookings for other listings
+        don't contend. Elsewhere the check runs under SQLite's write lock,
+        taken up front with BEGIN IMMEDIATE (see _begin_immediate).
+
+        Raises BookingConflictError if the stay overlaps another booking.
+        """
+
+        booking = cls(user_id=user_id,
+                      listing_id=listing_id,
+                      checkin_date=checkin_date,
+                      checkout_date=checkout_date)
+
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(
+                func.pg_advisory_xact_lock(BOOKING_LOCK_CLASS, listing_id)
+                    .select())
+            db.session.add(booking)
+            try:
+                db.session.commit()
+            except IntegrityError as e:
+                db.session.rollback()
+                if getattr(e.orig, "pgcode", None) == EXCLUSION_VIOLATION:
+                    raise BookingConflictError() from e
+                raise
+            return booking
+
+        _begin_immediate()
+
+        conflict = db.session.query(cls.id)\
+            .filter(cls.listing_id == listing_id,
+                    cls.overlaps(checkin_date, checkout_date))\
+            .first()
+        if conflict:
+            db.session.rollback()
+            raise BookingConflictError()
+
+        db.session.add(booking)
+        db.session.commit()
+        return booking
+
+    @classmethod
+    def book_many(cls, user_id, stays):
+        """Book many (listing_id, checkin_date, checkout_date) stays and
+        commit, all in one transaction.
+
+        Locks as book() does, but takes every listing's lock up front (in
+        id order, so concurrent batches can't deadlock), then checks all
+        the stays against existing bookings, and each other, with one
+        query. Stays that conflict, or whose listing doesn't exist, are
+        skipped; the rest are inserted. The listings are checked under
+        the locks, and on Postgres stay locked (FOR KEY SHARE) until the
+        commit, so one can't be deleted between the check and the insert.
+
+        Returns a list with, for each stay, the new Booking, or the error
+        it wasn't booked for: a BookingConflictError or a
+        ListingNotFoundError. The bookings are detached from the session,
+        so reading them after the commit doesn't reload them.
+
+        Raises BookingConflictError, having booked nothing, if a booking
+        made without the listing locks (by the bulk loader, say) got in
+        between the check and the insert; trying again will see it.
+        """
+
+        listing_ids = sorted({listing_id for listing_id, _, _ in stays})
+        if not listing_ids:
+            return []
+
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(BOOKING_LOCKS,
+                               {"lock_class": BOOKING_LOCK_CLASS,
+                                "ids": listing_ids})
+        else:
+            _begin_immediate()
+
+        found = {id for id, in db.session.query(Listing.id)
+                 .filter(Listing.id.in_(listing_ids))
+                 .with_for_update(key_share=True)}
+
+        first = min(checkin for _, checkin, _ in stays)
+        last = max(checkout for _, _, checkout in stays)
+        taken = defaultdict(list)
+        for listing_id, checkin, checkout in db.session.query(
+                cls.listing_id, cls.checkin_date, cls.checkout_date)\
+                .filter(cls.listing_id.in_(listing_ids),
+                        cls.overlaps(first, last)):
+            taken[listing_id].append((checkin, checkout))
+
+        bookings = []
+        for listing_id, checkin, checkout in stays:
+            if listing_id not in found:
+                bookings.append(ListingNotFoundError())
+                continue
+            if any(checkin < other_out and checkout > other_in
+                   for other_in, other_out in taken[listing_id]):
+                bookings.append(BookingConflictError())
+                continue
+            taken[listing_id].append((checkin, checkout))
+            bookings.append(cls(user_id=user_id,
+                                listing_id=listing_id,
+                                checkin_date=checkin,
+                                checkout_date=checkout))
+
+        created = [booking for booking in bookings
+                   if isinstance(booking, Booking)]
+        db.session.add_all(created)
+        try:
+            db.session.flush()
+        except IntegrityError as e:
+            db.session.rollback()
+            if getattr(e.orig, "pgcode", None) == EXCLUSION_VIOLATION:
+                raise BookingConflictError() from e
+            raise
+        for booking in created:
+            db.session.expunge(booking)
+        db.session.commit()
+
+        return bookings
+
     def serialize(self):
         """Serialize booking to a dict of booking info."""
 
@@ -71,10 +303,33 @@ class Booking(db.Model):
         }
 
 
+# No two bookings for a listing may overlap. The constraint's GiST index
+# also serves overlap queries; btree_gist lets the plain integer
+# listing_id share it with the stay range.
+BOOKING_STAY_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS btree_gist",
+    "ALTER TABLE bookings ADD CONSTRAINT bookings_no_overlap "
+    "EXCLUDE USING gist "
+    "(listing_id WITH =, tsrange(checkin_date, checkout_date) WITH &&)",
+]
+
+for statement in BOOKING_STAY_DDL:
+    event.listen(Booking.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+
 class Listing(db.Model):
     """Connection of a user -> listing."""
 
     __tablename__ = 'listings'
+    __table_args__ = (
+        # serves price range filters and keyset pages ordered by price,
+        # in either direction
+        db.Index('ix_listings_price_id', 'price', 'id'),
+        db.Index('ix_listings_user_id', 'user_id'),
+    )
+
+    SORTS = ("id", "-id", "price", "-price")
 
     id = db.Column(
         db.Integer,
@@ -95,7 +350,20 @@ class Listing(db.Model):
 
     photo = db.Column(
         db.Text,
-        default=DEFAULT_IMAGE_URL
+        default=default_image_url
+    )
+
+    # resized copies of photo: {variant: {format: url}}, see images.py
+    photo_variants = db.Column(
+        db.JSON
+    )
+
+    # "ready", or "pending"/"failed" while an UploadJob owns the photo
+    photo_status = db.Column(
+        db.Text,
+        nullable=False,
+        default="ready",
+        server_default="ready"
     )
 
     price = db.Column(
@@ -107,37 +375,193 @@ class Listing(db.Model):
         db.Text
     )
 
+    # bumped on every change; see _track_listing_changes
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1"
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.now()
+    )
+
+    @classmethod
+    def filtered(cls, min_price=None, max_price=None, available=None,
+                 columns=None):
+        """Return a listings query narrowed to the given price range.
+
+        `available` is an optional (checkin_date, checkout_date) pair; only
+        listings with no booking overlapping that stay are kept. With
+        `columns` the query yields those columns as tuples instead of
+        Listing instances.
+        """
+
+        query = cls.query
+        if columns is not None:
+            query = query.with_entities(*columns)
+
+        if min_price is not None:
+            query = query.filter(cls.price >= min_price)
+        if max_price is not None:
+            query = query.filter(cls.price <= max_price)
+        if available is not None:
+            booked = db.session.query(Booking.id)\
+                .filter(Booking.listing_id == cls.id,
+                        Booking.overlaps(*available))
+            query = query.filter(~booked.exists())
+
+        return query
+
+    @classmethod
+    def browse(cls, sort="id", min_price=None, max_price=None,
+               available=None, after=None, limit=20, columns=None):
+        """Return a page of listings in `sort` order.
+
+        `after` is the sort key of the last listing on the previous page
+        (as returned by this method), so each page is an index range scan
+        rather than an OFFSET over every earlier row. `columns` is as for
+        filtered(), and must include the sort columns.
+
+        Returns (listings, next_key); next_key is None on the last page.
+        """
+
+        descending = sort.startswith("-")
+        if sort.lstrip("-") == "price":
+            sort_columns = [cls.price, cls.id]
+        else:
+            sort_columns = [cls.id]
+
+        query = cls.filtered(min_price, max_price, available, columns)
+
+        if after is not None:
+            if len(after) != len(sort_columns):
+                raise ValueError("invalid cursor")
+            if len(sort_columns) == 2:
+                key = tuple_(*sort_columns)
+                bound = tuple_(Decimal(after[0]), int(after[1]))
+            else:
+                key = sort_columns[0]
+                bound = int(after[0])
+            query = query.filter(key < bound if descending else key > bound)
+
+        order = [c.desc() if descending else c.asc() for c in sort_columns]
+        listings = query.order_by(*order).limit(limit + 1).all()
+
+        next_key = None
+        if len(listings) > limit:
+            listings = listings[:limit]
+            last = listings[-1]
+            next_key = [getattr(last, c.key) for c in sort_columns]
+
+        return listings, next_key
+
+    @classmethod
+    def by_ids(cls, ids, min_price=None, max_price=None, available=None,
+               columns=None):
+        """Return the listings with these ids, in the order given, with
+        one IN query.
+
+        Ids with no listing (or filtered out) are left out. `columns` is
+        as for filtered(), and must include the id.
+        """
+
+        query = cls.filtered(min_price, max_price, available, columns)
+        found = {listing.id: listing
+                 for listing in query.filter(cls.id.in_(ids))}
+
+        return [found[id] for id in ids if id in found]
+
+    @classmethod
+    def search(cls, terms, min_price=None, max_price=None, available=None,
+               offset=0, limit=20, columns=None):
+        """Return a page of listings matching `terms`, best match first.
+
+        Matches against name and details using the text index for the
+        current database (see LISTING_SEARCH_DDL). Relevance isn't a
+        stable key, so pages are addressed by offset. `columns` is as for
+        filtered().
+
+        Returns (listings, next_offset); next_offset is None on the last
+        page.
+        """
+
+        query = cls.filtered(min_price, max_price, available, columns)
+        query, order = cls._matching(query, terms)
+
+        listings = query.order_by(*order)\
+                        .offset(offset).limit(limit + 1).all()
+
+        next_offset = None
+        if len(listings) > limit:
+            listings = listings[:limit]
+            next_offset = offset + limit
+
+        return listings, next_offset
+
+    @classmethod
+    def _matching(cls, query, terms):
+        """Narrow `query` to listings matching `terms`.
+
+        Returns (query, order), `order` being the columns to order by,
+        best match first.
+        """
+
+        if db.engine.dialect.name == "postgresql":
+            tsquery = func.websearch_to_tsquery("english", terms)
+            rank = (func.ts_rank(_search_vector(), tsquery) +
+                    func.similarity(cls.name, terms))
+            query = query.filter(_search_vector().op("@@")(tsquery) |
+                                 cls.name.ilike(f"%{_escape_like(terms)}%",
+                                                escape="\\"))
+            return query, [rank.desc(), cls.id]
+
+        fts = table("listings_fts", column("rowid"), column("rank"))
+        query = query.join(fts, fts.c.rowid == cls.id)\
+                     .filter(text("listings_fts MATCH :terms"))\
+                     .params(terms=_fts5_query(terms))
+        return query, [fts.c.rank, cls.id]
+
+    @classmethod
+    def price_counts(cls, terms=None, available=None):
+        """Return [(price, number of listings)] in price order.
+
+        One row per distinct price, so callers can count listings in any
+        price range without reading every listing. `terms` and
+        `available` filter as for search() and filtered().
+        """
+
+        query = cls.filtered(available=available,
+                             columns=[cls.price, func.count()])
+        if terms:
+            query, _ = cls._matching(query, terms)
+
+        return query.group_by(cls.price).order_by(cls.price).all()
+
     @classmethod
     def upload_file(cls, file_name, object_name=None):
-        """Upload a file to an S3 bucket
+        """Upload a file from uploads/ to photo storage
 
-        :param file_name: File to upload
-        :param bucket: Bucket to upload to
-        :param object_name: S3 object name. If not specified then file_name is used
-        :return: True if file was uploaded, else False
+        :param file_name: File to upload, relative to uploads/
+        :param object_name: Storage key. If not specified then file_name is used
+        :return: URL of the uploaded file, or False if the upload failed
         """
         mimetype = 'image/jpeg'
-        # If S3 object_name was not specified, use file_name
+        # If object_name was not specified, use file_name
         if object_name is None:
             object_name = os.path.basename(file_name)
 
-        # Upload the file
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
-        )
+        # Stream the file through the process-wide storage client
         try:
-            response = s3_client.upload_file(f"uploads/{file_name}",
-                                            AWS_BUCKET_NAME,
-                                            object_name,
-                                            ExtraArgs={
-                                                "ContentType": mimetype
-                                                    })
-        except ClientError as e:
+            with open(os.path.join("uploads", file_name), "rb") as f:
+                return storage.put(f, object_name, content_type=mimetype)
+        except StorageError as e:
             logging.error(e)
             return False
-        return f"https://{AWS_BUCKET_NAME}.s3.amazonaws.com/{file_name}"
 
     def serialize(self):
         """Serialize listing to a dict of listing info."""
@@ -147,21 +571,539 @@ class Listing(db.Model):
             "userId": self.user_id,
             "name": self.name,
             "photo": self.photo,
+            "photoVariants": self.photo_variants,
+            "photoStatus": self.photo_status,
             "price": self.price,
             "details": self.details,
         }
 
 
+# Listing.serialize, for column-tuple queries
+LISTING_JSON = RowSerializer(
+    id=Listing.id,
+    userId=Listing.user_id,
+    name=Listing.name,
+    photo=Listing.photo,
+    photoVariants=Listing.photo_variants,
+    photoStatus=Listing.photo_status,
+    price=Listing.price,
+    details=Listing.details,
+)
+
+
+def _search_vector():
+    """The tsvector searched by Listing.search on Postgres.
+
+    Must match the expression in ix_listings_search so the planner can
+    use the index.
+    """
+
+    document = (func.coalesce(Listing.name, "") + " " +
+                func.coalesce(Listing.details, ""))
+
+    return func.to_tsvector(literal_column("'english'"), document)
+
+
+def _escape_like(terms):
+    """Escape LIKE wildcards in user-supplied search terms."""
+
+    return (terms.replace("\\", "\\\\")
+                 .replace("%", "\\%")
+                 .replace("_", "\\_"))
+
+
+def _fts5_query(terms):
+    """Turn free text into an FTS5 query of quoted prefix terms."""
+
+    words = [w.replace('"', '""') for w in terms.split()]
+
+    return " ".join(f'"{w}"*' for w in words) or '""'
+
+
+# Text search indexes. Postgres indexes an expression, so it never goes
+# stale; the SQLite FTS5 table is external-content and kept in sync with
+# triggers.
+LISTING_SEARCH_DDL = {
+    "postgresql": [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX ix_listings_search ON listings USING gin "
+        "(to_tsvector('english', coalesce(name, '') || ' ' || "
+        "coalesce(details, '')))",
+        "CREATE INDEX ix_listings_name_trgm ON listings USING gin "
+        "(name gin_trgm_ops)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE listings_fts USING fts5"
+        "(name, details, content='listings', content_rowid='id')",
+        "CREATE TRIGGER listings_fts_ai AFTER INSERT ON listings BEGIN "
+        "INSERT INTO listings_fts(rowid, name, details) "
+        "VALUES (new.id, new.name, new.details); END",
+        "CREATE TRIGGER listings_fts_ad AFTER DELETE ON listings BEGIN "
+        "INSERT INTO listings_fts(listings_fts, rowid, name, details) "
+        "VALUES ('delete', old.id, old.name, old.details); END",
+        "CREATE TRIGGER listings_fts_au AFTER UPDATE ON listings BEGIN "
+        "INSERT INTO listings_fts(listings_fts, rowid, name, details) "
+        "VALUES ('delete', old.id, old.name, old.details); "
+        "INSERT INTO listings_fts(rowid, name, details) "
+        "VALUES (new.id, new.name, new.details); END",
+    ],
+}
+
+for dialect, statements in LISTING_SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Listing.__table__, "after_create",
+                     DDL(statement).execute_if(dialect=dialect))
+
+event.listen(Listing.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS listings_fts")
+             .execute_if(dialect="sqlite"))
+
+
+class CacheVersion(db.Model):
+    """A counter that changes whenever a cached collection does.
+
+    GET /api/listings uses the "listings" counter as its validator, so a
+    client revalidating it costs one primary key lookup instead of the
+    page query.
+    """
+
+    __tablename__ = 'cache_versions'
+
+    LISTINGS = "listings"
+
+    name = db.Column(
+        db.Text,
+        primary_key=True
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    updated_at = db.Column(
+        db.DateTime
+    )
+
+    @classmethod
+    def current(cls, name):
+        """Return (version, updated_at) for `name`; (0, None) if unset."""
+
+        row = db.session.query(cls.version, cls.updated_at)\
+            .filter_by(name=name)\
+            .first()
+
+        return tuple(row) if row else (0, None)
+
+    @classmethod
+    def bump(cls, connection, name):
+        """Increment `name` on `connection`, in its current transaction.
+
+        The row stays locked until that transaction ends, so concurrent
+        writers to the collection queue on it; keep counters for things
+        that change rarely.
+        """
+
+        connection.execute(
+            cls.__table__.update()
+                .where(cls.name == name)
+                .values(version=cls.version + 1,
+                        updated_at=datetime.utcnow()))
+
+
+event.listen(CacheVersion.__table__, "after_create",
+             DDL(f"INSERT INTO cache_versions (name, version) "
+                 f"VALUES ('{CacheVersion.LISTINGS}', 0)"))
+
+
+@event.listens_for(Session, "before_flush")
+def _track_listing_changes(session, flush_context, instances):
+    """Version listings as they are written.
+
+    Each changed listing gets a new version and updated_at (its ETag and
+    Last-Modified), and the listings collection counter is bumped in the
+    same transaction. Bulk query.update()/delete() skip the ORM flush, so
+    they don't bump anything.
+    """
+
+    changed = any(isinstance(obj, Listing)
+                  for obj in [*session.new, *session.deleted])
+
+    for obj in session.dirty:
+        if isinstance(obj, Listing) and session.is_modified(obj):
+            obj.version = Listing.version + 1
+            obj.updated_at = datetime.utcnow()
+            changed = True
+
+    if changed:
+        CacheVersion.bump(session.connection(), CacheVersion.LISTINGS)
+
+
+class ListingCalendar(db.Model):
+    """Which nights of a year a listing is booked, one bit per night.
+
+    Bit n of `nights` (least significant first) is the night starting on
+    day n of `year`, counting January 1 as 0; a stay books the nights
+    from its checkin date up to, not including, its checkout date. A
+    year is 46 bytes, so a calendar page reads one or two small rows
+    whatever the listing's booking history.
+
+    Rows are kept up to date as bookings are flushed (see
+    _track_booking_changes). Bulk inserts and query.delete() skip the
+    ORM, so call rebuild() after them.
+    """
+
+    __tablename__ = 'listing_calendars'
+
+    YEAR_BYTES = 46
+
+    listing_id = db.Column(
+        db.Integer,
+        db.ForeignKey('listings.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    year = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    nights = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    @staticmethod
+    def masks(checkin_date, checkout_date):
+        """Yield (year, bit mask) for the nights of a stay."""
+
+        first = _as_datetime(checkin_date).date()
+        end = _as_datetime(checkout_date).date()
+
+        while first < end:
+            year_start = date(first.year, 1, 1)
+            last = min(end, date(first.year + 1, 1, 1))
+            start_bit = (first - year_start).days
+            count = (last - first).days
+            yield first.year, ((1 << count) - 1) << start_bit
+            first = last
+
+    @classmethod
+    def apply(cls, connection, changes):
+        """Set and clear nights on `connection`, in its transaction.
+
+        `changes` maps (listing_id, year) to (bits to set, bits to
+        clear). Two statements however many rows change: on Postgres the
+        first creates missing rows and locks them all, so concurrent
+        bookings can't lose each other's bits.
+        """
+
+        table = cls.__table__
+        keys = sorted(changes)
+        empty = bytes(cls.YEAR_BYTES)
+
+        if connection.dialect.name == "postgresql":
+            insert = postgresql.insert(table).values(
+                [{"listing_id": listing_id, "year": year, "nights": empty}
+                 for listing_id, year in keys])
+            rows = connection.execute(insert.on_conflict_do_update(
+                index_elements=[table.c.listing_id, table.c.year],
+                set_={"nights": table.c.nights})
+                .returning(table.c.listing_id, table.c.year,
+                           table.c.nights))
+            dialect = postgresql
+        else:
+            rows = connection.execute(
+                select(table.c.listing_id, table.c.year, table.c.nights)
+                .where(tuple_(table.c.listing_id, table.c.year).in_(keys)))
+            dialect = sqlite
+
+        current = {(row.listing_id, row.year): row.nights for row in rows}
+
+        values = []
+        for key in keys:
+            add, remove = changes[key]
+            bits = int.from_bytes(current.get(key, empty), "little")
+            bits = (bits | add) & ~remove
+            values.append({"listing_id": key[0], "year": key[1],
+                           "nights": bits.to_bytes(cls.YEAR_BYTES,
+                                                   "little")})
+
+        insert = dialect.insert(table)
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=[table.c.listing_id, table.c.year],
+            set_={"nights": insert.excluded.nights}), values)
+
+    @classmethod
+    def booked(cls, listing_id, start, end):
+        """Return "0"/"1" per night from `start` up to `end` (dates), "1"
+        where booked; None if there is no such listing.
+
+        One query: the listing joined to the calendar rows for the years
+        asked about.
+        """
+
+        rows = db.session.query(Listing.id, cls.year, cls.nights)\
+            .outerjoin(cls, (cls.listing_id == Listing.id) &
+                       cls.year.between(start.year, end.year))\
+            .filter(Listing.id == listing_id)\
+            .all()
+        if not rows:
+            return None
+
+        years = {year: int.from_bytes(nights, "little")
+                 for _, year, nights in rows if year is not None}
+
+        days = []
+        day = start
+        while day < end:
+            bits = years.get(day.year, 0)
+            night = (day - date(day.year, 1, 1)).days
+            days.append("1" if bits >> night & 1 else "0")
+            day += timedelta(days=1)
+
+        return "".join(days)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every calendar from the bookings table, in the
+        current transaction.
+
+        For bookings inserted in bulk (see loader.py), which bypass the
+        ORM, and for those made by a release without calendars (see
+        `python -m migrations rebuild-calendars`). Safe while the app
+        runs: bookings can't change until the transaction ends, so none
+        is lost between reading them and replacing the calendars.
+        """
+
+        if db.engine.dialect.name == "postgresql":
+            # calendars first: a booking's flush updates them before it
+            # writes the booking, so the other order could deadlock
+            db.session.execute(text(
+                "LOCK TABLE listing_calendars, bookings "
+                "IN SHARE ROW EXCLUSIVE MODE"))
+        else:
+            dbapi_connection = db.session.connection().connection
+            if not dbapi_connection.in_transaction:
+                dbapi_connection.execute("BEGIN IMMEDIATE")
+
+        calendars = defaultdict(int)
+        bookings = db.session.query(Booking.listing_id,
+                                    Booking.checkin_date,
+                                    Booking.checkout_date)\
+            .yield_per(10_000)
+        for listing_id, checkin_date, checkout_date in bookings:
+            for year, mask in cls.masks(checkin_date, checkout_date):
+                calendars[listing_id, year] |= mask
+
+        db.session.execute(cls.__table__.delete())
+        rows = [{"listing_id": listing_id, "year": year,
+                 "nights": bits.to_bytes(cls.YEAR_BYTES, "little")}
+                for (listing_id, year), bits in calendars.items()]
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+
+
+def _as_datetime(value):
+    """Booking dates as assigned may still be ISO strings."""
+
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+@event.listens_for(Session, "before_flush")
+def _track_booking_changes(session, flush_context, instances):
+    """Book and free calendar nights as bookings are written."""
+
+    changes = defaultdict(lambda: [0, 0])
+
+    def mark(listing_id, checkin_date, checkout_date, slot):
+        for year, mask in ListingCalendar.masks(checkin_date, checkout_date):
+            changes[listing_id, year][slot] |= mask
+
+    for obj in session.new:
+        if isinstance(obj, Booking):
+            mark(obj.listing_id, obj.checkin_date, obj.checkout_date, 0)
+
+    for obj in session.deleted:
+        if isinstance(obj, Booking):
+            mark(obj.listing_id, obj.checkin_date, obj.checkout_date, 1)
+
+    for obj in session.dirty:
+        if isinstance(obj, Booking) and session.is_modified(obj):
+            state = inspect(obj)
+            old = [state.attrs[name].history.deleted or
+                   [getattr(obj, name)]
+                   for name in ("listing_id", "checkin_date",
+                                "checkout_date")]
+            mark(old[0][0], old[1][0], old[2][0], 1)
+            mark(obj.listing_id, obj.checkin_date, obj.checkout_date, 0)
+
+    if changes:
+        # a night freed and booked again in one flush stays booked
+        ListingCalendar.apply(session.connection(),
+                              {key: (add, remove & ~add)
+                               for key, (add, remove) in changes.items()})
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    """Nothing to do; listening with active_history loads the old value
+    before a set, so _track_booking_changes can free the old nights."""
+
+
+for _attribute in (Booking.listing_id, Booking.checkin_date,
+                   Booking.checkout_date):
+    event.listen(_attribute, "set", _keep_old_value, active_history=True)
+
+
+class UploadJob(db.Model):
+    """A listing photo waiting to be uploaded, bytes and all.
+
+    Rows are the durable queue for uploader.UploadWorker: a job is due
+    when run_at has passed, whether it is new, waiting to retry, or was
+    claimed by a worker that died before finishing. The photo is in the
+    row, so a worker on any host can run it.
+    """
+
+    __tablename__ = 'upload_jobs'
+    __table_args__ = (
+        db.Index('ix_upload_jobs_status_run_at', 'status', 'run_at'),
+        db.Index('ix_upload_jobs_listing_id', 'listing_id'),
+    )
+
+    PENDING = "pending"
+    RUNNING = "running"
+    FAILED = "failed"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+
+    listing_id = db.Column(
+        db.Integer,
+        db.ForeignKey('listings.id', ondelete="cascade"),
+        nullable=False
+    )
+
+    # the photo; deferred, so claiming a job doesn't fetch it. None only
+    # for jobs queued by releases that staged photos on local disk.
+    data = db.deferred(db.Column(
+        db.LargeBinary
+    ))
+
+    object_name = db.Column(
+        db.Text,
+        nullable=False
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default=PENDING
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow
+    )
+
+    last_error = db.Column(
+        db.Text
+    )
+
+    listing = db.relationship('Listing')
+
+    @classmethod
+    def claim_next(cls, lease):
+        """Claim the next due job for `lease` and commit; None if idle.
+
+        The claim is a conditional UPDATE, so two workers can't both take
+        a job (on Postgres, SKIP LOCKED also keeps them from queueing on
+        the same row). The lease pushes run_at forward: if the claimant
+        dies, the job comes due again once it runs out.
+        """
+
+        now = datetime.utcnow()
+        job = cls.query\
+            .filter(cls.status.in_([cls.PENDING, cls.RUNNING]),
+                    cls.run_at <= now)\
+            .order_by(cls.run_at)\
+            .with_for_update(skip_locked=True)\
+            .first()
+
+        if job is None:
+            db.session.commit()
+            return None
+
+        claimed = cls.query\
+            .filter_by(id=job.id, status=job.status, run_at=job.run_at)\
+            .update({"status": cls.RUNNING,
+                     "run_at": now + lease,
+                     "attempts": cls.attempts + 1},
+                    synchronize_session=False)
+        db.session.commit()
+
+        if not claimed:
+            return None
+
+        return job
+
+
+# session.info key for new messages to push once committed; see events.py
+MESSAGE_OUTBOX = "message_outbox"
+
+
+def conversation_key(user_id, other_user_id):
+    """The key shared by all messages between two users, either way.
+
+    Packs the ordered pair (lower id, higher id) into one integer.
+    """
+
+    low, high = sorted((user_id, other_user_id))
+
+    return (low << 32) | high
+
+
+def _message_conversation_key(context):
+    params = context.get_current_parameters()
+
+    return conversation_key(params["to_user_id"], params["from_user_id"])
+
+
 class Message(db.Model):
     """A message to another user."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # serves each page of a conversation's history
+        db.Index('ix_messages_conversation_id', 'conversation_key', 'id'),
+        db.Index('ix_messages_to_user_id', 'to_user_id'),
+        db.Index('ix_messages_from_user_id', 'from_user_id'),
+    )
 
     id = db.Column(
         db.Integer,
         primary_key=True,
     )
 
+    # see conversation_key(); filled in from the user ids on insert
+    conversation_key = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=_message_conversation_key,
+    )
+
     to_user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete='CASCADE'),
@@ -196,6 +1138,234 @@ class Message(db.Model):
             "timestamp": self.timestamp,
         }
 
+    @classmethod
+    def send(cls, from_user_id, to_user_id, text):
+        """Add a message and update both sides' conversation summaries.
+
+        Both go into the current transaction; the caller should commit.
+        Once it does, the message is pushed to open streams (events.py).
+        """
+
+        message = cls(to_user_id=to_user_id,
+                      from_user_id=from_user_id,
+                      text=text)
+        db.session.add(message)
+        db.session.flush()
+
+        Conversation.record(message)
+        db.session.info.setdefault(MESSAGE_OUTBOX, []).append(
+            message.serialize())
+        return message
+
+    @classmethod
+    def history(cls, user_id, other_user_id, before=None, after=None,
+                limit=50):
+        """Return a page of messages between two users, oldest first.
+
+        With no cursor this is the latest page. `before` pages back from
+        (and excluding) that message id, `after` forward. Rows are in the
+        shape of MESSAGE_JSON.
+
+        Returns (rows, has_more): whether there are more messages past
+        the page in the direction it was read.
+        """
+
+        query = db.session.query(*MESSAGE_JSON.columns)\
+            .filter(cls.conversation_key ==
+                    conversation_key(user_id, other_user_id))
+
+        if after is not None:
+            query = query.filter(cls.id > after).order_by(cls.id)
+        else:
+            if before is not None:
+                query = query.filter(cls.id < before)
+            query = query.order_by(cls.id.desc())
+
+        rows = query.limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        if after is None:
+            rows.reverse()
+
+        return rows, has_more
+
+
+class Conversation(db.Model):
+    """One user's side of a conversation with another user.
+
+    Each message updates two rows, the sender's and the recipient's, so
+    a user's inbox is one range scan of ix_conversations_user_recent,
+    most recent first.
+    """
+
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        db.Index('ix_conversations_user_recent',
+                 'user_id', 'last_message_id'),
+        db.Index('ix_conversations_other_user_id', 'other_user_id'),
+        db.Index('ix_conversations_last_message_id', 'last_message_id'),
+    )
+
+    SNIPPET_LENGTH = 80
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    other_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    last_message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    snippet = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    last_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # messages from other_user_id that user_id hasn't opened yet
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    @classmethod
+    def record(cls, message):
+        """Upsert both participants' rows for a flushed `message`.
+
+        Concurrent sends can commit out of order, so the summary only
+        moves forward to a higher message id; unread always counts up.
+        """
+
+        values = [{"user_id": message.to_user_id,
+                   "other_user_id": message.from_user_id,
+                   "unread": 1}]
+        if message.from_user_id != message.to_user_id:
+            values.append({"user_id": message.from_user_id,
+                           "other_user_id": message.to_user_id,
+                           "unread": 0})
+
+        for row in values:
+            row.update(last_message_id=message.id,
+                       snippet=message.text[:cls.SNIPPET_LENGTH],
+                       last_at=message.timestamp)
+
+        dialect = postgresql if db.engine.dialect.name == "postgresql" \
+            else sqlite
+        insert = dialect.insert(cls.__table__).values(values)
+        newer = insert.excluded.last_message_id > cls.last_message_id
+
+        def latest(name):
+            return case((newer, getattr(insert.excluded, name)),
+                        else_=getattr(cls, name))
+
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=[cls.user_id, cls.other_user_id],
+            set_={"last_message_id": latest("last_message_id"),
+                  "snippet": latest("snippet"),
+                  "last_at": latest("last_at"),
+                  "unread": cls.unread + insert.excluded.unread}))
+
+    @classmethod
+    def inbox(cls, user_id, before=None, limit=20):
+        """Return a page of `user_id`'s conversations, most recent first.
+
+        Rows are (Conversation columns..., other user's username), in the
+        shape of CONVERSATION_JSON. `before` is the last_message_id of the
+        last conversation on the previous page.
+
+        Returns (rows, next_key); next_key is None on the last page.
+        """
+
+        query = db.session.query(*CONVERSATION_JSON.columns)\
+            .join(User, User.id == cls.other_user_id)\
+            .filter(cls.user_id == user_id)
+
+        if before is not None:
+            query = query.filter(cls.last_message_id < before)
+
+        rows = query.order_by(cls.last_message_id.desc())\
+            .limit(limit + 1)\
+            .all()
+
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = rows[-1].last_message_id
+
+        return rows, next_key
+
+    @classmethod
+    def mark_read(cls, user_id, other_user_id):
+        """Zero `user_id`'s unread count with `other_user_id`."""
+
+        cls.query\
+            .filter_by(user_id=user_id, other_user_id=other_user_id)\
+            .filter(cls.unread > 0)\
+            .update({"unread": 0}, synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every summary from the messages table.
+
+        For messages inserted in bulk (see seed.py), which bypass send().
+        Unread counts start at zero.
+        """
+
+        sides = union_all(
+            select(Message.from_user_id.label("user_id"),
+                   Message.to_user_id.label("other_user_id"),
+                   Message.id),
+            select(Message.to_user_id,
+                   Message.from_user_id,
+                   Message.id),
+        ).subquery()
+
+        latest = select(sides.c.user_id,
+                        sides.c.other_user_id,
+                        func.max(sides.c.id).label("id"))\
+            .group_by(sides.c.user_id, sides.c.other_user_id)\
+            .subquery()
+
+        rows = select(latest.c.user_id,
+                      latest.c.other_user_id,
+                      Message.id,
+                      func.substr(Message.text, 1, cls.SNIPPET_LENGTH),
+                      Message.timestamp,
+                      literal(0))\
+            .join(Message, Message.id == latest.c.id)
+
+        db.session.execute(cls.__table__.delete())
+        db.session.execute(cls.__table__.insert().from_select(
+            ["user_id", "other_user_id", "last_message_id", "snippet",
+             "last_at", "unread"],
+            rows))
+
+
+# Message.serialize, for column-tuple queries
+MESSAGE_JSON = RowSerializer(
+    id=Message.id,
+    toUserId=Message.to_user_id,
+    fromUserId=Message.from_user_id,
+    text=Message.text,
+    timestamp=Message.timestamp,
+)
+
 
 class User(db.Model):
     """User in the system."""
@@ -259,7 +1429,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -282,13 +1452,18 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the stored hash used a different work factor than
+        BCRYPT_LOG_ROUNDS, it is rehashed; the caller should commit.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -307,6 +1482,38 @@ class User(db.Model):
 
 
 
+# a row of Conversation.inbox
+CONVERSATION_JSON = RowSerializer(
+    id=Conversation.other_user_id,
+    username=User.username,
+    lastMessageId=Conversation.last_message_id,
+    text=Conversation.snippet,
+    timestamp=Conversation.last_at,
+    unread=Conversation.unread,
+)
+
+
+@event.listens_for(Pool, "connect")
+def _remember_process(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(Pool, "checkout")
+def _refuse_inherited_connection(dbapi_connection, connection_record,
+                                 connection_proxy):
+    """Never use a connection opened before a fork (gunicorn --preload).
+
+    Parent and child would talk over the same socket. The pool discards
+    it, without closing it under the parent, and connects afresh.
+    """
+
+    if connection_record.info["pid"] != os.getpid():
+        connection_record.dbapi_connection = None
+        connection_proxy.dbapi_connection = None
+        raise DisconnectionError(
+            "connection belongs to another process; reconnecting")
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -315,4 +1522,7 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
+    hasher.init_app(app)
+    storage.init_app(app)
 
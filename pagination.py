@@ -0,0 +1,55 @@
+"""Helpers for keyset (cursor) pagination."""
+
+import base64
+import binascii
+import json
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(sort, key):
+    """Encode the sort key of the last row on a page as an opaque cursor.
+
+    `key` is a list of JSON-able values (Decimals are sent as strings).
+    """
+
+    payload = json.dumps({"s": sort, "k": key}, default=str)
+
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, sort):
+    """Decode a cursor made by `encode_cursor` and return its key.
+
+    Raises ValueError if the cursor is malformed or was made for a
+    different sort order.
+    """
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError("invalid cursor")
+
+    if not isinstance(payload, dict) or payload.get("s") != sort:
+        raise ValueError("cursor does not match sort")
+
+    key = payload.get("k")
+    if not isinstance(key, list):
+        raise ValueError("invalid cursor")
+
+    return key
+
+
+def parse_limit(raw, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Parse a `limit` query param, clamped to 1..maximum."""
+
+    if raw is None or raw == "":
+        return default
+
+    limit = int(raw)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+
+    return min(limit, maximum)
@@ -0,0 +1,125 @@
+"""Per-route limits on SQL statements, to catch N+1 queries early.
+
+Declare a route's budget under its route decorator:
+
+    @app.get('/api/listings/<int:listing_id>')
+    @query_budget(2)
+    def get_listing(listing_id): ...
+
+A request that runs more statements than its route's budget (counted by
+metrics.py) is then, depending on QUERY_BUDGET_MODE:
+
+- "raise": fails with QueryBudgetExceeded, listing the statements. The
+  default under TESTING, so route tests fail on a regression.
+- "warn": logs a warning with the statements. The default in debug mode.
+- "off": nothing, and statements aren't kept. The default otherwise.
+
+For tests of code outside a request, count_queries() collects the
+statements run inside a with block, and QueryBudgetMixin adds
+assertMaxQueries(n) to a TestCase.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request ran more SQL statements than its route allows."""
+
+
+def query_budget(statements):
+    """Allow the decorated view at most `statements` SQL statements."""
+
+    def decorate(view):
+        view.query_budget = statements
+        return view
+
+    return decorate
+
+
+def _describe(statements):
+    return "\n".join(f"  {n}. {' '.join(statement.split())}"
+                     for n, statement in enumerate(statements, 1))
+
+
+class QueryBudget:
+    """Checks each request against its view's declared budget."""
+
+    def init_app(self, app):
+        """Hook into requests; call after metrics.init_app."""
+
+        app.before_request(self._keep_statements)
+        app.after_request(self._check)
+
+    @staticmethod
+    def mode():
+        config = current_app.config
+        default = ("raise" if config.get('TESTING')
+                   else "warn" if current_app.debug
+                   else "off")
+        return config.get('QUERY_BUDGET_MODE') or default
+
+    def _keep_statements(self):
+        if metrics.current is not None and self.mode() != "off":
+            metrics.current.statements = []
+
+    def _check(self, response):
+        stats = metrics.current
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, "query_budget", None)
+
+        if (stats is None or stats.statements is None or budget is None or
+                stats.queries <= budget):
+            return response
+
+        message = (f"{request.method} {request.url_rule} ran "
+                   f"{stats.queries} SQL statements; its budget is "
+                   f"{budget}:\n{_describe(stats.statements)}")
+        if self.mode() == "raise":
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+        return response
+
+
+@contextmanager
+def count_queries():
+    """Collect the statements this thread runs inside the with block."""
+
+    statements = []
+    thread = threading.get_ident()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread:
+            statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+
+class QueryBudgetMixin:
+    """assertMaxQueries for TestCase classes."""
+
+    @contextmanager
+    def assertMaxQueries(self, n):
+        with count_queries() as statements:
+            yield statements
+
+        if len(statements) > n:
+            self.fail(f"{len(statements)} SQL statements, expected at most "
+                      f"{n}:\n{_describe(statements)}")
+
+
+budget = QueryBudget()
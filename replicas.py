@@ -0,0 +1,251 @@
+"""Read replica routing.
+
+Views marked @read_only, served for GET or HEAD, read from a replica
+engine picked round robin; everything else uses the primary:
+
+    @api.get('/api/listings/<int:listing_id>')
+    @read_only
+    @query_budget(1)
+    def get_listing(listing_id): ...
+
+Only mark views that don't write. If one does anyway, the session
+(models.RoutingSession) sends the write, and every statement after it,
+to the primary.
+
+Replication lags, so a user who has just written reads from the primary
+for REPLICA_STICKY_SECONDS (default 5) afterwards, so they see their own
+booking or message. Three signals say a user has just written; any one
+is enough:
+
+- a cookie set on the response to the write, which browsers send to any
+  worker;
+- this process's record of users (by token identity) who wrote, for
+  clients without cookies;
+- a token issued within the window, since signup and login hand one out.
+
+A background thread checks each replica every REPLICA_CHECK_INTERVAL
+seconds (default 10). Replicas that can't be reached, or (on Postgres)
+that lag by more than REPLICA_MAX_LAG seconds (default 30), get no reads
+until they pass a check. With no healthy replica, reads go to the
+primary. An interval of 0 starts no thread; call replicas.check()
+yourself.
+
+SQLALCHEMY_REPLICA_URIS lists the replicas; without any, this does
+nothing.
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+from flask import current_app, request
+from flask_jwt_extended import (
+    get_jwt, get_jwt_identity, verify_jwt_in_request)
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError
+from sqlalchemy import create_engine, event, text
+
+from cache import TTLCache
+from models import db, READ_REPLICA, SESSION_WROTE
+
+logger = logging.getLogger(__name__)
+
+# Cookie holding the time until which the client should read from the
+# primary
+STICKY_COOKIE = "primary_until"
+
+# Seconds a Postgres replica is behind; 0 if it has replayed everything
+# it received (otherwise an idle primary would look like growing lag)
+POSTGRES_LAG = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery()
+          OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+
+def read_only(view):
+    """Let the decorated view's GET/HEAD requests read from a replica."""
+
+    view.read_only = True
+    return view
+
+
+class Replica:
+    """One replica engine and what the last check found."""
+
+    def __init__(self, url, engine_options):
+        self.url = url
+        self.engine = create_engine(url, **engine_options)
+        self.healthy = True
+        self.lag = 0.0
+        event.listen(self.engine, "handle_error", self._on_error)
+
+    def check(self, max_lag):
+        """Connect and measure lag; update and return `healthy`."""
+
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == "postgresql":
+                    self.lag = float(connection.execute(POSTGRES_LAG)
+                                     .scalar() or 0)
+                else:
+                    connection.execute(text("SELECT 1"))
+                    self.lag = 0.0
+        except Exception as e:
+            if self.healthy:
+                logger.warning("replica %s is down: %s",
+                               self.engine.url, e)
+            self.healthy = False
+            return False
+
+        healthy = self.lag <= max_lag
+        if healthy != self.healthy:
+            logger.warning("replica %s is %s (lag %.1f s)", self.engine.url,
+                           "back" if healthy else "lagging", self.lag)
+        self.healthy = healthy
+        return healthy
+
+    def _on_error(self, context):
+        # a lost connection takes the replica out until the next check
+        if context.is_disconnect:
+            self.healthy = False
+
+
+class Replicas:
+    """Routes read-only requests to replicas; see the module docstring."""
+
+    def __init__(self):
+        self.replicas = []
+        self.sticky = 5.0
+        self.check_interval = 10.0
+        self.max_lag = 30.0
+        self._counter = itertools.count()
+        self._writers = TTLCache(ttl=self.sticky)
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read replica settings from config and hook into requests."""
+
+        self.sticky = app.config.get('REPLICA_STICKY_SECONDS', 5.0)
+        self.check_interval = app.config.get('REPLICA_CHECK_INTERVAL', 10.0)
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', 30.0)
+        self._writers = TTLCache(
+            maxsize=app.config.get('REPLICA_STICKY_USERS', 10_000),
+            ttl=self.sticky)
+        self.configure(app.config.get('SQLALCHEMY_REPLICA_URIS') or [],
+                       app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+
+        app.before_request(self._route_request)
+        app.after_request(self._remember_write)
+
+    def configure(self, urls, engine_options=None):
+        """Replace the replicas with engines for `urls`."""
+
+        for replica in self.replicas:
+            replica.engine.dispose()
+        self.replicas = [Replica(url, engine_options or {}) for url in urls]
+
+    def pick(self):
+        """The next healthy replica's engine, or None."""
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)].engine
+
+    def check(self):
+        """Check every replica now."""
+
+        for replica in self.replicas:
+            replica.check(self.max_lag)
+
+    def ensure_started(self):
+        """Start the health check thread once per process."""
+
+        if self._started or not self.replicas or not self.check_interval:
+            return
+
+        with self._start_lock:
+            if self._started:
+                return
+            threading.Thread(target=self._loop, name="replica-checks",
+                             daemon=True).start()
+            self._started = True
+
+    def _loop(self):
+        while True:
+            self.check()
+            time.sleep(self.check_interval)
+
+    def _route_request(self):
+        if not self.replicas:
+            return
+
+        session = db.session
+        session.info.pop(SESSION_WROTE, None)
+        session.info.pop(READ_REPLICA, None)
+
+        if request.method not in ("GET", "HEAD"):
+            return
+
+        view = current_app.view_functions.get(request.endpoint)
+        if not getattr(view, "read_only", False):
+            return
+
+        self.ensure_started()
+        if self._wrote_recently():
+            return
+
+        engine = self.pick()
+        if engine is not None:
+            session.info[READ_REPLICA] = engine
+
+    def _wrote_recently(self):
+        until = request.cookies.get(STICKY_COOKIE)
+        try:
+            if until and float(until) > time.time():
+                return True
+        except ValueError:
+            pass
+
+        claims = _claims()
+        if not claims:
+            return False
+        wrote_at = self._writers.get(get_jwt_identity(), 0)
+        started = max(wrote_at, claims.get("iat", 0))
+        return time.time() - started < self.sticky
+
+    def _remember_write(self, response):
+        if not (self.replicas and db.session.registry.has() and
+                db.session.info.get(SESSION_WROTE)):
+            return response
+
+        response.set_cookie(STICKY_COOKIE, f"{time.time() + self.sticky:.3f}",
+                            max_age=int(self.sticky) + 1, httponly=True,
+                            samesite="Lax")
+        if _claims():
+            self._writers.set(get_jwt_identity(), time.time())
+
+        return response
+
+
+def _claims():
+    """The request's verified token claims, or {} if it has none."""
+
+    try:
+        return get_jwt()
+    except RuntimeError:
+        pass
+
+    try:
+        verify_jwt_in_request(optional=True)
+    except (JWTExtendedException, PyJWTError):
+        return {}
+    return get_jwt()
+
+
+replicas = Replicas()
@@ -1,23 +1,18 @@
-"""Seed database with sample data from CSV Files."""
+"""Reset the database to the sample data in generator/.
 
-from csv import DictReader
-from app import db
-from models import User, Listing, Booking, Message
+To load other data, or without wiping what is there, use loader.py.
+"""
 
-db.drop_all()
-db.create_all()
+import migrations
+from app import create_app
+from loader import BulkLoader
+from models import db
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+app = create_app()
 
-with open('generator/listings.csv') as listings:
-    db.session.bulk_insert_mappings(Listing, DictReader(listings))
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+    migrations.stamp(db.engine)
 
-with open('generator/bookings.csv') as bookings:
-    db.session.bulk_insert_mappings(Booking, DictReader(bookings))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-
-db.session.commit()
+    BulkLoader(db.engine).load('generator', replace=True)
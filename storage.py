@@ -0,0 +1,206 @@
+"""Object storage for listing photos.
+
+Backends share one interface: put(stream, key, content_type) streams a
+file object into storage and returns its public URL. S3Storage keeps a
+single boto3 client (and so one connection pool) for the life of the
+process and uploads in multipart chunks above a size threshold;
+LocalStorage writes under a directory, for development, tests and
+offline benchmarks.
+"""
+
+import os
+import shutil
+import threading
+
+MB = 1024 * 1024
+
+
+class StorageError(Exception):
+    """An object could not be stored."""
+
+
+class LocalStorage:
+    """Stores objects as files under `root`."""
+
+    def __init__(self, root, base_url=None):
+        self.root = os.path.abspath(root)
+        self.base_url = (base_url or f"file://{self.root}").rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        """Filesystem path for `key`."""
+
+        return os.path.join(self.root, key)
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+    def put(self, stream, key, content_type=None):
+        """Copy `stream` to `key` in fixed-size chunks; return its URL.
+
+        Writes to a .part file and renames it into place, so readers
+        never see a half-written object.
+        """
+
+        path = self.path(key)
+        partial = f"{path}.part"
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(partial, "wb") as f:
+                shutil.copyfileobj(stream, f, MB)
+            os.replace(partial, path)
+        except OSError as e:
+            raise StorageError(str(e)) from e
+
+        return self.url(key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage:
+    """Stores objects in an S3 bucket through one shared client.
+
+    boto3 clients are thread-safe, so every thread in the process uses
+    the same one; creating it resolves credentials and builds a
+    connection pool, which used to happen on every upload.
+    """
+
+    def __init__(self, bucket, access_key=None, secret_key=None,
+                 max_connections=10, multipart_threshold=8 * MB,
+                 multipart_chunksize=8 * MB):
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.max_connections = max_connections
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self._client = None
+        self._transfer_config = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The process-wide boto3 S3 client, created on first use."""
+
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    from boto3.s3.transfer import TransferConfig
+                    from botocore.config import Config
+
+                    self._transfer_config = TransferConfig(
+                        multipart_threshold=self.multipart_threshold,
+                        multipart_chunksize=self.multipart_chunksize,
+                        max_concurrency=self.max_connections)
+                    self._client = boto3.client(
+                        's3',
+                        aws_access_key_id=self.access_key,
+                        aws_secret_access_key=self.secret_key,
+                        config=Config(
+                            max_pool_connections=self.max_connections))
+
+        return self._client
+
+    def url(self, key):
+        return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+    def put(self, stream, key, content_type=None):
+        """Stream `stream` to `key`, multipart if large; return its URL."""
+
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        client = self.client
+        extra = {"ContentType": content_type} if content_type else {}
+
+        try:
+            client.upload_fileobj(stream, self.bucket, key,
+                                  ExtraArgs=extra,
+                                  Config=self._transfer_config)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError(str(e)) from e
+
+        return self.url(key)
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return False
+
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class Storage:
+    """Hands out the configured backend, one instance per process.
+
+    Config:
+    - STORAGE_BACKEND: "s3" (default) or "local"
+    - STORAGE_LOCAL_ROOT, STORAGE_BASE_URL: where the local backend
+      writes, and the URL prefix it reports
+    - AWS_BUCKET_NAME, AWS_ACCESS_KEY, AWS_SECRET_ACCESS_KEY,
+      STORAGE_MAX_CONNECTIONS: for S3
+
+    The backend is rebuilt if the process forks, so workers never share
+    a connection pool with their parent.
+    """
+
+    def __init__(self):
+        self.config = {}
+        self._backend = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.config = app.config
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None or self._pid != os.getpid():
+            with self._lock:
+                if self._backend is None or self._pid != os.getpid():
+                    self._backend = self._create()
+                    self._pid = os.getpid()
+
+        return self._backend
+
+    def _create(self):
+        config = self.config
+
+        if config.get('STORAGE_BACKEND', 's3') == 'local':
+            return LocalStorage(config.get('STORAGE_LOCAL_ROOT', 'media'),
+                                config.get('STORAGE_BASE_URL'))
+
+        return S3Storage(config['AWS_BUCKET_NAME'],
+                         config.get('AWS_ACCESS_KEY'),
+                         config.get('AWS_SECRET_ACCESS_KEY'),
+                         config.get('STORAGE_MAX_CONNECTIONS', 10))
+
+    def put(self, stream, key, content_type=None):
+        return self.backend.put(stream, key, content_type)
+
+    def url(self, key):
+        return self.backend.url(key)
+
+    def exists(self, key):
+        return self.backend.exists(key)
+
+    def delete(self, key):
+        return self.backend.delete(key)
+
+
+storage = Storage()
@@ -0,0 +1,300 @@
+"""Booking route tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_booking_routes.py
+
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, create_token
+from models import db, User, Listing, Booking, BookingConflictError
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+db.drop_all()
+db.create_all()
+
+
+class BookingRoutes(TestCase):
+    """Tests for POST /api/listings/<id>/book and POST /api/bookings."""
+
+    def setUp(self):
+        """Make a guest and two listings."""
+
+        Booking.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+
+        guest = User.signup("guest", "guest@email.com", "password",
+                            "Guest", "Person")
+        db.session.commit()
+
+        self.listings = []
+        for name in ["Cabin", "Yurt"]:
+            listing = Listing(user_id=guest.id, name=name, price=100)
+            db.session.add(listing)
+            db.session.commit()
+            self.listings.append(listing.id)
+
+        with app.app_context():
+            token = create_token(guest)
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def book(self, client, listing_id, checkin, checkout):
+        return client.post(f"/api/listings/{listing_id}/book",
+                           headers=self.headers,
+                           json={"checkin_date": checkin,
+                                 "checkout_date": checkout})
+
+    def test_book(self):
+        with app.test_client() as client:
+            resp = self.book(client, self.listings[0],
+                             "2022-10-26", "2022-10-31")
+
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(resp.json["booking"]["listingId"],
+                             self.listings[0])
+
+    def test_overlap_rejected(self):
+        with app.test_client() as client:
+            self.book(client, self.listings[0], "2022-10-26", "2022-10-31")
+
+            resp = self.book(client, self.listings[0],
+                             "2022-10-30", "2022-11-02")
+            self.assertEqual(resp.status_code, 409)
+
+            # back-to-back and other listings are fine
+            resp = self.book(client, self.listings[0],
+                             "2022-10-31", "2022-11-02")
+            self.assertEqual(resp.status_code, 201)
+            resp = self.book(client, self.listings[1],
+                             "2022-10-26", "2022-10-31")
+            self.assertEqual(resp.status_code, 201)
+
+    def test_bad_stay(self):
+        with app.test_client() as client:
+            resp = self.book(client, self.listings[0],
+                             "2022-10-31", "2022-10-26")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = self.book(client, 99999, "2022-10-26", "2022-10-31")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_checks_under_write_lock(self):
+        """On SQLite, even when the session has already read."""
+
+        if db.engine.dialect.name != "sqlite":
+            self.skipTest("SQLite's write lock")
+
+        listing = Listing.query.get(self.listings[0])
+        locked = []
+
+        def try_writing(conn, cursor, statement, *args):
+            if statement.startswith("SELECT bookings.id"):
+                other = sqlite3.connect(db.engine.url.database, timeout=0)
+                try:
+                    other.execute("BEGIN IMMEDIATE")
+                    locked.append(False)
+                except sqlite3.OperationalError:
+                    locked.append(True)
+                finally:
+                    other.close()
+
+        # a deferred transaction with a read in it: a shared lock only
+        db.session.connection().connection.execute("BEGIN")
+        Listing.query.all()
+
+        event.listen(db.engine, "before_cursor_execute", try_writing)
+        try:
+            Booking.book(listing.user_id, listing.id,
+                         datetime(2022, 10, 26), datetime(2022, 10, 31))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", try_writing)
+
+        self.assertEqual(locked, [True])
+
+    def test_concurrent_bookings(self):
+        """Hammer both listings with overlapping stays from many threads.
+
+        Every night can be won exactly once per listing, so there must be
+        no overlapping bookings and no lost non-overlapping ones.
+        """
+
+        # 20 nights per listing, each requested as 1-3 night stays by
+        # several clients at once
+        requests = []
+        for listing_id in self.listings:
+            for day in range(1, 21):
+                for nights in (1, 2, 3):
+                    checkout = min(day + nights, 21)
+                    requests.extend([(listing_id,
+                                      f"2022-11-{day:02}",
+                                      f"2022-11-{checkout:02}")] * 2)
+
+        def attempt(args):
+            with app.test_client() as client:
+                return self.book(client, *args).status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            statuses = list(pool.map(attempt, requests))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(set(statuses), {201, 409})
+
+        first = db.aliased(Booking)
+        second = db.aliased(Booking)
+        overlaps = db.session.query(first.id)\
+            .join(second, (first.listing_id == second.listing_id) &
+                          (first.id < second.id) &
+                          (first.checkin_date < second.checkout_date) &
+                          (first.checkout_date > second.checkin_date))\
+            .count()
+        self.assertEqual(overlaps, 0)
+        self.assertEqual(statuses.count(201), Booking.query.count())
+
+        print(f"\n{len(requests)} booking attempts in {elapsed:.2f}s "
+              f"({len(requests) / elapsed:.0f}/s), "
+              f"{statuses.count(201)} booked, {statuses.count(409)} rejected")
+
+    def book_many(self, client, stays):
+        return client.post("/api/bookings", headers=self.headers,
+                           json={"bookings": [
+                               {"listing_id": listing_id,
+                                "checkin_date": checkin,
+                                "checkout_date": checkout}
+                               for listing_id, checkin, checkout in stays]})
+
+    def test_book_many(self):
+        with app.test_client() as client:
+            resp = self.book_many(client, [
+                (self.listings[0], "2022-10-26", "2022-10-28"),
+                (self.listings[0], "2022-10-28", "2022-10-31"),
+                (self.listings[1], "2022-10-26", "2022-10-31"),
+            ])
+
+            self.assertEqual(resp.status_code, 201)
+            results = resp.json["results"]
+            self.assertEqual([r["status"] for r in results], [201] * 3)
+            self.assertEqual(results[2]["booking"]["listingId"],
+                             self.listings[1])
+            self.assertEqual(Booking.query.count(), 3)
+
+    def test_book_many_results_per_stay(self):
+        with app.test_client() as client:
+            self.book(client, self.listings[1], "2022-10-26", "2022-10-31")
+
+            resp = self.book_many(client, [
+                (self.listings[0], "2022-10-26", "2022-10-31"),
+                # overlaps the stay before it
+                (self.listings[0], "2022-10-30", "2022-11-02"),
+                (self.listings[0], "2022-11-02", "2022-11-01"),
+                (99999, "2022-10-26", "2022-10-31"),
+                # overlaps the booking above
+                (self.listings[1], "2022-10-30", "2022-11-02"),
+            ])
+
+            self.assertEqual(resp.status_code, 207)
+            self.assertEqual([r["status"] for r in resp.json["results"]],
+                             [201, 409, 400, 404, 409])
+            self.assertEqual(Booking.query.count(), 2)
+
+    def conflicting(self, times):
+        """Make Booking.book_many lose to a booking made without the
+        listing locks, `times` times."""
+
+        book_many = Booking.__dict__["book_many"]
+        self.addCleanup(setattr, Booking, "book_many", book_many)
+        self.attempts = 0
+
+        def attempt(user_id, stays):
+            self.attempts += 1
+            if self.attempts <= times:
+                raise BookingConflictError()
+            return book_many.__get__(None, Booking)(user_id, stays)
+
+        Booking.book_many = attempt
+
+    def test_book_many_retries_conflict(self):
+        self.conflicting(1)
+
+        with app.test_client() as client:
+            resp = self.book_many(client, [
+                (self.listings[0], "2022-10-26", "2022-10-28"),
+            ])
+
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(self.attempts, 2)
+            self.assertEqual(Booking.query.count(), 1)
+
+    def test_book_many_conflicts_per_stay(self):
+        self.conflicting(2)
+
+        with app.test_client() as client:
+            resp = self.book_many(client, [
+                (self.listings[0], "2022-10-26", "2022-10-28"),
+                (self.listings[0], "2022-11-02", "2022-11-01"),
+                (self.listings[1], "2022-10-26", "2022-10-28"),
+            ])
+
+            self.assertEqual(resp.status_code, 207)
+            self.assertEqual([r["status"] for r in resp.json["results"]],
+                             [409, 400, 409])
+            self.assertEqual(self.attempts, 2)
+
+    def test_book_many_bad_request(self):
+        with app.test_client() as client:
+            for body in [{}, {"bookings": []}, {"bookings": "all"},
+                         {"bookings": [{}] * 101}]:
+                resp = client.post("/api/bookings", headers=self.headers,
+                                   json=body)
+                self.assertEqual(resp.status_code, 400, body)
+
+    def test_concurrent_batches(self):
+        """Batches of overlapping stays on both listings, in parallel."""
+
+        batches = []
+        for day in range(1, 19):
+            for nights in (1, 2, 3):
+                batches.append([(listing_id,
+                                 f"2022-11-{day:02}",
+                                 f"2022-11-{day + nights:02}")
+                                for listing_id in self.listings])
+
+        def attempt(stays):
+            with app.test_client() as client:
+                return [r["status"] for r in
+                        self.book_many(client, stays).json["results"]]
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            statuses = [s for batch in pool.map(attempt, batches)
+                        for s in batch]
+
+        self.assertEqual(set(statuses), {201, 409})
+
+        first = db.aliased(Booking)
+        second = db.aliased(Booking)
+        overlaps = db.session.query(first.id)\
+            .join(second, (first.listing_id == second.listing_id) &
+                          (first.id < second.id) &
+                          (first.checkin_date < second.checkout_date) &
+                          (first.checkout_date > second.checkin_date))\
+            .count()
+        self.assertEqual(overlaps, 0)
+        self.assertEqual(statuses.count(201), Booking.query.count())
@@ -0,0 +1,99 @@
+"""Synthetic data generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+import csv
+import glob
+import os
+import tempfile
+from collections import defaultdict
+from unittest import TestCase
+
+from generator import Dataset, conversation_key, generate
+
+
+def read(out, table):
+    """All rows of `table` under `out`, in chunk order."""
+
+    rows = []
+    for path in sorted(glob.glob(os.path.join(out, table, "*.csv"))):
+        with open(path, newline="") as file:
+            rows.extend(csv.DictReader(file))
+    return rows
+
+
+class GeneratorTestCase(TestCase):
+    """A small dataset is consistent and reproducible."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dataset = Dataset(users=3000, listings=2500, bookings=20000,
+                              messages=12000, seed=7)
+        cls.out = tempfile.mkdtemp()
+        generate(cls.dataset, cls.out, chunk_size=5000, workers=2,
+                 log=lambda line: None)
+
+    def test_counts(self):
+        self.assertEqual(len(read(self.out, "users")), 3000)
+        self.assertEqual(len(read(self.out, "listings")), 2500)
+        self.assertEqual(len(read(self.out, "messages")), 12000)
+        self.assertGreater(len(read(self.out, "bookings")), 15000)
+
+    def test_same_output_any_chunking(self):
+        other = tempfile.mkdtemp()
+        generate(self.dataset, other, chunk_size=1000, workers=1,
+                 log=lambda line: None)
+
+        for table in ("users", "listings", "bookings", "messages"):
+            self.assertEqual(read(other, table), read(self.out, table))
+
+    def test_resumes(self):
+        totals = generate(self.dataset, self.out, chunk_size=5000,
+                          workers=1, log=lambda line: None)
+        self.assertEqual(sum(totals.values()), 0)
+
+        with self.assertRaises(ValueError):
+            generate(Dataset(1, 1, 1, 1), self.out)
+
+    def test_referential_consistency(self):
+        users = {int(row["id"]) for row in read(self.out, "users")}
+        hosts = {int(row["id"]): int(row["user_id"])
+                 for row in read(self.out, "listings")}
+        self.assertLessEqual(set(hosts.values()), users)
+
+        for row in read(self.out, "bookings"):
+            self.assertIn(int(row["user_id"]), users)
+            self.assertIn(int(row["listing_id"]), hosts)
+
+        for row in read(self.out, "messages"):
+            to_id, from_id = int(row["to_user_id"]), int(row["from_user_id"])
+            self.assertNotEqual(to_id, from_id)
+            self.assertLessEqual({to_id, from_id}, users)
+            self.assertEqual(int(row["conversation_key"]),
+                             conversation_key(to_id, from_id))
+
+    def test_bookings_dont_overlap(self):
+        stays = defaultdict(list)
+        for row in read(self.out, "bookings"):
+            self.assertLess(row["checkin_date"], row["checkout_date"])
+            self.assertLessEqual(row["booking_date"], row["checkin_date"])
+            stays[row["listing_id"]].append(
+                (row["checkin_date"], row["checkout_date"]))
+
+        for listing_stays in stays.values():
+            listing_stays.sort()
+            for (_, checkout), (checkin, _) in zip(listing_stays,
+                                                  listing_stays[1:]):
+                self.assertLessEqual(checkout, checkin)
+
+    def test_popularity_skewed(self):
+        per_listing = defaultdict(int)
+        for row in read(self.out, "bookings"):
+            per_listing[row["listing_id"]] += 1
+
+        # the busiest tenth of listings get well over a tenth of stays
+        counts = sorted(per_listing.values(), reverse=True)
+        top = sum(counts[:self.dataset.listings // 10])
+        self.assertGreater(top, sum(counts) * 0.25)
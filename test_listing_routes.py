@@ -1,7 +1,21 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
 from unittest import TestCase
 
-from app import app
-from models import db, User
+from app import app, create_token, upload_worker
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from facets import price_facets
+from storage import storage
+from uploader import PhotoTooLargeError, images, upload_photo
+from models import (
+    db, User, Listing, ListingCalendar, Booking, UploadJob,
+    default_image_url)
 
 # Use test database and don't clutter tests with SQL
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
@@ -10,6 +24,9 @@ app.config['SQLALCHEMY_ECHO'] = False
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
 
+# Run photo uploads by hand rather than on background threads
+app.config['UPLOAD_WORKER_THREADS'] = 0
+
 db.drop_all()
 db.create_all()
 
@@ -159,3 +176,793 @@ class UserRoutes(TestCase):
             resp = client.delete(url)
 
             self.assertEqual(resp.status_code, 404)
+
+
+class ListingBrowseRoutes(TestCase):
+    """Tests for paginated GET /api/listings."""
+
+    def setUp(self):
+        """Make an owner with listings at a spread of prices."""
+
+        Listing.query.delete()
+        User.query.delete()
+
+        owner = User.signup("owner", "owner@email.com", "password",
+                            "Owner", "Person")
+        db.session.commit()
+
+        for price in [300, 100, 200, 100, 500]:
+            db.session.add(Listing(user_id=owner.id,
+                                   name=f"Place {price}",
+                                   price=price,
+                                   details="somewhere"))
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def fetch_all_pages(self, client, **params):
+        """Follow nextCursor until the last page; return pages of prices."""
+
+        pages = []
+        cursor = None
+        while True:
+            query = dict(params)
+            if cursor:
+                query["cursor"] = cursor
+            resp = client.get("/api/listings", query_string=query)
+            self.assertEqual(resp.status_code, 200)
+            pages.append([float(l["price"]) for l in resp.json["listings"]])
+            cursor = resp.json["nextCursor"]
+            if not cursor:
+                return pages
+
+    def test_pages_by_price(self):
+        with app.test_client() as client:
+            pages = self.fetch_all_pages(client, sort="price", limit=2)
+
+            self.assertEqual(pages, [[100, 100], [200, 300], [500]])
+
+    def test_pages_by_price_descending(self):
+        with app.test_client() as client:
+            pages = self.fetch_all_pages(client, sort="-price", limit=3)
+
+            self.assertEqual(pages, [[500, 300, 200], [100, 100]])
+
+    def test_price_range(self):
+        with app.test_client() as client:
+            pages = self.fetch_all_pages(
+                client, sort="price", minPrice="150", maxPrice="300")
+
+            self.assertEqual(pages, [[200, 300]])
+
+    def test_default_sort_is_id(self):
+        with app.test_client() as client:
+            resp = client.get("/api/listings")
+            ids = [l["id"] for l in resp.json["listings"]]
+
+            self.assertEqual(ids, sorted(ids))
+            self.assertEqual(len(ids), 5)
+            self.assertIsNone(resp.json["nextCursor"])
+
+    def test_same_json_as_serialize(self):
+        with app.test_client() as client:
+            resp = client.get("/api/listings")
+
+            expected = [json.loads(json.dumps(l.serialize(), default=str))
+                        for l in Listing.query.order_by(Listing.id)]
+            self.assertEqual(resp.json["listings"], expected)
+
+    def test_cursor_from_other_sort(self):
+        with app.test_client() as client:
+            resp = client.get("/api/listings",
+                              query_string={"sort": "price", "limit": 1})
+            cursor = resp.json["nextCursor"]
+
+            resp = client.get("/api/listings",
+                              query_string={"sort": "id", "cursor": cursor})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_bad_params(self):
+        with app.test_client() as client:
+            for params in [{"sort": "name"},
+                           {"limit": "0"},
+                           {"minPrice": "cheap"},
+                           {"cursor": "not-a-cursor"}]:
+                resp = client.get("/api/listings", query_string=params)
+                self.assertEqual(resp.status_code, 400, params)
+
+    def test_ids(self):
+        ids = [l.id for l in Listing.query.order_by(Listing.price)]
+        wanted = [ids[3], 0, ids[0], ids[3]]
+
+        with app.test_client() as client:
+            resp = client.get("/api/listings", query_string={
+                "ids": ",".join(str(id) for id in wanted)})
+
+            self.assertEqual(resp.status_code, 200)
+            # in the order asked for, without repeats or missing ids
+            self.assertEqual([l["id"] for l in resp.json["listings"]],
+                             [ids[3], ids[0]])
+            self.assertIsNone(resp.json["nextCursor"])
+
+            resp = client.get("/api/listings", query_string={
+                "ids": ",".join(str(id) for id in ids), "maxPrice": "150"})
+            self.assertEqual([float(l["price"]) for l in
+                              resp.json["listings"]], [100, 100])
+
+    def test_bad_ids(self):
+        with app.test_client() as client:
+            for params in [{"ids": "1,two"},
+                           {"ids": ",".join(map(str, range(101)))},
+                           {"ids": "1", "q": "place"}]:
+                resp = client.get("/api/listings", query_string=params)
+                self.assertEqual(resp.status_code, 400, params)
+
+
+class ListingSearchRoutes(TestCase):
+    """Tests for GET /api/listings?q=..."""
+
+    def setUp(self):
+        """Make an owner with a few searchable listings."""
+
+        Listing.query.delete()
+        User.query.delete()
+
+        owner = User.signup("owner", "owner@email.com", "password",
+                            "Owner", "Person")
+        db.session.commit()
+
+        listings = [
+            ("Desert Oasis", 200, "rustic cabin with a pool"),
+            ("Oak Tree A-Frame", 345, "in a tree"),
+            ("Pool House", 150, "quiet backyard with a big pool"),
+            ("Schrute Farms", 1200, "beets"),
+        ]
+        for name, price, details in listings:
+            db.session.add(Listing(user_id=owner.id, name=name, price=price,
+                                   details=details))
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def search(self, client, **params):
+        resp = client.get("/api/listings", query_string=params)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json
+
+    def test_search_name_and_details(self):
+        with app.test_client() as client:
+            data = self.search(client, q="pool")
+            names = [l["name"] for l in data["listings"]]
+
+            # name match ranks above a details-only match
+            self.assertEqual(names, ["Pool House", "Desert Oasis"])
+
+    def test_search_name_alias(self):
+        with app.test_client() as client:
+            data = self.search(client, name="schrute")
+
+            self.assertEqual([l["name"] for l in data["listings"]],
+                             ["Schrute Farms"])
+
+    def test_search_partial_name(self):
+        with app.test_client() as client:
+            data = self.search(client, q="Oas")
+
+            self.assertEqual([l["name"] for l in data["listings"]],
+                             ["Desert Oasis"])
+
+    def test_search_with_price_filter(self):
+        with app.test_client() as client:
+            data = self.search(client, q="pool", maxPrice="180")
+
+            self.assertEqual([l["name"] for l in data["listings"]],
+                             ["Pool House"])
+
+    def test_search_pages(self):
+        with app.test_client() as client:
+            first = self.search(client, q="pool", limit=1)
+            second = self.search(client, q="pool", limit=1,
+                                 cursor=first["nextCursor"])
+
+            self.assertEqual(first["listings"][0]["name"], "Pool House")
+            self.assertEqual(second["listings"][0]["name"], "Desert Oasis")
+            self.assertIsNone(second["nextCursor"])
+
+
+class ListingFacetRoutes(TestCase):
+    """Tests for GET /api/listings/facets."""
+
+    def setUp(self):
+        """Make an owner with listings at a spread of prices."""
+
+        Booking.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+        # query.delete() doesn't bump the listings version
+        price_facets.clear()
+
+        owner = User.signup("owner", "owner@email.com", "password",
+                            "Owner", "Person")
+        db.session.commit()
+
+        for name, price in [("Pool House", 300), ("Yard", 100),
+                            ("Barn", 200), ("Shed", 100), ("Pool Villa", 500)]:
+            db.session.add(Listing(user_id=owner.id, name=name, price=price,
+                                   details="somewhere"))
+        db.session.commit()
+        self.owner_id = owner.id
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def facets(self, client, **params):
+        resp = client.get("/api/listings/facets", query_string=params)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json["facets"]
+
+    def test_histogram(self):
+        with app.test_client() as client:
+            facets = self.facets(client, buckets=4)
+
+        self.assertEqual(facets, {
+            "count": 5,
+            "price": {
+                "min": "100.00",
+                "max": "500.00",
+                "buckets": [
+                    {"min": "100.00", "max": "199.99", "count": 2},
+                    {"min": "200.00", "max": "299.99", "count": 1},
+                    {"min": "300.00", "max": "399.99", "count": 1},
+                    {"min": "400.00", "max": "500.00", "count": 1},
+                ],
+            },
+        })
+
+    def test_price_range_counts_but_keeps_histogram(self):
+        with app.test_client() as client:
+            facets = self.facets(client, minPrice="150", maxPrice="300")
+
+        self.assertEqual(facets["count"], 2)
+        self.assertEqual(sum(b["count"] for b in facets["price"]["buckets"]),
+                         5)
+
+    def test_search(self):
+        with app.test_client() as client:
+            facets = self.facets(client, q="pool", buckets=2)
+
+        self.assertEqual(facets["count"], 2)
+        self.assertEqual(facets["price"]["buckets"], [
+            {"min": "300.00", "max": "399.99", "count": 1},
+            {"min": "400.00", "max": "500.00", "count": 1},
+        ])
+
+    def test_stay(self):
+        shed = Listing.query.filter_by(name="Shed").one()
+        db.session.add(Booking(user_id=self.owner_id,
+                               listing_id=shed.id,
+                               checkin_date=datetime(2030, 1, 1),
+                               checkout_date=datetime(2030, 1, 3)))
+        db.session.commit()
+
+        with app.test_client() as client:
+            facets = self.facets(client, checkin_date="2030-01-02",
+                                 checkout_date="2030-01-04")
+
+        self.assertEqual(facets["count"], 4)
+
+    def test_follows_changes(self):
+        with app.test_client() as client:
+            self.assertEqual(self.facets(client)["count"], 5)
+
+            db.session.add(Listing(user_id=self.owner_id, name="Tent",
+                                   price=50))
+            db.session.commit()
+
+            facets = self.facets(client)
+            self.assertEqual(facets["count"], 6)
+            self.assertEqual(facets["price"]["min"], "50.00")
+
+    def test_no_listings(self):
+        Listing.query.delete()
+        db.session.commit()
+        price_facets.clear()
+
+        with app.test_client() as client:
+            self.assertEqual(self.facets(client), {
+                "count": 0,
+                "price": {"min": None, "max": None, "buckets": []},
+            })
+
+    def test_bad_params(self):
+        with app.test_client() as client:
+            for params in [{"buckets": "0"}, {"buckets": "101"},
+                           {"buckets": "ten"}, {"minPrice": "cheap"}]:
+                resp = client.get("/api/listings/facets",
+                                  query_string=params)
+                self.assertEqual(resp.status_code, 400, params)
+
+
+class ListingAvailabilityRoutes(TestCase):
+    """Tests for GET /api/listings?checkin_date=...&checkout_date=..."""
+
+    def setUp(self):
+        """Make two listings; book one of them for 10/26 - 10/31."""
+
+        Booking.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+
+        owner = User.signup("owner", "owner@email.com", "password",
+                            "Owner", "Person")
+        db.session.commit()
+
+        booked = Listing(user_id=owner.id, name="Booked", price=100)
+        free = Listing(user_id=owner.id, name="Free", price=100)
+        db.session.add_all([booked, free])
+        db.session.commit()
+
+        db.session.add(Booking(user_id=owner.id,
+                               listing_id=booked.id,
+                               checkin_date="2022-10-26",
+                               checkout_date="2022-10-31"))
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def available(self, client, checkin, checkout, **params):
+        resp = client.get("/api/listings", query_string={
+            "checkin_date": checkin, "checkout_date": checkout, **params})
+        self.assertEqual(resp.status_code, 200)
+        return [l["name"] for l in resp.json["listings"]]
+
+    def test_overlapping_stay(self):
+        with app.test_client() as client:
+            self.assertEqual(
+                self.available(client, "2022-10-30", "2022-11-02"), ["Free"])
+            self.assertEqual(
+                self.available(client, "2022-10-20", "2022-11-20"), ["Free"])
+
+    def test_adjacent_stays(self):
+        with app.test_client() as client:
+            self.assertEqual(
+                self.available(client, "2022-10-31", "2022-11-02"),
+                ["Booked", "Free"])
+            self.assertEqual(
+                self.available(client, "2022-10-20", "2022-10-26"),
+                ["Booked", "Free"])
+
+    def test_with_search(self):
+        with app.test_client() as client:
+            self.assertEqual(
+                self.available(client, "2022-10-27", "2022-10-28",
+                               q="booked"),
+                [])
+
+    def test_bad_stay(self):
+        with app.test_client() as client:
+            for params in [{"checkin_date": "2022-10-26"},
+                           {"checkin_date": "2022-10-26",
+                            "checkout_date": "2022-10-26"},
+                           {"checkin_date": "soon",
+                            "checkout_date": "2022-10-26"}]:
+                resp = client.get("/api/listings", query_string=params)
+                self.assertEqual(resp.status_code, 400, params)
+
+
+class ListingCalendarRoutes(TestCase):
+    """Tests for GET /api/listings/<id>/calendar."""
+
+    def setUp(self):
+        """Make a listing booked for the nights of 12/30 - 1/2."""
+
+        Booking.query.delete()
+        ListingCalendar.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+
+        owner = User.signup("owner", "owner@email.com", "password",
+                            "Owner", "Person")
+        db.session.commit()
+
+        listing = Listing(user_id=owner.id, name="Yard", price=100)
+        db.session.add(listing)
+        db.session.commit()
+        self.listing_id = listing.id
+        self.owner_id = owner.id
+
+        self.booking = Booking(user_id=owner.id,
+                               listing_id=listing.id,
+                               checkin_date=datetime(2022, 12, 30),
+                               checkout_date=datetime(2023, 1, 2))
+        db.session.add(self.booking)
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def booked(self, client, start, end):
+        resp = client.get(f"/api/listings/{self.listing_id}/calendar",
+                          query_string={"from": start, "to": end})
+        self.assertEqual(resp.status_code, 200)
+        return resp.json["calendar"]["booked"]
+
+    def test_across_years(self):
+        with app.test_client() as client:
+            self.assertEqual(self.booked(client, "2022-12-28", "2023-01-04"),
+                             "0011100")
+
+    def test_follows_bookings(self):
+        db.session.add(Booking(user_id=self.owner_id,
+                               listing_id=self.listing_id,
+                               checkin_date=datetime(2023, 1, 2),
+                               checkout_date=datetime(2023, 1, 3)))
+        db.session.delete(self.booking)
+        db.session.commit()
+
+        with app.test_client() as client:
+            self.assertEqual(self.booked(client, "2022-12-28", "2023-01-04"),
+                             "0000010")
+
+    def test_follows_moved_booking(self):
+        self.booking.checkin_date = datetime(2023, 1, 1)
+        db.session.commit()
+
+        with app.test_client() as client:
+            self.assertEqual(self.booked(client, "2022-12-28", "2023-01-04"),
+                             "0000100")
+
+    def test_rebuild(self):
+        with app.test_client() as client:
+            before = self.booked(client, "2022-12-01", "2023-02-01")
+            ListingCalendar.query.delete()
+            db.session.commit()
+            self.assertNotIn("1", self.booked(client, "2022-12-01",
+                                              "2023-02-01"))
+
+            ListingCalendar.rebuild()
+            db.session.commit()
+            self.assertEqual(self.booked(client, "2022-12-01", "2023-02-01"),
+                             before)
+
+    def test_rebuild_adds_missed_bookings(self):
+        # as the release before calendars would have made it
+        db.session.execute(Booking.__table__.insert().values(
+            user_id=self.owner_id, listing_id=self.listing_id,
+            checkin_date=datetime(2023, 1, 2),
+            checkout_date=datetime(2023, 1, 3)))
+        db.session.commit()
+
+        ListingCalendar.rebuild()
+        db.session.commit()
+
+        with app.test_client() as client:
+            self.assertEqual(self.booked(client, "2022-12-28", "2023-01-04"),
+                             "0011110")
+
+    def test_compact(self):
+        self.assertEqual(
+            [len(c.nights) for c in ListingCalendar.query], [46, 46])
+
+    def test_default_range(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/listings/{self.listing_id}/calendar")
+
+            self.assertEqual(len(resp.json["calendar"]["booked"]), 30)
+
+    def test_bad_params(self):
+        with app.test_client() as client:
+            for params in [{"from": "soon"},
+                           {"from": "2023-01-02", "to": "2023-01-01"},
+                           {"from": "2023-01-01", "to": "2024-06-01"}]:
+                resp = client.get(
+                    f"/api/listings/{self.listing_id}/calendar",
+                    query_string=params)
+                self.assertEqual(resp.status_code, 400, params)
+
+            resp = client.get("/api/listings/0/calendar")
+            self.assertEqual(resp.status_code, 404)
+
+
+class ListingPhotoUploadRoutes(TestCase):
+    """Tests for background photo uploads from POST /api/listings."""
+
+    def setUp(self):
+        """Make an owner; store photos in a temp dir instead of S3."""
+
+        UploadJob.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+
+        owner = User.signup("owner", "owner@email.com", "password",
+                            "Owner", "Person")
+        db.session.commit()
+
+        with app.app_context():
+            token = create_token(owner)
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+        self.bucket = tempfile.mkdtemp()
+        app.config['STORAGE_BACKEND'] = 'local'
+        app.config['STORAGE_LOCAL_ROOT'] = self.bucket
+        storage.init_app(app)
+
+        self.failures = 0
+        self.uploads = 0
+        upload_worker.upload = self.upload
+        upload_worker.process = images.process
+
+    def tearDown(self):
+        """Clean up fouled transactions and the fake bucket."""
+
+        db.session.rollback()
+        shutil.rmtree(self.bucket)
+        images.timeout = 60
+        app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
+
+    def upload(self, data, object_name):
+        """The real upload, failing on request."""
+
+        self.uploads += 1
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("storage unavailable")
+
+        return upload_photo(data, object_name)
+
+    def create_listing(self, client, color="red"):
+        return client.post("/api/listings", headers=self.headers, data={
+            "name": "Photo Place",
+            "price": "100",
+            "details": "nice",
+            "photo": (io.BytesIO(self.jpeg(color)), "mine.jpg"),
+        })
+
+    def jpeg(self, color):
+        """A 2000x1000 JPEG of a solid color."""
+
+        out = io.BytesIO()
+        Image.new("RGB", (2000, 1000), color).save(out, "JPEG")
+        return out.getvalue()
+
+    def test_returns_before_upload(self):
+        with app.test_client() as client:
+            resp = self.create_listing(client)
+
+            self.assertEqual(resp.status_code, 201)
+            listing = resp.json["listing"]
+            with app.app_context():
+                self.assertEqual(listing["photo"], default_image_url())
+            self.assertEqual(listing["photoStatus"], "pending")
+
+            # the job carries the photo, so any worker, anywhere, can run it
+            self.assertEqual(UploadJob.query.one().data, self.jpeg("red"))
+
+            self.assertEqual(upload_worker.run_pending(), 1)
+
+            resp = client.get(f"/api/listings/{listing['id']}")
+            object_name = f"{listing['id']}.jpg"
+            self.assertEqual(resp.json["listing"]["photoStatus"], "ready")
+            self.assertEqual(resp.json["listing"]["photo"],
+                             f"file://{self.bucket}/{object_name}")
+            with open(os.path.join(self.bucket, object_name), "rb") as f:
+                self.assertEqual(f.read(), self.jpeg("red"))
+            self.assertEqual(UploadJob.query.count(), 0)
+
+    def test_too_large(self):
+        app.config['MAX_CONTENT_LENGTH'] = 1000
+
+        with app.test_client() as client:
+            resp = self.create_listing(client)
+
+        self.assertEqual(resp.status_code, 413)
+        self.assertEqual(Listing.query.count(), 0)
+
+    def test_too_large_without_length(self):
+        # as a chunked request would get past Werkzeug's check
+        app.config['MAX_CONTENT_LENGTH'] = 1000
+        photo = FileStorage(io.BytesIO(self.jpeg("red")), "mine.jpg")
+
+        with self.assertRaises(PhotoTooLargeError):
+            upload_worker.enqueue(Listing(name="Big", price=100), photo,
+                                  "big.jpg")
+
+        self.assertEqual(photo.stream.tell(), 1001)
+
+    def test_retries_with_backoff(self):
+        self.failures = 1
+
+        with app.test_client() as client:
+            listing_id = self.create_listing(client).json["listing"]["id"]
+
+        upload_worker.run_pending()
+
+        job = UploadJob.query.one()
+        self.assertEqual(job.status, UploadJob.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # not due yet
+        self.assertEqual(upload_worker.run_pending(), 0)
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(upload_worker.run_pending(), 1)
+        self.assertEqual(Listing.query.get(listing_id).photo_status, "ready")
+
+    def test_gives_up(self):
+        self.failures = upload_worker.max_attempts
+
+        with app.test_client() as client:
+            listing_id = self.create_listing(client).json["listing"]["id"]
+
+        for _ in range(upload_worker.max_attempts):
+            UploadJob.query.update({"run_at": datetime.utcnow()})
+            db.session.commit()
+            upload_worker.run_pending()
+
+        self.assertEqual(UploadJob.query.one().status, UploadJob.FAILED)
+        self.assertEqual(Listing.query.get(listing_id).photo_status, "failed")
+
+    def test_variants(self):
+        with app.test_client() as client:
+            listing_id = self.create_listing(client).json["listing"]["id"]
+            upload_worker.run_pending()
+
+            resp = client.get(f"/api/listings/{listing_id}")
+            variants = resp.json["listing"]["photoVariants"]
+
+        self.assertEqual(set(variants), {"thumb", "card", "full"})
+        for variant, edge in [("thumb", 320), ("card", 640), ("full", 1600)]:
+            self.assertEqual(set(variants[variant]), {"jpeg", "webp"})
+            for fmt, url in variants[variant].items():
+                with Image.open(url.removeprefix("file://")) as image:
+                    self.assertEqual(image.size, (edge, edge // 2))
+                    self.assertEqual(image.format, fmt.upper())
+
+    def test_variants_fail(self):
+        def process(data):
+            raise OSError("cannot identify image file")
+
+        upload_worker.process = process
+
+        with app.test_client() as client:
+            listing_id = self.create_listing(client).json["listing"]["id"]
+
+        with self.assertLogs("uploader", "ERROR"):
+            self.assertEqual(upload_worker.run_pending(), 1)
+
+        # the uploaded original stands, and isn't uploaded again
+        listing = Listing.query.get(listing_id)
+        self.assertEqual(listing.photo_status, "ready")
+        self.assertEqual(listing.photo,
+                         f"file://{self.bucket}/{listing_id}.jpg")
+        self.assertIsNone(listing.photo_variants)
+        self.assertEqual(UploadJob.query.count(), 0)
+        self.assertEqual(self.uploads, 1)
+
+    def test_variants_time_out(self):
+        images.timeout = 0.001
+
+        with app.test_client() as client:
+            listing_id = self.create_listing(client).json["listing"]["id"]
+
+        with self.assertLogs("uploader", "ERROR"):
+            upload_worker.run_pending()
+
+        listing = Listing.query.get(listing_id)
+        self.assertEqual(listing.photo_status, "ready")
+        self.assertIsNone(listing.photo_variants)
+
+    def test_variants_deduplicated(self):
+        with app.test_client() as client:
+            first = self.create_listing(client).json["listing"]["id"]
+            second = self.create_listing(client).json["listing"]["id"]
+            other = self.create_listing(client, "blue").json["listing"]["id"]
+            upload_worker.run_pending()
+
+        variants = {l: Listing.query.get(l).photo_variants
+                    for l in (first, second, other)}
+        self.assertEqual(variants[first], variants[second])
+        self.assertNotEqual(variants[first], variants[other])
+        self.assertEqual(len(os.listdir(os.path.join(self.bucket, "photos"))),
+                         2)
+
+
+class ListingCachingRoutes(TestCase):
+    """Tests for ETags and conditional GETs on public listing reads."""
+
+    def setUp(self):
+        """Make an owner with one listing."""
+
+        Listing.query.delete()
+        User.query.delete()
+
+        owner = User.signup("owner", "owner@email.com", "password",
+                            "Owner", "Person")
+        db.session.commit()
+
+        listing = Listing(user_id=owner.id, name="Cabin", price=100)
+        db.session.add(listing)
+        db.session.commit()
+        self.listing_id = listing.id
+
+        with app.app_context():
+            token = create_token(owner)
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def test_listing_not_modified(self):
+        with app.test_client() as client:
+            url = f"/api/listings/{self.listing_id}"
+            resp = client.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.cache_control.public)
+            self.assertFalse(resp.cache_control.no_store)
+            self.assertIsNotNone(resp.last_modified)
+            etag = resp.headers["ETag"]
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers["ETag"], etag)
+
+            listing = Listing.query.get(self.listing_id)
+            listing.price = 150
+            db.session.commit()
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_browse_changes_on_create(self):
+        with app.test_client() as client:
+            etag = client.get("/api/listings").headers["ETag"]
+
+            resp = client.get("/api/listings",
+                              headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.post("/api/listings", headers=self.headers,
+                               data={"name": "Yurt", "price": "80"})
+            self.assertEqual(resp.status_code, 201)
+            self.assertTrue(resp.cache_control.no_store)
+
+            resp = client.get("/api/listings",
+                              headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.json["listings"]), 2)
+
+    def test_availability_not_cached(self):
+        with app.test_client() as client:
+            resp = client.get("/api/listings", query_string={
+                "checkin_date": "2022-10-26", "checkout_date": "2022-10-31"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("ETag", resp.headers)
+            self.assertTrue(resp.cache_control.no_store)
+
+    def test_authenticated_not_cached(self):
+        with app.test_client() as client:
+            resp = client.get("/api/users/owner", headers=self.headers)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.cache_control.no_store)
+            self.assertFalse(resp.cache_control.public)
@@ -0,0 +1,138 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from app import app
+from loader import BulkLoader, deferred_indexes, loaded_files
+from models import (
+    db, User, Listing, Booking, Message, Conversation, CacheVersion,
+    conversation_key)
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+db.drop_all()
+db.create_all()
+
+
+def quiet(line):
+    pass
+
+
+class BulkLoaderTestCase(TestCase):
+    """Loading CSV directories: sample data, resuming, replacing."""
+
+    def setUp(self):
+        self.loader = BulkLoader(db.engine, batch_size=100, log=quiet)
+        self.loader.load("generator", replace=True)
+        db.session.commit()
+
+        self.out = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def write(self, path, text):
+        path = os.path.join(self.out, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.write(text)
+
+    def test_sample(self):
+        self.assertEqual(User.query.count(), 300)
+        self.assertEqual(Listing.query.count(), 26)
+        self.assertEqual(Booking.query.count(), 3)
+
+        message = Message.query.order_by(Message.id).first()
+        self.assertEqual(message.conversation_key,
+                         conversation_key(message.to_user_id,
+                                          message.from_user_id))
+        self.assertEqual(Conversation.query.count(), 4)
+
+        # every deferred index came back
+        with db.engine.connect() as connection:
+            self.assertIsNone(
+                connection.execute(deferred_indexes.select()).first())
+        names = {i["name"] for i in inspect(db.engine).get_indexes("messages")}
+        self.assertIn("ix_messages_conversation_id", names)
+
+    def test_skips_loaded_files(self):
+        rows = self.loader.load("generator")
+
+        self.assertEqual(sum(rows.values()), 0)
+        self.assertEqual(User.query.count(), 300)
+
+    def test_incremental(self):
+        version, _ = CacheVersion.current(CacheVersion.LISTINGS)
+        self.write("listings/00000.csv",
+                   "id,user_id,name,price\n"
+                   "1000,1,Loaded Later,10\n")
+
+        rows = self.loader.load(self.out)
+
+        self.assertEqual(rows, {"listings": 1})
+        self.assertEqual(Listing.query.count(), 27)
+        self.assertEqual(Listing.query.get(1000).name, "Loaded Later")
+        self.assertEqual(CacheVersion.current(CacheVersion.LISTINGS)[0],
+                         version + 1)
+
+        # the id sequence moved past the loaded ids
+        listing = Listing(user_id=1, name="New", price=5)
+        db.session.add(listing)
+        db.session.commit()
+        self.assertGreater(listing.id, 1000)
+
+    def test_resumes(self):
+        self.write("messages/00000.csv",
+                   "to_user_id,from_user_id,text,timestamp\n"
+                   "1,2,first,2023-01-01\n")
+        self.write("messages/00001.csv",
+                   "to_user_id,from_user_id,text,timestamp\n"
+                   "2,1,second,not a date\n")
+
+        loader = BulkLoader(db.engine, defer_indexes=True, log=quiet)
+        with self.assertRaises(Exception):
+            loader.load(self.out)
+        db.session.rollback()
+
+        # the first file stuck; the table is still without its indexes
+        self.assertEqual(Message.query.count(), 8)
+        with db.engine.connect() as connection:
+            self.assertTrue(connection.execute(
+                deferred_indexes.select()
+                .where(deferred_indexes.c.table_name == "messages")).first())
+
+        self.write("messages/00001.csv",
+                   "to_user_id,from_user_id,text,timestamp\n"
+                   "2,1,second,2023-01-02\n")
+        rows = loader.load(self.out)
+
+        self.assertEqual(rows, {"messages": 1})
+        self.assertEqual(Message.query.count(), 9)
+        with db.engine.connect() as connection:
+            self.assertIsNone(
+                connection.execute(deferred_indexes.select()).first())
+            loaded = connection.execute(
+                loaded_files.select()
+                .where(loaded_files.c.table_name == "messages")).all()
+        self.assertEqual(len(loaded), 3)
+
+    def test_rejects_unknown_columns(self):
+        self.write("users.csv", "username,nickname\nbob,bobby\n")
+
+        with self.assertRaises(ValueError):
+            self.loader.load(self.out)
@@ -0,0 +1,334 @@
+"""Message route tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_message_routes.py
+
+from unittest import TestCase
+
+import json
+
+from app import app, create_token
+from events import hub
+from models import db, User, Message, Conversation
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+# Push new messages within this process only
+app.config['MESSAGE_BROKER'] = 'local'
+
+db.drop_all()
+db.create_all()
+
+
+class InboxRoutes(TestCase):
+    """Tests for GET /api/messages and its conversation summaries."""
+
+    def setUp(self):
+        """Make three users, with a token each."""
+
+        Conversation.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.ids = {}
+        self.headers = {}
+        for name in ["alice", "bob", "carol"]:
+            user = User.signup(name, f"{name}@email.com", "password",
+                               name.title(), "Person")
+            db.session.commit()
+            self.ids[name] = user.id
+            with app.app_context():
+                token = create_token(user)
+            self.headers[name] = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def send(self, client, sender, recipient, text):
+        resp = client.post(f"/api/messages/{self.ids[recipient]}",
+                           headers=self.headers[sender],
+                           json={"text": text})
+        self.assertEqual(resp.status_code, 201)
+
+    def inbox(self, client, user, **params):
+        resp = client.get("/api/messages", headers=self.headers[user],
+                          query_string=params)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json
+
+    def test_summaries(self):
+        with app.test_client() as client:
+            self.send(client, "alice", "bob", "hi bob")
+            self.send(client, "bob", "alice", "hi alice")
+            self.send(client, "alice", "bob", "x" * 140)
+            self.send(client, "carol", "alice", "hello")
+
+            convos = self.inbox(client, "alice")["conversations"]
+            self.assertEqual([c["username"] for c in convos],
+                             ["carol", "bob"])
+            self.assertEqual(convos[1]["text"],
+                             "x" * Conversation.SNIPPET_LENGTH)
+            self.assertEqual([c["unread"] for c in convos], [1, 1])
+
+            convos = self.inbox(client, "bob")["conversations"]
+            self.assertEqual(len(convos), 1)
+            self.assertEqual(convos[0]["id"], self.ids["alice"])
+            self.assertEqual(convos[0]["unread"], 2)
+
+    def test_open_marks_read(self):
+        with app.test_client() as client:
+            self.send(client, "alice", "bob", "one")
+            self.send(client, "alice", "bob", "two")
+
+            client.get(f"/api/messages/{self.ids['alice']}",
+                       headers=self.headers["bob"])
+
+            convos = self.inbox(client, "bob")["conversations"]
+            self.assertEqual(convos[0]["unread"], 0)
+
+    def test_pages(self):
+        with app.test_client() as client:
+            for name in ["bob", "carol", "bob"]:
+                self.send(client, name, "alice", f"from {name}")
+
+            first = self.inbox(client, "alice", limit=1)
+            second = self.inbox(client, "alice", limit=1,
+                                cursor=first["nextCursor"])
+
+            self.assertEqual(first["conversations"][0]["username"], "bob")
+            self.assertEqual(second["conversations"][0]["username"], "carol")
+            self.assertIsNone(second["nextCursor"])
+
+    def test_rebuild(self):
+        with app.test_client() as client:
+            self.send(client, "alice", "bob", "one")
+            self.send(client, "carol", "alice", "two")
+
+            expected = self.inbox(client, "alice")["conversations"]
+
+            Conversation.rebuild()
+            db.session.commit()
+
+            rebuilt = self.inbox(client, "alice")["conversations"]
+            for convo in expected:
+                convo["unread"] = 0
+            self.assertEqual(rebuilt, expected)
+
+
+class ConversationHistoryRoutes(TestCase):
+    """Tests for paging GET /api/messages/<user_id>."""
+
+    def setUp(self):
+        """Make alice and bob, with ten messages between them."""
+
+        Conversation.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        alice = User.signup("alice", "alice@email.com", "password",
+                            "Alice", "Person")
+        bob = User.signup("bob", "bob@email.com", "password",
+                          "Bob", "Person")
+        db.session.commit()
+        self.bob_id = bob.id
+
+        self.texts = []
+        for n in range(10):
+            sender, recipient = (alice, bob) if n % 2 else (bob, alice)
+            Message.send(sender.id, recipient.id, f"message {n}")
+            self.texts.append(f"message {n}")
+        db.session.commit()
+
+        with app.app_context():
+            token = create_token(alice)
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def history(self, client, **params):
+        resp = client.get(f"/api/messages/{self.bob_id}",
+                          headers=self.headers, query_string=params)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json
+
+    def test_latest_page(self):
+        with app.test_client() as client:
+            data = self.history(client, limit=4)
+
+            self.assertEqual([m["text"] for m in data["messages"]],
+                             self.texts[6:])
+            self.assertTrue(data["hasMore"])
+
+    def test_page_back_and_forward(self):
+        with app.test_client() as client:
+            pages = []
+            data = self.history(client, limit=4)
+            pages.append(data["messages"])
+            while data["hasMore"]:
+                data = self.history(client, limit=4,
+                                    before=pages[0][0]["id"])
+                pages.insert(0, data["messages"])
+
+            self.assertEqual([len(p) for p in pages], [2, 4, 4])
+            self.assertEqual([m["text"] for p in pages for m in p],
+                             self.texts)
+
+            data = self.history(client, limit=4, after=pages[0][-1]["id"])
+            self.assertEqual(data["messages"], pages[1])
+            self.assertTrue(data["hasMore"])
+
+    def test_same_key_either_way(self):
+        keys = {m.conversation_key for m in Message.query}
+
+        self.assertEqual(len(keys), 1)
+
+    def test_bad_params(self):
+        with app.test_client() as client:
+            for params in [{"before": "soon"},
+                           {"limit": "0"},
+                           {"before": "5", "after": "2"}]:
+                resp = client.get(f"/api/messages/{self.bob_id}",
+                                  headers=self.headers, query_string=params)
+                self.assertEqual(resp.status_code, 400, params)
+
+
+class MessageStreamRoutes(TestCase):
+    """Tests for GET /api/messages/stream."""
+
+    def setUp(self):
+        """Make alice, bob and carol; idle streams send keepalives fast."""
+
+        Conversation.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.ids = {}
+        self.tokens = {}
+        for name in ["alice", "bob", "carol"]:
+            user = User.signup(name, f"{name}@email.com", "password",
+                               name.title(), "Person")
+            db.session.commit()
+            self.ids[name] = user.id
+            with app.app_context():
+                self.tokens[name] = create_token(user)
+
+        hub.keepalive = 0.05
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def open_stream(self, client, name):
+        resp = client.get("/api/messages/stream",
+                          query_string={"jwt": self.tokens[name]},
+                          buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+
+        events = iter(resp.response)
+        self.assertEqual(next(events), b"retry: 5000\n\n")
+        return resp, events
+
+    def next_message(self, events, tries=100):
+        """The data of the next message event, skipping keepalives."""
+
+        for _ in range(tries):
+            chunk = next(events).decode()
+            if chunk.startswith("id: "):
+                data = chunk.split("data: ", 1)[1]
+                return json.loads(data)
+
+        self.fail("no message event")
+
+    def test_push_to_both_sides(self):
+        with app.test_client() as client:
+            bob, bob_events = self.open_stream(client, "bob")
+            alice, alice_events = self.open_stream(client, "alice")
+            self.assertEqual(len(hub), 2)
+
+            resp = client.post(f"/api/messages/{self.ids['bob']}",
+                               headers={"Authorization":
+                                        f"Bearer {self.tokens['alice']}"},
+                               json={"text": "are you there?"})
+            self.assertEqual(resp.status_code, 201)
+
+            for events in (bob_events, alice_events):
+                message = self.next_message(events)
+                self.assertEqual(message["text"], "are you there?")
+                self.assertEqual(message["fromUserId"], self.ids["alice"])
+
+            bob.close()
+            alice.close()
+            self.assertEqual(len(hub), 0)
+
+    def test_not_pushed_to_others(self):
+        with app.test_client() as client:
+            carol, carol_events = self.open_stream(client, "carol")
+
+            Message.send(self.ids["alice"], self.ids["bob"], "private")
+            db.session.commit()
+            Message.send(self.ids["bob"], self.ids["carol"], "for carol")
+            db.session.commit()
+
+            self.assertEqual(self.next_message(carol_events)["text"],
+                             "for carol")
+            carol.close()
+
+    def test_rollback_not_pushed(self):
+        with app.test_client() as client:
+            bob, bob_events = self.open_stream(client, "bob")
+
+            Message.send(self.ids["alice"], self.ids["bob"], "oops")
+            db.session.rollback()
+            Message.send(self.ids["alice"], self.ids["bob"], "hello")
+            db.session.commit()
+
+            self.assertEqual(self.next_message(bob_events)["text"], "hello")
+            bob.close()
+
+    def test_unsent_stream_holds_no_slot(self):
+        with app.test_client() as client:
+            resp = client.get("/api/messages/stream",
+                              query_string={"jwt": self.tokens["bob"]},
+                              buffered=False)
+            resp.close()
+
+            resp = client.head("/api/messages/stream",
+                               query_string={"jwt": self.tokens["bob"]})
+            self.assertEqual(resp.status_code, 200)
+
+            self.assertEqual(len(hub), 0)
+
+    def test_full(self):
+        hub.max_subscribers = 1
+
+        try:
+            with app.test_client() as client:
+                bob, _ = self.open_stream(client, "bob")
+                resp = client.get("/api/messages/stream",
+                                  query_string={"jwt": self.tokens["alice"]})
+                self.assertEqual(resp.status_code, 503)
+
+                bob.close()
+                alice, _ = self.open_stream(client, "alice")
+                alice.close()
+        finally:
+            hub.max_subscribers = 16
+
+    def test_requires_token(self):
+        with app.test_client() as client:
+            resp = client.get("/api/messages/stream")
+
+            self.assertEqual(resp.status_code, 401)
@@ -0,0 +1,101 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+from unittest import TestCase
+
+from app import app
+from metrics import metrics
+from models import db, User, Listing
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+db.drop_all()
+db.create_all()
+
+
+class MetricsRoutes(TestCase):
+    """Per-request SQL stats and /metrics."""
+
+    def setUp(self):
+        Listing.query.delete()
+        User.query.delete()
+        user = User.signup("u1", "u1@email.com", "password", "First", "Last")
+        db.session.commit()
+        listing = Listing(user_id=user.id, name="Yard", price=100)
+        db.session.add(listing)
+        db.session.commit()
+        self.listing_id = listing.id
+
+    def tearDown(self):
+        db.session.rollback()
+        metrics.slow_query = 0.25
+        metrics.token = None
+
+    def test_server_timing(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/listings/{self.listing_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        timing = resp.headers["Server-Timing"]
+        self.assertTrue(timing.startswith("db;dur="))
+        self.assertNotIn('desc="0 queries"', timing)
+
+    def test_metrics(self):
+        with app.test_client() as client:
+            client.get(f"/api/listings/{self.listing_id}")
+            client.get("/api/listings/0")
+            resp = client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        text = resp.get_data(as_text=True)
+
+        # series are per route rule, not per listing id
+        self.assertIn('sharebnb_http_requests_total{method="GET",'
+                      'route="/api/listings/<int:listing_id>",status="200"}',
+                      text)
+        self.assertIn('route="/api/listings/<int:listing_id>",status="404"',
+                      text)
+        self.assertNotIn(f'/api/listings/{self.listing_id}"', text)
+        self.assertIn('sharebnb_http_request_duration_seconds_bucket{'
+                      'method="GET",route="/api/listings/<int:listing_id>",'
+                      'le="+Inf"}', text)
+        self.assertIn('sharebnb_db_queries_per_request_count{'
+                      'route="/api/listings/<int:listing_id>"}', text)
+        self.assertIn("sharebnb_db_slow_queries_total", text)
+
+    def test_failed_statement(self):
+        with db.engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.exec_driver_sql("SELECT * FROM no_such_table")
+            self.assertEqual(
+                connection.exec_driver_sql("SELECT 1").scalar(), 1)
+
+            # no start time left behind by the statement that failed
+            self.assertNotIn("query_start", connection.connection.info)
+
+    def test_slow_query_log(self):
+        metrics.slow_query = 1e-9
+
+        with self.assertLogs("metrics", "WARNING") as logs:
+            with app.test_client() as client:
+                client.get(f"/api/listings/{self.listing_id}")
+
+        self.assertIn("/api/listings/<int:listing_id>", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+    def test_token(self):
+        metrics.token = "secret"
+
+        with app.test_client() as client:
+            self.assertEqual(client.get("/metrics").status_code, 404)
+            resp = client.get("/metrics",
+                              headers={"Authorization": "Bearer secret"})
+            self.assertEqual(resp.status_code, 200)
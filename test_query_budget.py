@@ -0,0 +1,110 @@
+"""Query budget tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_budget.py
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app, create_token, user_cache
+from models import db, User, Listing, Booking
+from query_budget import QueryBudgetExceeded, QueryBudgetMixin
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+db.drop_all()
+db.create_all()
+
+
+class QueryBudgetRoutes(QueryBudgetMixin, TestCase):
+    """Routes stay within their budgets however much data they touch."""
+
+    def setUp(self):
+        user_cache.clear()
+        Booking.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+
+        user = User.signup("u1", "u1@email.com", "password", "First", "Last")
+        db.session.commit()
+
+        start = datetime(2023, 1, 1)
+        for n in range(20):
+            listing = Listing(user_id=user.id, name=f"Yard {n}", price=100)
+            db.session.add(listing)
+            db.session.flush()
+            db.session.add(Booking(user_id=user.id, listing_id=listing.id,
+                                   checkin_date=start + timedelta(days=n),
+                                   checkout_date=start + timedelta(days=n + 1)))
+        db.session.commit()
+
+        self.listing_id = listing.id
+        self.username = user.username
+        with app.app_context():
+            self.headers = {"Authorization": f"Bearer {create_token(user)}"}
+
+        self.view = app.view_functions["api.get_listing"]
+        self.budget = self.view.query_budget
+
+    def tearDown(self):
+        db.session.rollback()
+        self.view.query_budget = self.budget
+        app.config['QUERY_BUDGET_MODE'] = None
+
+    def test_over_budget_raises(self):
+        self.view.query_budget = 0
+
+        with app.test_client() as client:
+            with self.assertRaises(QueryBudgetExceeded) as raised:
+                client.get(f"/api/listings/{self.listing_id}")
+
+        self.assertIn("budget is 0", str(raised.exception))
+        self.assertIn("FROM listings", str(raised.exception))
+
+    def test_over_budget_warns(self):
+        self.view.query_budget = 0
+        app.config['QUERY_BUDGET_MODE'] = "warn"
+
+        with self.assertLogs("query_budget", "WARNING"):
+            with app.test_client() as client:
+                resp = client.get(f"/api/listings/{self.listing_id}")
+
+        self.assertEqual(resp.status_code, 200)
+
+    def test_off(self):
+        self.view.query_budget = 0
+        app.config['QUERY_BUDGET_MODE'] = "off"
+
+        with app.test_client() as client:
+            resp = client.get(f"/api/listings/{self.listing_id}")
+
+        self.assertEqual(resp.status_code, 200)
+
+    def test_user_routes_independent_of_rows(self):
+        with app.test_client() as client:
+            with self.assertMaxQueries(1):
+                client.get(f"/api/users/{self.username}",
+                           headers=self.headers)
+            with self.assertMaxQueries(2):
+                resp = client.get(f"/api/users/{self.username}/bookings",
+                                  headers=self.headers)
+
+        self.assertEqual(len(resp.json["bookings"]), 20)
+
+    def test_browse_independent_of_rows(self):
+        with app.test_client() as client:
+            with self.assertMaxQueries(2):
+                resp = client.get("/api/listings")
+
+        self.assertEqual(len(resp.json["listings"]), 20)
+
+    def test_assert_max_queries_fails(self):
+        with self.assertRaises(AssertionError):
+            with self.assertMaxQueries(0):
+                Listing.query.all()
@@ -0,0 +1,212 @@
+"""Query plan regression tests.
+
+Loads the test database with a realistic number of rows, calls the hot
+routes, and EXPLAINs every SELECT they ran: none may sequentially scan
+one of the big tables. Also checks every foreign key is indexed, since
+ON DELETE CASCADE searches for the referencing rows.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+import random
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event, inspect
+
+from app import app, create_token
+from models import (
+    db, User, Listing, Booking, Message, Conversation, conversation_key)
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+db.drop_all()
+db.create_all()
+
+USERS = 2_000
+LISTINGS = 20_000
+BOOKINGS_PER_LISTING = 3
+MESSAGES = 60_000
+
+BIG_TABLES = {"users", "listings", "bookings", "messages", "conversations"}
+
+
+@contextmanager
+def captured_selects():
+    """Collect (statement, parameters) for every SELECT sent to the DB."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+
+def seq_scans(plan):
+    """Names of big tables read by a Seq Scan anywhere in `plan`."""
+
+    found = set()
+    if (plan.get("Node Type") == "Seq Scan" and
+            plan.get("Relation Name") in BIG_TABLES):
+        found.add(plan["Relation Name"])
+
+    for child in plan.get("Plans", []):
+        found |= seq_scans(child)
+
+    return found
+
+
+class QueryPlans(TestCase):
+    """The hot routes' queries use indexes at realistic row counts."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Fill every table; deterministic, so plans are repeatable."""
+
+        Conversation.query.delete()
+        Message.query.delete()
+        Booking.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        rng = random.Random(0)
+        password = User.signup("owner", "owner@email.com", "password",
+                               "Owner", "Person").password
+        db.session.commit()
+
+        db.session.execute(User.__table__.insert(), [
+            {"username": f"user{n}", "email": f"user{n}@email.com",
+             "password": password, "first_name": "First",
+             "last_name": f"Last{n}"}
+            for n in range(USERS)])
+        user_ids = [id for (id,) in db.session.query(User.id)]
+
+        db.session.execute(Listing.__table__.insert(), [
+            {"user_id": rng.choice(user_ids),
+             "name": f"Backyard {n}",
+             "price": rng.randrange(20, 500),
+             "details": "a quiet yard with a fire pit",
+             "photo_status": "ready", "version": 1,
+             "updated_at": datetime.utcnow()}
+            for n in range(LISTINGS)])
+        db.session.execute(Listing.__table__.insert(), [
+            {"user_id": user_ids[0], "name": "Zanzibar Treehouse",
+             "price": 250, "photo_status": "ready", "version": 1,
+             "updated_at": datetime.utcnow()}])
+        listing_ids = [id for (id,) in db.session.query(Listing.id)]
+
+        start = datetime(2023, 1, 1)
+        db.session.execute(Booking.__table__.insert(), [
+            {"user_id": rng.choice(user_ids),
+             "listing_id": listing_id,
+             "checkin_date": start + timedelta(days=7 * week),
+             "checkout_date": start + timedelta(days=7 * week + 3),
+             "booking_date": start}
+            for listing_id in listing_ids
+            for week in range(BOOKINGS_PER_LISTING)])
+
+        messages = []
+        for n in range(MESSAGES):
+            sender, recipient = rng.sample(user_ids, 2)
+            messages.append({"from_user_id": sender,
+                             "to_user_id": recipient,
+                             "conversation_key":
+                                 conversation_key(sender, recipient),
+                             "text": f"message {n}",
+                             "timestamp": start})
+        db.session.execute(Message.__table__.insert(), messages)
+
+        Conversation.rebuild()
+        db.session.commit()
+
+        with db.engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT")\
+                .exec_driver_sql("ANALYZE")
+
+        user = User.query.filter_by(username="user0").one()
+        cls.user = (user.id, user.username)
+        cls.other_id = db.session.query(Conversation.other_user_id)\
+            .filter_by(user_id=user.id)\
+            .limit(1)\
+            .scalar()
+        cls.listing_id = listing_ids[len(listing_ids) // 2]
+
+        with app.app_context():
+            cls.headers = {
+                "Authorization": f"Bearer {create_token(user)}"}
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def assert_no_seq_scans(self, url, **params):
+        """GET `url` and check the plan of every SELECT it ran."""
+
+        with captured_selects() as statements:
+            with app.test_client() as client:
+                resp = client.get(url, headers=self.headers,
+                                  query_string=params)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(statements)
+
+        cursor = db.session.connection().connection.cursor()
+        for statement, parameters in statements:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+            plan = cursor.fetchone()[0][0]["Plan"]
+            self.assertEqual(seq_scans(plan), set(), statement)
+
+    def test_browse(self):
+        self.assert_no_seq_scans("/api/listings")
+        self.assert_no_seq_scans("/api/listings", sort="-price", limit=50)
+        self.assert_no_seq_scans("/api/listings", minPrice="100",
+                                 maxPrice="110", sort="price")
+
+    def test_browse_available(self):
+        self.assert_no_seq_scans("/api/listings",
+                                 checkin_date="2023-01-02",
+                                 checkout_date="2023-01-05")
+
+    def test_search(self):
+        self.assert_no_seq_scans("/api/listings", q="zanzibar")
+
+    def test_listing(self):
+        self.assert_no_seq_scans(f"/api/listings/{self.listing_id}")
+
+    def test_user_bookings(self):
+        self.assert_no_seq_scans(f"/api/users/{self.user[1]}/bookings")
+
+    def test_inbox(self):
+        self.assert_no_seq_scans("/api/messages")
+
+    def test_conversation(self):
+        self.assert_no_seq_scans(f"/api/messages/{self.other_id}")
+
+    def test_foreign_keys_indexed(self):
+        inspector = inspect(db.engine)
+
+        for table in db.metadata.sorted_tables:
+            leading = {tuple(index["column_names"][:1])
+                       for index in inspector.get_indexes(table.name)}
+            primary = inspector.get_pk_constraint(table.name)
+            leading.add(tuple(primary["constrained_columns"][:1]))
+
+            for fk in inspector.get_foreign_keys(table.name):
+                column = fk["constrained_columns"][0]
+                self.assertIn((column,), leading,
+                              f"{table.name}.{column} is not indexed")
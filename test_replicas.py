@@ -0,0 +1,192 @@
+"""Read replica routing tests.
+
+These need a second database standing in for the replica, e.g.
+
+    createdb sharebnb_test_replica
+
+Nothing replicates into it: the tests copy rows over and then change
+them, so each response shows which database served it.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+import time
+from datetime import datetime
+from unittest import TestCase
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import create_engine
+
+from app import app, create_token, user_cache
+from models import db, User, Listing, Booking
+from replicas import STICKY_COOKIE, replicas
+
+# Use test database and don't clutter tests with SQL
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///sharebnb_test'
+app.config['SQLALCHEMY_ECHO'] = False
+
+# Make Flask errors be real errors, rather than HTML pages with error info
+app.config['TESTING'] = True
+
+REPLICA_URI = 'postgresql:///sharebnb_test_replica'
+UNREACHABLE_URI = 'postgresql:///sharebnb_test_no_such_db'
+
+db.drop_all()
+db.create_all()
+
+replica = create_engine(REPLICA_URI)
+db.metadata.drop_all(replica)
+db.metadata.create_all(replica)
+
+TABLES = [User.__table__, Listing.__table__, Booking.__table__]
+
+
+class ReplicaRouting(TestCase):
+    """Read-only views read from the replica, unless the user just wrote."""
+
+    def setUp(self):
+        user_cache.clear()
+        Booking.query.delete()
+        Listing.query.delete()
+        User.query.delete()
+
+        user = User.signup("u1", "u1@email.com", "password", "First", "Last")
+        db.session.commit()
+        listing = Listing(user_id=user.id, name="Yard", price=100)
+        db.session.add(listing)
+        db.session.commit()
+
+        self.listing_id = listing.id
+        self.username = user.username
+
+        # "replicate", then make the replica's copy recognizable
+        with db.engine.connect() as source, replica.begin() as target:
+            for table in reversed(TABLES):
+                target.execute(table.delete())
+            for table in TABLES:
+                rows = [dict(row._mapping)
+                        for row in source.execute(table.select())]
+                if rows:
+                    target.execute(table.insert(), rows)
+            target.execute(Listing.__table__.update()
+                           .values(name="Replica yard"))
+
+        replicas.configure([REPLICA_URI])
+        replicas.check_interval = 0
+        replicas._writers.clear()
+
+        with app.app_context():
+            # issued a while ago, so not treated as a just-logged-in user
+            token = create_access_token(
+                identity=user.username,
+                additional_claims={"user_id": user.id,
+                                   "iat": int(time.time()) - 3600})
+            self.fresh_token = create_token(user)
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    def tearDown(self):
+        db.session.rollback()
+        replicas.configure([])
+
+    def listing_name(self, client):
+        return client.get(f"/api/listings/{self.listing_id}")\
+            .json["listing"]["name"]
+
+    def bookings(self, client, headers):
+        return client.get(f"/api/users/{self.username}/bookings",
+                          headers=headers).json["bookings"]
+
+    def book(self, client):
+        return client.post(f"/api/listings/{self.listing_id}/book",
+                           headers=self.headers,
+                           json={"checkin_date": "2030-01-01",
+                                 "checkout_date": "2030-01-03"})
+
+    def test_read_only_view_reads_replica(self):
+        with app.test_client() as client:
+            self.assertEqual(self.listing_name(client), "Replica yard")
+
+    def test_no_replicas(self):
+        replicas.configure([])
+
+        with app.test_client() as client:
+            self.assertEqual(self.listing_name(client), "Yard")
+
+    def test_writes_go_to_primary(self):
+        with app.test_client() as client:
+            resp = self.book(client)
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(Booking.query.count(), 1)
+        with replica.connect() as connection:
+            self.assertEqual(connection.execute(
+                Booking.__table__.select()).all(), [])
+
+    def test_reads_own_writes(self):
+        with app.test_client() as client:
+            resp = self.book(client)
+            self.assertEqual(resp.status_code, 201)
+
+            # the cookie sends the browser's next read to the primary
+            self.assertIn(STICKY_COOKIE, resp.headers["Set-Cookie"])
+            self.assertEqual(len(self.bookings(client, self.headers)), 1)
+
+        # and so does the token, without the cookie
+        with app.test_client() as client:
+            self.assertEqual(len(self.bookings(client, self.headers)), 1)
+
+            # other users still read from the replica
+            self.assertEqual(self.listing_name(client), "Replica yard")
+
+    def test_sticky_window_ends(self):
+        replicas.sticky = 0
+
+        try:
+            with app.test_client() as client:
+                self.book(client)
+                self.assertEqual(self.bookings(client, self.headers), [])
+        finally:
+            replicas.sticky = 5.0
+
+    def test_fresh_token_reads_primary(self):
+        Booking.query.delete()
+        db.session.add(Booking(user_id=User.query.one().id,
+                               listing_id=self.listing_id,
+                               checkin_date=datetime(2030, 1, 1),
+                               checkout_date=datetime(2030, 1, 3)))
+        db.session.commit()
+
+        headers = {"Authorization": f"Bearer {self.fresh_token}"}
+        with app.test_client() as client:
+            self.assertEqual(len(self.bookings(client, headers)), 1)
+            self.assertEqual(self.bookings(client, self.headers), [])
+
+    def test_round_robin(self):
+        replicas.configure([REPLICA_URI, REPLICA_URI])
+
+        engines = [replicas.pick() for _ in range(4)]
+
+        self.assertIsNot(engines[0], engines[1])
+        self.assertEqual(engines[:2], engines[2:])
+
+    def test_unhealthy_replica_skipped(self):
+        replicas.configure([UNREACHABLE_URI, REPLICA_URI])
+
+        with self.assertLogs("replicas", "WARNING"):
+            replicas.check()
+
+        self.assertEqual([r.healthy for r in replicas.replicas],
+                         [False, True])
+        self.assertEqual({replicas.pick() for _ in range(4)},
+                         {replicas.replicas[1].engine})
+
+    def test_no_healthy_replica_reads_primary(self):
+        replicas.configure([UNREACHABLE_URI])
+
+        with self.assertLogs("replicas", "WARNING"):
+            replicas.check()
+
+        with app.test_client() as client:
+            self.assertEqual(self.listing_name(client), "Yard")
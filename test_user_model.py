@@ -6,9 +6,13 @@
 
 
 import os
+import threading
 from unittest import TestCase
 
-from models import db, User
+import bcrypt as bcrypt_lib
+
+from hashing import HashingOverloadedError, PasswordHasher
+from models import db, User, bcrypt, hasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -71,3 +75,54 @@ class UserModelTestCase(TestCase):
 
     def test_wrong_password(self):
         self.assertFalse(User.authenticate("u1", "bad-password"))
+
+    def test_rehash_on_login(self):
+        u1 = User.query.get(self.u1_id)
+        u1.password = bcrypt_lib.hashpw(b"password",
+                                        bcrypt_lib.gensalt(4)).decode()
+        db.session.commit()
+
+        u = User.authenticate("u1", "password")
+        db.session.commit()
+
+        self.assertEqual(u, u1)
+        self.assertTrue(u1.password.startswith(f"$2b${hasher.log_rounds}$"))
+        self.assertFalse(hasher.needs_rehash(u1.password))
+
+    # #################### Hashing pool Tests
+
+    def test_hashing_overloaded(self):
+        pool = PasswordHasher(bcrypt, max_workers=1, max_pending=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            started.set()
+            release.wait()
+
+        busy = threading.Thread(target=pool._run, args=(hold,))
+        busy.start()
+        started.wait()
+
+        try:
+            with self.assertRaises(HashingOverloadedError):
+                pool.hash("password")
+        finally:
+            release.set()
+            busy.join()
+
+        self.assertTrue(pool.check(pool.hash("password"), "password"))
+
+    def test_reconfigure_stops_old_pool(self):
+        pool = PasswordHasher(bcrypt, max_workers=1, max_pending=1)
+        pool.hash("password")
+        old = pool._executor
+
+        pool.configure(1, 1)
+
+        with self.assertRaises(RuntimeError):
+            old.submit(print)
+        self.assertTrue(pool.check(pool.hash("password"), "password"))
+
+    def test_log_rounds_from_config(self):
+        self.assertEqual(hasher.log_rounds, app.config['BCRYPT_LOG_ROUNDS'])
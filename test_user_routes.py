@@ -1,8 +1,9 @@
 from unittest import TestCase
 
 import os
-from app import app
+from app import app, user_cache
 from models import db, User
+from flask_jwt_extended import create_access_token
 import jwt
 
 
@@ -145,3 +146,61 @@ class UserRoutes(TestCase):
     #         resp = client.delete(url)
 
     #         self.assertEqual(resp.status_code, 404)
+
+
+class UserTokenRoutes(TestCase):
+    """Tests for the identity carried in access tokens."""
+
+    def setUp(self):
+        """Make a user and clear the identity cache."""
+
+        User.query.delete()
+        user_cache.clear()
+
+        user = User.signup("tokenuser", "token@email.com", "password",
+                           "Token", "User")
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def test_login_token_has_user_id(self):
+        with app.test_client() as client:
+            resp = client.post("/api/login", json={"username": "tokenuser",
+                                                   "password": "password"})
+            token = resp.json["token"]
+
+            decode = jwt.decode(token, app.config['JWT_SECRET_KEY'],
+                                algorithms=["HS256"])
+            self.assertEqual(decode["sub"], "tokenuser")
+            self.assertEqual(decode["user_id"], self.user_id)
+
+    def test_token_without_user_id(self):
+        """Tokens issued before the user_id claim still work."""
+
+        with app.app_context():
+            token = create_access_token(identity="tokenuser")
+
+        with app.test_client() as client:
+            resp = client.get("/api/messages",
+                              headers={"Authorization": f"Bearer {token}"})
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_get_user_cached(self):
+        with app.app_context():
+            token = create_access_token(identity="tokenuser")
+        headers = {"Authorization": f"Bearer {token}"}
+
+        with app.test_client() as client:
+            for _ in range(2):
+                resp = client.get("/api/users/tokenuser", headers=headers)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json["user"]["id"], self.user_id)
+
+            self.assertEqual(len(user_cache), 1)
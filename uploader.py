@@ -0,0 +1,196 @@
+"""Background upload of listing photos.
+
+create_listing records an UploadJob holding the photo's bytes in the
+same transaction as the listing, then returns straight away. An
+UploadWorker in each app process picks due jobs up, uploads them, makes
+resized variants, and points the listing at the results. Failed jobs
+are retried with exponential backoff. The photo lives in the job's row,
+not on the disk of the process that took the request, so any process on
+any host can run the job, and a restart loses nothing.
+
+Photos are read whole, so their size is capped by MAX_CONTENT_LENGTH:
+a job row holds at most that much, however the request was sent.
+"""
+
+import io
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from images import ImageProcessor
+from models import db, UploadJob
+from storage import storage
+
+images = ImageProcessor(storage)
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoTooLargeError(Exception):
+    """An uploaded photo is bigger than MAX_CONTENT_LENGTH."""
+
+
+def upload_photo(data, object_name):
+    """Store a photo's bytes in photo storage and return its URL."""
+
+    return storage.put(io.BytesIO(data), object_name,
+                       content_type="image/jpeg")
+
+
+class UploadWorker:
+    """Threads that drain the upload_jobs table.
+
+    `upload(data, object_name)` does the actual upload and returns the
+    photo URL; `process(data)` makes resized variants and returns their
+    URLs (see images.py). Swap either for a stand-in in tests, or pass
+    process=None to skip variants. Threads start on the first request
+    (so each gunicorn worker gets its own, after any fork); with
+    UPLOAD_WORKER_THREADS = 0 nothing starts and jobs only run when
+    run_pending() is called.
+    """
+
+    def __init__(self, upload=upload_photo, process=images.process):
+        self.upload = upload
+        self.process = process
+        self.app = None
+        self._wake = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read worker settings from config and hook up lazy start."""
+
+        self.app = app
+        images.init_app(app)
+        self.max_attempts = app.config.get('UPLOAD_MAX_ATTEMPTS', 5)
+        self.retry_base = app.config.get('UPLOAD_RETRY_BASE', 2)
+        self.retry_max = app.config.get('UPLOAD_RETRY_MAX', 300)
+        self.lease = timedelta(seconds=app.config.get('UPLOAD_LEASE', 300))
+        self.poll_interval = app.config.get('UPLOAD_POLL_INTERVAL', 5)
+
+        app.before_request(self.ensure_started)
+
+    def ensure_started(self):
+        """Start the worker threads once per process."""
+
+        if self._started:
+            return
+
+        with self._start_lock:
+            if self._started:
+                return
+            threads = self.app.config.get('UPLOAD_WORKER_THREADS', 2)
+            for n in range(threads):
+                threading.Thread(target=self._loop,
+                                 name=f"upload-worker-{n}",
+                                 daemon=True).start()
+            self._started = True
+
+    def enqueue(self, listing, photo, object_name):
+        """Add an upload job for `listing`, with the bytes of `photo` (an
+        uploaded FileStorage), to the current transaction.
+
+        Call wake() after committing so an idle worker starts on it.
+        Raises PhotoTooLargeError if the photo is over MAX_CONTENT_LENGTH,
+        having read no more than one byte past it: Werkzeug checks that
+        limit against Content-Length only, which a chunked request
+        doesn't send.
+        """
+
+        limit = self.app.config.get('MAX_CONTENT_LENGTH')
+        data = photo.read() if limit is None else photo.read(limit + 1)
+        if limit is not None and len(data) > limit:
+            raise PhotoTooLargeError()
+
+        listing.photo_status = "pending"
+        db.session.add(UploadJob(listing=listing,
+                                 data=data,
+                                 object_name=object_name))
+
+    def wake(self):
+        """Tell an idle worker thread to look for jobs now."""
+
+        self._wake.set()
+
+    def run_pending(self):
+        """Run every job that is due now; return how many ran."""
+
+        count = 0
+        while self.run_one():
+            count += 1
+
+        return count
+
+    def run_one(self):
+        """Claim and run a single due job; False if there was none."""
+
+        job = UploadJob.claim_next(self.lease)
+        if job is None:
+            return False
+
+        try:
+            if job.data is None:
+                # queued by a release that staged photos on local disk
+                raise FileNotFoundError("the photo was not kept in the job")
+            url = self.upload(job.data, job.object_name)
+        except Exception as e:
+            self._failed(job, e)
+        else:
+            self._succeeded(job, url, self._variants(job))
+
+        return True
+
+    def _variants(self, job):
+        """Make the job's variants; None if there are none to be had.
+
+        The original is uploaded by now, so a photo Pillow can't read, or
+        a render that times out, leaves the listing without variants
+        rather than failing (and re-uploading) the job.
+        """
+
+        if self.process is None:
+            return None
+
+        try:
+            return self.process(job.data)
+        except Exception:
+            logger.exception("upload job %s: making variants failed", job.id)
+            return None
+
+    def _succeeded(self, job, url, variants):
+        listing = job.listing
+        listing.photo = url
+        listing.photo_variants = variants
+        listing.photo_status = "ready"
+        db.session.delete(job)
+        db.session.commit()
+
+    def _failed(self, job, error):
+        logger.warning("upload job %s attempt %s failed: %s",
+                       job.id, job.attempts, error)
+
+        job.last_error = str(error)
+
+        if job.attempts >= self.max_attempts:
+            job.status = UploadJob.FAILED
+            job.listing.photo_status = "failed"
+        else:
+            delay = min(self.retry_base * 2 ** (job.attempts - 1),
+                        self.retry_max)
+            job.status = UploadJob.PENDING
+            job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+
+        db.session.commit()
+
+    def _loop(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    ran = self.run_pending()
+            except Exception:
+                logger.exception("upload worker crashed; restarting")
+                ran = 0
+
+            if not ran:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()